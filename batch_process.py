@@ -0,0 +1,224 @@
+from __future__ import print_function
+
+import argparse
+import csv
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+
+from logger import LOGGER, set_up_logger
+from image_correction import calibrate_camera, Undistorter, BirdsEyeTransform, PerspectiveTransform, PERSPECTIVE_PRESETS
+from frame_pipeline import run_pipeline
+from video_io import get_video_info, stream_frames, make_sink
+import lane_detection_pipeline as pipeline
+
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv')
+SUMMARY_FIELDS = ['video', 'status', 'output', 'frames', 'seconds', 'fps', 'failed_frames', 'error']
+
+def find_videos(inputs,
+                extensions=VIDEO_EXTENSIONS):
+    """ Expand a list of video files and directories into video files,
+        each video once however many times it is given.
+    """
+    videos = []
+    seen = set()
+    for path in inputs:
+        if os.path.isdir(path):
+            file_names = [file_name for file_name in sorted(glob.glob(os.path.join(path, '*'))) if os.path.splitext(file_name)[1].lower() in extensions]
+        else:
+            file_names = [path]
+        for file_name in file_names:
+            absolute_path = os.path.abspath(file_name)
+            if absolute_path not in seen:
+                seen.add(absolute_path)
+                videos.append(file_name)
+
+    return videos
+
+def output_path(video_file,
+                output_dir,
+                sink):
+    """ Where the annotated video_file goes. Videos of the same name in
+        different directories, or with different extensions, are told apart
+        by a short hash of the video's absolute path.
+    """
+    path_hash = hashlib.sha1(os.path.abspath(video_file).encode('utf-8')).hexdigest()[:8]
+    name = '{0}_{1}_annotated'.format(os.path.splitext(os.path.basename(video_file))[0],
+                                      path_hash)
+    if sink != 'images':
+        name += '.mp4'
+
+    return os.path.join(output_dir, name)
+
+def process_video_job(job):
+    """ Process one video with its own pair of lines.
+
+        Runs in a pool worker and never raises, so one bad clip does not
+        stop the batch; failures are reported in the returned result.
+    """
+    video_file, output_file, mtx, dist, preset, sink_kind = job
+    result = {'video': video_file,
+              'output': output_file,
+              'status': 'failed',
+              'frames': 0,
+              'seconds': 0.,
+              'fps': 0.,
+              'failed_frames': 0,
+              'error': ''}
+    start = time.time()
+    try:
+        birds_eye = BirdsEyeTransform(Undistorter(mtx, dist),
+                                      PerspectiveTransform.from_preset(preset))
+        tracker = pipeline.make_tracker()
+        info = get_video_info(video_file)
+        with make_sink(sink_kind,
+                       output_file,
+                       info.fps,
+                       info.frame_size) as sink:
+            result['frames'] = run_pipeline(stream_frames(video_file),
+                                            sink,
+                                            birds_eye,
+                                            tracker)
+        result['failed_frames'] = tracker.failed_frames
+        result['status'] = 'done'
+    except Exception as error:
+        LOGGER.exception("Failed to process {}".format(video_file))
+        result['error'] = '{0}: {1}'.format(type(error).__name__, error)
+
+    result['seconds'] = time.time() - start
+    result['fps'] = result['frames'] / max(result['seconds'], 1e-9)
+
+    return result
+
+def load_state(state_file):
+    if not os.path.isfile(state_file):
+        return {}
+    with open(state_file) as state:
+        return json.load(state)
+
+def save_state(state_file,
+               state):
+    # Write to a temporary file first so an interrupted batch keeps the
+    # last complete state
+    temp_file = state_file + '.tmp'
+    with open(temp_file, 'w') as temp:
+        json.dump(state, temp, indent=2, sort_keys=True)
+    os.replace(temp_file,
+               state_file)
+
+def write_summary(summary_file,
+                  state):
+    with open(summary_file, 'w') as summary:
+        writer = csv.DictWriter(summary,
+                                SUMMARY_FIELDS)
+        writer.writeheader()
+        for video_file in sorted(state):
+            writer.writerow(state[video_file])
+
+def run_batch(videos,
+              output_dir,
+              workers=None,
+              preset=pipeline.PERSPECTIVE_PRESET,
+              sink='video',
+              state_file=None,
+              summary_file=None):
+    """ Process many videos across a process pool.
+
+        The state of every job is kept in a JSON file that is updated as
+        each video finishes, so an interrupted batch can be run again and
+        only the videos not yet done are processed. A CSV summary with the
+        frames, fps and failed frames of every video is written at the end.
+    """
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    if state_file is None:
+        state_file = os.path.join(output_dir, 'batch_state.json')
+    if summary_file is None:
+        summary_file = os.path.join(output_dir, 'batch_summary.csv')
+
+    state = load_state(state_file)
+    todo = [video for video in videos if state.get(video, {}).get('status') != 'done']
+    LOGGER.info("{0} videos, {1} already done, {2} to process".format(len(videos),
+                                                                      len(videos) - len(todo),
+                                                                      len(todo)))
+
+    # Calibrate once here rather than in every worker
+    _, _, _, mtx, dist, _, _ = calibrate_camera(pipeline.CALIBRATION_DIR,
+                                                (pipeline.NX, pipeline.NY),
+                                                pipeline.CALIBRATION_CACHE,
+                                                pipeline.CALIBRATION_PROCESSES)
+    jobs = [(video, output_path(video, output_dir, sink), mtx, dist, preset, sink) for video in todo]
+
+    if jobs:
+        pool = multiprocessing.Pool(workers)
+        try:
+            for result in pool.imap_unordered(process_video_job,
+                                              jobs):
+                state[result['video']] = result
+                save_state(state_file,
+                           state)
+                LOGGER.info("{0}: {1}, {2} frames at {3:.1f} fps, {4} failed frames".format(result['video'],
+                                                                                          result['status'],
+                                                                                          result['frames'],
+                                                                                          result['fps'],
+                                                                                          result['failed_frames']))
+        finally:
+            pool.close()
+            pool.join()
+
+    write_summary(summary_file,
+                  state)
+    LOGGER.info("Summary written to {}".format(summary_file))
+
+    return state
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Detect lanes in a batch of videos.')
+    parser.add_argument('inputs',
+                        nargs='+',
+                        help='video files and/or directories of videos')
+    parser.add_argument('-o', '--output-dir',
+                        default='batch_output',
+                        help='directory for the annotated videos, job state and summary')
+    parser.add_argument('-w', '--workers',
+                        type=int,
+                        default=None,
+                        help='videos processed at once (default: one per CPU)')
+    parser.add_argument('-p', '--preset',
+                        default=pipeline.PERSPECTIVE_PRESET,
+                        choices=sorted(PERSPECTIVE_PRESETS),
+                        help='perspective preset matching the camera')
+    parser.add_argument('-s', '--sink',
+                        default='video',
+                        choices=['video', 'ffmpeg', 'images'],
+                        help='how the annotated frames are written')
+    parser.add_argument('--state-file',
+                        help='job state file (default: OUTPUT_DIR/batch_state.json)')
+    parser.add_argument('--summary',
+                        help='summary CSV (default: OUTPUT_DIR/batch_summary.csv)')
+
+    return parser.parse_args(args)
+
+def main():
+    """ Batch processing entry point
+    """
+    args = parse_args()
+    state = run_batch(find_videos(args.inputs),
+                      args.output_dir,
+                      args.workers,
+                      args.preset,
+                      args.sink,
+                      args.state_file,
+                      args.summary)
+
+    failed = [video for video, result in state.items() if result['status'] != 'done']
+    if failed:
+        LOGGER.warning("{0} videos failed: {1}".format(len(failed),
+                                                       ', '.join(sorted(failed))))
+
+if __name__ == '__main__':
+    set_up_logger()
+    main()
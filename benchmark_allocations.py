@@ -0,0 +1,136 @@
+from __future__ import print_function
+
+import gc
+import glob
+import multiprocessing
+import os
+import time
+
+import cv2
+
+import numpy as np
+
+from logger import LOGGER, set_up_logger
+from image_correction import calibrate_camera, Undistorter, BirdsEyeTransform, PerspectiveTransform
+from frame_pipeline import run_pipeline
+from buffer_arena import AllocationMonitor, peak_rss_mb
+import lane_detection_pipeline as pipeline
+
+# GLOBALS
+TEST_DIR = 'test_images'
+PERSPECTIVE_PRESET = 'test_images'
+# Frames run through the pipeline per configuration, cycling the test images
+FRAMES = 100
+
+class NullSink():
+    """ Drops the annotated frames, so only the pipeline is measured. """
+    def write(self,
+              frame):
+        pass
+
+class MonitoredFrames():
+    """ Yields the frames, marking the start and end of each one on an
+        AllocationMonitor and recording how long the pipeline took over it.
+    """
+    def __init__(self,
+                 frames,
+                 monitor=None):
+        self.frames = frames
+        self.monitor = monitor
+        self.frame_times = []
+
+    def __iter__(self):
+        for frame in self.frames:
+            if self.monitor is not None:
+                self.monitor.start_frame()
+            start = time.time()
+            yield frame
+            self.frame_times.append(time.time() - start)
+            if self.monitor is not None:
+                self.monitor.end_frame()
+
+def run_configuration(reuse_buffers):
+    """ Run FRAMES frames twice in this process, once timed and once under
+        tracemalloc, and report the allocations, timings and peak RSS.
+    """
+    _, _, _, mtx, dist, _, _ = calibrate_camera(pipeline.CALIBRATION_DIR,
+                                                (pipeline.NX, pipeline.NY),
+                                                pipeline.CALIBRATION_CACHE,
+                                                pipeline.CALIBRATION_PROCESSES)
+    birds_eye = BirdsEyeTransform(Undistorter(mtx, dist),
+                                  PerspectiveTransform.from_preset(PERSPECTIVE_PRESET))
+    images = [cv2.imread(file_name) for file_name in sorted(glob.glob(os.path.join(TEST_DIR, '*.jpg')))]
+    frames = [images[index % len(images)] for index in range(FRAMES)]
+
+    pipeline.REUSE_BUFFERS = reuse_buffers
+    tracker = pipeline.make_tracker()
+    collections = sum(stats['collections'] for stats in gc.get_stats())
+    timed = MonitoredFrames(frames)
+    run_pipeline(timed,
+                 NullSink(),
+                 birds_eye,
+                 tracker)
+    collections = sum(stats['collections'] for stats in gc.get_stats()) - collections
+
+    monitor = AllocationMonitor()
+    monitor.start()
+    run_pipeline(MonitoredFrames(frames, monitor),
+                 NullSink(),
+                 birds_eye,
+                 tracker)
+    monitor.stop()
+
+    # Leave out the first frame, which fills the arena
+    frame_times = np.array(timed.frame_times[1:])
+    stats = monitor.stats()
+    stats.update({'mean_ms': 1000*frame_times.mean(),
+                  'p99_ms': 1000*np.percentile(frame_times, 99),
+                  'jitter_ms': 1000*frame_times.std(),
+                  'gc_collections': collections,
+                  'peak_rss_mb': peak_rss_mb()})
+    if tracker.arena is not None:
+        stats['arena_allocations'] = tracker.arena.allocations
+        stats['arena_mb'] = tracker.arena.nbytes() / 1024. / 1024.
+
+    return stats
+
+def main():
+    """ Per-frame allocations, latency jitter and peak RSS with and without
+        the buffer arena
+    """
+    print("{0:<10} {1:>15} {2:>14} {3:>13} {4:>9} {5:>8} {6:>11} {7:>5} {8:>13} {9:>9}".format('arena',
+                                                                                           'mean peak (MB)',
+                                                                                           'max peak (MB)',
+                                                                                           'retained (MB)',
+                                                                                           'mean (ms)',
+                                                                                           'p99 (ms)',
+                                                                                           'jitter (ms)',
+                                                                                           'gc',
+                                                                                           'peak RSS (MB)',
+                                                                                           'arena (MB)'))
+    for reuse_buffers in (False, True):
+        # A fresh process per configuration, so the peak RSS is its own
+        pool = multiprocessing.Pool(1)
+        try:
+            stats = pool.apply(run_configuration,
+                               (reuse_buffers,))
+        finally:
+            pool.close()
+            pool.join()
+        LOGGER.debug("Arena {0}: {1}".format(reuse_buffers,
+                                             stats))
+
+        print("{0:<10} {1:>15.2f} {2:>14.2f} {3:>13.3f} {4:>9.1f} {5:>8.1f} {6:>11.2f} {7:>5} {8:>13.1f} {9:>10}".format(str(reuse_buffers),
+                                                                                                               stats['mean_peak_bytes'] / 1024. / 1024.,
+                                                                                                               stats['max_peak_bytes'] / 1024. / 1024.,
+                                                                                                               stats['retained_bytes'] / 1024. / 1024.,
+                                                                                                               stats['mean_ms'],
+                                                                                                               stats['p99_ms'],
+                                                                                                               stats['jitter_ms'],
+                                                                                                               stats['gc_collections'],
+                                                                                                               stats['peak_rss_mb'] or 0.,
+                                                                                                               '{0:.1f}'.format(stats['arena_mb']) if 'arena_mb' in stats else '-'))
+
+if __name__ == '__main__':
+    set_up_logger()
+    main()
@@ -0,0 +1,135 @@
+from __future__ import print_function
+
+import glob
+import os
+import timeit
+
+import cv2
+
+import numpy as np
+
+from logger import LOGGER, set_up_logger
+from image_correction import warp_perspective, PerspectiveTransform
+from image_preprocessing import detect_lines, scaled_sobel_kernel
+from detect_lanes import fit_lines
+from frame_pipeline import detection_shape
+from line import Line
+
+# GLOBALS
+TEST_DIR = 'test_images'
+PERSPECTIVE_PRESET = 'test_images'
+# Detection scales to compare against full resolution
+SCALES = [1., 0.75, 0.5, 0.33, 0.25]
+# Timing repeats per image
+REPEATS = 10
+
+# Pixel to meter conversion factors, as in lane_detection_pipeline
+Y_M_PER_PIX = 15./920.
+X_M_PER_PIX = 3.7/605.
+
+def load_warped_images(test_dir):
+    perspective = PerspectiveTransform.from_preset(PERSPECTIVE_PRESET)
+
+    warped_images = []
+    for file_name in sorted(glob.glob(os.path.join(test_dir, '*.jpg'))):
+        image = cv2.cvtColor(cv2.imread(file_name),
+                             cv2.COLOR_BGR2RGB)
+        warped, _, _ = warp_perspective(image,
+                                        perspective)
+        warped_images.append((os.path.basename(file_name), warped))
+
+    return warped_images
+
+def detect(warped_image,
+           scale):
+    """ The detection stages at scale: shrink, threshold and fit both lines
+        from scratch with the sliding-window search. Returns the raw fits.
+    """
+    detection_image = warped_image
+    if scale != 1.:
+        height, width = detection_shape(warped_image.shape,
+                                        scale)
+        detection_image = cv2.resize(warped_image,
+                                     (width, height),
+                                     interpolation=cv2.INTER_AREA)
+    binary_warped = detect_lines(detection_image,
+                                 sobel_kernel=scaled_sobel_kernel(scale))
+
+    left_line = Line(X_M_PER_PIX, Y_M_PER_PIX, 0.1, 10)
+    right_line = Line(X_M_PER_PIX, Y_M_PER_PIX, 0.1, 10)
+    fit_lines(binary_warped,
+              left_line,
+              right_line,
+              0,
+              warped_shape=warped_image.shape[:2])
+
+    return left_line, right_line
+
+def time_detect(warped_image,
+                scale):
+    timer = timeit.Timer(lambda: detect(warped_image,
+                                        scale))
+
+    return min(timer.repeat(repeat=3, number=REPEATS)) / REPEATS
+
+def fit_errors(reference_line,
+               line,
+               height):
+    """ Largest x difference in pixels over the image and relative
+        curvature difference at the bottom, between two lines' raw fits.
+    """
+    if reference_line.current_fit[0] is None or line.current_fit[0] is None:
+        return np.nan, np.nan
+
+    ploty = np.arange(height, dtype=np.float64)
+    reference_x = np.polyval(reference_line.current_fit, ploty)
+    x = np.polyval(line.current_fit, ploty)
+    reference_curvature = reference_line.calculate_curvature(height - 1.,
+                                                             reference_line.current_fit)
+    curvature = line.calculate_curvature(height - 1.,
+                                         line.current_fit)
+
+    return np.abs(x - reference_x).max(), np.abs(curvature - reference_curvature) / reference_curvature
+
+def main():
+    """ Accuracy and speed of the lane detection at reduced resolutions
+    """
+    warped_images = load_warped_images(TEST_DIR)
+
+    # Per scale: detection times, x errors and curvature errors
+    times = dict((scale, []) for scale in SCALES)
+    x_errors = dict((scale, []) for scale in SCALES)
+    curvature_errors = dict((scale, []) for scale in SCALES)
+    for name, warped_image in warped_images:
+        reference_lines = detect(warped_image, 1.)
+        for scale in SCALES:
+            lines = detect(warped_image, scale)
+            times[scale].append(time_detect(warped_image, scale))
+            for reference_line, line in zip(reference_lines, lines):
+                x_error, curvature_error = fit_errors(reference_line,
+                                                      line,
+                                                      warped_image.shape[0])
+                x_errors[scale].append(x_error)
+                curvature_errors[scale].append(curvature_error)
+            LOGGER.debug("{0} at {1}: {2:.1f} ms".format(name,
+                                                         scale,
+                                                         1000*times[scale][-1]))
+
+    print("{0:>6} {1:>12} {2:>8} {3:>14} {4:>13} {5:>17}".format('scale',
+                                                              'time (ms)',
+                                                              'speedup',
+                                                              'mean dx (px)',
+                                                              'max dx (px)',
+                                                              'median curv err'))
+    full_time = np.mean(times[1.])
+    for scale in SCALES:
+        print("{0:>6.2f} {1:>12.2f} {2:>7.1f}x {3:>14.2f} {4:>13.2f} {5:>16.1f}%".format(scale,
+                                                                                     1000*np.mean(times[scale]),
+                                                                                     full_time / np.mean(times[scale]),
+                                                                                     np.nanmean(x_errors[scale]),
+                                                                                     np.nanmax(x_errors[scale]),
+                                                                                     100*np.nanmedian(curvature_errors[scale])))
+
+if __name__ == '__main__':
+    set_up_logger()
+    main()
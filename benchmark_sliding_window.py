@@ -0,0 +1,138 @@
+from __future__ import print_function
+
+import glob
+import os
+import timeit
+
+import cv2
+
+import numpy as np
+
+from logger import LOGGER, set_up_logger
+from image_correction import warp_perspective, PerspectiveTransform
+from image_preprocessing import detect_lines
+from detect_lanes import sliding_window_search
+
+# GLOBALS
+TEST_DIR = 'test_images'
+PERSPECTIVE_PRESET = 'test_images'
+# Timing repeats per image
+REPEATS = 50
+# Fraction of extra random pixels set in the noisy variant of each binary
+NOISE_FRACTION = 0.25
+MARGIN = 100
+
+def full_scan_sliding_window_search(binary_warped,
+                                    nonzerox,
+                                    nonzeroy,
+                                    margin):
+    """ The sliding-window search as it was before the row-bucketed index,
+        where every window compares against every nonzero pixel. Kept as the
+        reference the bucketed search must match exactly.
+    """
+    histogram = np.sum(binary_warped[np.floor(binary_warped.shape[0]/2).astype(np.int):,:], axis=0)
+    midpoint = np.int(histogram.shape[0]/2)
+    leftx_current = np.argmax(histogram[:midpoint])
+    rightx_current = np.argmax(histogram[midpoint:]) + midpoint
+
+    nwindows = 9
+    window_height = np.int(binary_warped.shape[0]/nwindows)
+    minpix = 50
+    left_lane_inds = []
+    right_lane_inds = []
+
+    for window in range(nwindows):
+        win_y_low = binary_warped.shape[0] - (window+1)*window_height
+        win_y_high = binary_warped.shape[0] - window*window_height
+        win_xleft_low = leftx_current - margin
+        win_xleft_high = leftx_current + margin
+        win_xright_low = rightx_current - margin
+        win_xright_high = rightx_current + margin
+
+        good_left_inds = (((nonzeroy >= win_y_low) & (nonzeroy < win_y_high) & (nonzerox >= win_xleft_low) & (nonzerox < win_xleft_high)).nonzero()[0]).astype(np.int)
+        good_right_inds = (((nonzeroy >= win_y_low) & (nonzeroy < win_y_high) & (nonzerox >= win_xright_low) & (nonzerox < win_xright_high)).nonzero()[0]).astype(np.int)
+        left_lane_inds.append(good_left_inds)
+        right_lane_inds.append(good_right_inds)
+        if len(good_left_inds) > minpix:
+            leftx_current = np.int(np.mean(nonzerox[good_left_inds]))
+        if len(good_right_inds) > minpix:
+            rightx_current = np.int(np.mean(nonzerox[good_right_inds]))
+
+    return np.concatenate(left_lane_inds), np.concatenate(right_lane_inds)
+
+def load_binaries(test_dir):
+    perspective = PerspectiveTransform.from_preset(PERSPECTIVE_PRESET)
+    random_state = np.random.RandomState(0)
+
+    binaries = []
+    for file_name in sorted(glob.glob(os.path.join(test_dir, '*.jpg'))):
+        image = cv2.cvtColor(cv2.imread(file_name),
+                             cv2.COLOR_BGR2RGB)
+        warped, _, _ = warp_perspective(image,
+                                        perspective)
+        binary_warped = detect_lines(warped)
+        binaries.append((os.path.basename(file_name), binary_warped))
+
+        # Same image with salt noise, to stress the per-window pixel scan
+        noisy = binary_warped.copy()
+        noisy[random_state.random_sample(noisy.shape) < NOISE_FRACTION] = 1
+        binaries.append((os.path.basename(file_name) + ' +noise', noisy))
+
+    return binaries
+
+def time_search(search,
+                binary_warped,
+                nonzerox,
+                nonzeroy):
+    timer = timeit.Timer(lambda: search(binary_warped,
+                                        nonzerox,
+                                        nonzeroy,
+                                        MARGIN))
+
+    return min(timer.repeat(repeat=5, number=REPEATS)) / REPEATS
+
+def main():
+    """ Compare the full-scan and row-bucketed sliding-window searches
+    """
+    print("{0:<26} {1:>9} {2:>12} {3:>12} {4:>8} {5:>6}".format('image',
+                                                             'pixels',
+                                                             'full (ms)',
+                                                             'bucket (ms)',
+                                                             'speedup',
+                                                             'match'))
+    for name, binary_warped in load_binaries(TEST_DIR):
+        nonzero = binary_warped.nonzero()
+        nonzeroy = np.array(nonzero[0])
+        nonzerox = np.array(nonzero[1])
+
+        reference = full_scan_sliding_window_search(binary_warped,
+                                                    nonzerox,
+                                                    nonzeroy,
+                                                    MARGIN)
+        bucketed = sliding_window_search(binary_warped,
+                                         nonzerox,
+                                         nonzeroy,
+                                         MARGIN)
+        match = all(np.array_equal(expected, actual) for expected, actual in zip(reference, bucketed))
+        if not match:
+            LOGGER.error("Bucketed search does not match the full scan on {}".format(name))
+
+        full_time = time_search(full_scan_sliding_window_search,
+                                binary_warped,
+                                nonzerox,
+                                nonzeroy)
+        bucket_time = time_search(sliding_window_search,
+                                  binary_warped,
+                                  nonzerox,
+                                  nonzeroy)
+
+        print("{0:<26} {1:>9} {2:>12.3f} {3:>12.3f} {4:>7.1f}x {5:>6}".format(name,
+                                                                           len(nonzerox),
+                                                                           1000*full_time,
+                                                                           1000*bucket_time,
+                                                                           full_time / bucket_time,
+                                                                           str(match)))
+
+if __name__ == '__main__':
+    set_up_logger()
+    main()
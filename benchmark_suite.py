@@ -0,0 +1,431 @@
+from __future__ import print_function
+
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import cv2
+
+import numpy as np
+
+from logger import LOGGER, set_up_logger
+from image_correction import calibrate_camera, warp_perspective, Undistorter, BirdsEyeTransform, PerspectiveTransform, PERSPECTIVE_PRESETS
+from image_preprocessing import detect_lines, threshold_lines, LANE_COLOURS, GRADIENTS
+from detect_lanes import fit_lines, visualise_lanes
+from frame_pipeline import process_frame, run_pipeline
+from line import fit_polynomial
+from profiling import PROFILER, set_up_profiler
+from buffer_arena import peak_rss_mb
+from video_io import stream_frames
+import lane_detection_pipeline as pipeline
+
+# GLOBALS
+TEST_DIR = 'test_images'
+PERSPECTIVE_PRESET = 'test_images'
+# Stages whose median latency may grow by this fraction over the baseline
+# before it is flagged as a regression
+TOLERANCE = 0.1
+
+def latency_stats(durations):
+    """ Count, mean, p50, p95, p99 and largest of durations in seconds, in
+        milliseconds.
+    """
+    durations = 1000. * np.asarray(durations, dtype=np.float64)
+    p50, p95, p99 = np.percentile(durations, [50, 95, 99])
+
+    return {'count': len(durations),
+            'mean_ms': float(durations.mean()),
+            'p50_ms': float(p50),
+            'p95_ms': float(p95),
+            'p99_ms': float(p99),
+            'max_ms': float(durations.max())}
+
+def time_calls(function,
+               repeats,
+               warmup):
+    """ Durations of repeats calls of function, after warmup untimed ones. """
+    for _ in range(warmup):
+        function()
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+
+    return durations
+
+def traced_peak_mb(function):
+    """ Most memory allocated through Python and numpy during one call. """
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return (peak - start) / 1024. / 1024.
+
+def image_stages(frame,
+                 birds_eye,
+                 perspective):
+    """ The stages of the pipeline as calls on one test image, each on the
+        output of the stage before it, as (name, function) pairs.
+    """
+    undistorter = birds_eye.undistorter
+    undistorted = cv2.cvtColor(undistorter.undistort(frame),
+                               cv2.COLOR_BGR2RGB)
+    warped, M, Minv = warp_perspective(undistorted,
+                                       perspective)
+    binary_warped = detect_lines(warped)
+    hsv_image = cv2.cvtColor(warped,
+                             cv2.COLOR_BGR2HSV)
+    s_channel = np.ascontiguousarray(cv2.cvtColor(warped,
+                                                  cv2.COLOR_BGR2HLS)[:, :, 2])
+
+    # Lines fitted to this image, for the stages after the fit
+    tracker = pipeline.make_tracker()
+    fit_lines(binary_warped,
+              tracker.left_line,
+              tracker.right_line,
+              0)
+    nonzeroy, nonzerox = binary_warped.nonzero()
+    left = nonzerox < binary_warped.shape[1] // 2
+    left_fit, left_moments = fit_polynomial(nonzerox[left],
+                                            nonzeroy[left],
+                                            binary_warped.shape[0])
+    right_fit, _ = fit_polynomial(nonzerox[~left],
+                                  nonzeroy[~left],
+                                  binary_warped.shape[0])
+
+    def fit_from_scratch():
+        scratch = pipeline.make_tracker()
+        fit_lines(binary_warped,
+                  scratch.left_line,
+                  scratch.right_line,
+                  0)
+
+    # Fresh lines every call, so each frame is searched from scratch, but
+    # the buffers are reused as they would be from frame to frame
+    arena = tracker.arena
+    def make_frame():
+        scratch = pipeline.make_tracker()
+        scratch.arena = arena
+        process_frame(frame,
+                      birds_eye,
+                      scratch)
+
+    return [('undistort', lambda: undistorter.undistort(frame)),
+            ('warp_perspective', lambda: warp_perspective(undistorted, perspective)),
+            ('birds_eye_warp', lambda: birds_eye.warp(frame, True)),
+            ('colour_threshold', lambda: LANE_COLOURS.apply(hsv_image)),
+            ('sobel_gradients', lambda: GRADIENTS.compute(s_channel)),
+            ('threshold_lines', lambda: threshold_lines(warped)),
+            ('detect_lines', lambda: detect_lines(warped)),
+            ('fit_lines', fit_from_scratch),
+            ('line_update', lambda: tracker.left_line.update(left_fit,
+                                                             right_fit,
+                                                             nonzerox[left],
+                                                             nonzeroy[left],
+                                                             binary_warped.shape,
+                                                             1,
+                                                             left_moments)),
+            ('visualise_lanes', lambda: visualise_lanes(undistorted,
+                                                        binary_warped,
+                                                        tracker.left_line,
+                                                        tracker.right_line,
+                                                        Minv,
+                                                        M)),
+            ('make_frame', make_frame)]
+
+def benchmark_images(test_dir,
+                     birds_eye,
+                     perspective,
+                     repeats,
+                     warmup):
+    """ Latency of every stage over the test images, and the most memory
+        one call of it allocates.
+    """
+    durations = {}
+    peaks = {}
+    stage_order = []
+    for file_name in sorted(glob.glob(os.path.join(test_dir, '*.jpg'))):
+        frame = cv2.imread(file_name)
+        for name, function in image_stages(frame,
+                                           birds_eye,
+                                           perspective):
+            if name not in durations:
+                stage_order.append(name)
+                durations[name] = []
+                peaks[name] = 0.
+            durations[name].extend(time_calls(function,
+                                              repeats,
+                                              warmup))
+            peaks[name] = max(peaks[name],
+                              traced_peak_mb(function))
+        LOGGER.debug("Benchmarked {}".format(file_name))
+
+    stages = {}
+    for name in stage_order:
+        stages[name] = latency_stats(durations[name])
+        stages[name]['peak_traced_mb'] = peaks[name]
+    if 'make_frame' in stages:
+        stages['make_frame']['fps'] = 1000. / stages['make_frame']['mean_ms']
+
+    return stages
+
+class TimedFrames():
+    """ Yields the frames, recording how long the pipeline took over each. """
+    def __init__(self,
+                 frames):
+        self.frames = frames
+        self.frame_times = []
+
+    def __iter__(self):
+        for frame in self.frames:
+            start = time.perf_counter()
+            yield frame
+            self.frame_times.append(time.perf_counter() - start)
+
+class NullSink():
+    def write(self,
+              frame):
+        pass
+
+def benchmark_clip(video_file,
+                   birds_eye,
+                   max_frames,
+                   repeats,
+                   warmup):
+    """ End-to-end frame rate and per-stage latency over a clip, decoded
+        into memory first so the decoding is left out. Each run tracks the
+        clip from the start with fresh lines.
+    """
+    frames = []
+    for frame in stream_frames(video_file):
+        frames.append(frame)
+        if max_frames is not None and len(frames) >= max_frames:
+            break
+
+    for _ in range(warmup):
+        run_pipeline(frames,
+                     NullSink(),
+                     birds_eye,
+                     pipeline.make_tracker())
+
+    frame_times = []
+    run_times = []
+    set_up_profiler()
+    try:
+        for _ in range(repeats):
+            timed = TimedFrames(frames)
+            start = time.perf_counter()
+            run_pipeline(timed,
+                         NullSink(),
+                         birds_eye,
+                         pipeline.make_tracker())
+            run_times.append(time.perf_counter() - start)
+            frame_times.extend(timed.frame_times)
+        stage_stats = PROFILER.stats()
+    finally:
+        PROFILER.enabled = False
+
+    stages = {}
+    for stats in stage_stats:
+        stages[stats.pop('stage')] = stats
+
+    return {'video': video_file,
+            'frames': len(frames),
+            'fps': len(frames) * len(run_times) / sum(run_times),
+            'frame': latency_stats(frame_times),
+            'stages': stages}
+
+def environment():
+    return {'python': platform.python_version(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpus': multiprocessing.cpu_count()}
+
+def run_benchmarks(test_dir,
+                   video_file,
+                   preset,
+                   max_frames,
+                   repeats,
+                   warmup):
+    _, _, _, mtx, dist, _, _ = calibrate_camera(pipeline.CALIBRATION_DIR,
+                                                (pipeline.NX, pipeline.NY),
+                                                pipeline.CALIBRATION_CACHE,
+                                                pipeline.CALIBRATION_PROCESSES)
+    undistorter = Undistorter(mtx, dist)
+    # The test images and the clip can come from differently mounted cameras
+    image_perspective = PerspectiveTransform.from_preset(PERSPECTIVE_PRESET)
+    results = {'environment': environment(),
+               'config': {'test_dir': test_dir,
+                          'video': video_file,
+                          'preset': preset,
+                          'max_frames': max_frames,
+                          'repeats': repeats,
+                          'warmup': warmup},
+               'images': benchmark_images(test_dir,
+                                          BirdsEyeTransform(undistorter,
+                                                            image_perspective),
+                                          image_perspective,
+                                          repeats,
+                                          warmup)}
+    if video_file is not None:
+        results['clip'] = benchmark_clip(video_file,
+                                         BirdsEyeTransform(undistorter,
+                                                           PerspectiveTransform.from_preset(preset)),
+                                         max_frames,
+                                         repeats,
+                                         warmup)
+    results['peak_rss_mb'] = peak_rss_mb()
+
+    return results
+
+def compare_results(results,
+                    baseline,
+                    tolerance=TOLERANCE):
+    """ Each stage's median latency, and the clip frame rate, against a
+        baseline. Returns (name, baseline, current, change, regressed) rows,
+        change being the fraction the stage got slower by.
+    """
+    rows = []
+    for section in ('images', 'clip'):
+        if section == 'images':
+            stages, baseline_stages = results.get('images', {}), baseline.get('images', {})
+        else:
+            stages = results.get('clip', {}).get('stages', {})
+            baseline_stages = baseline.get('clip', {}).get('stages', {})
+        for name in stages:
+            if name not in baseline_stages:
+                continue
+            old = baseline_stages[name]['p50_ms']
+            new = stages[name]['p50_ms']
+            change = new / old - 1. if old > 0 else 0.
+            rows.append((section + '/' + name, old, new, change, change > tolerance))
+
+    if 'clip' in results and 'clip' in baseline:
+        old = baseline['clip']['fps']
+        new = results['clip']['fps']
+        change = old / new - 1. if new > 0 else float('inf')
+        rows.append(('clip/fps', old, new, change, change > tolerance))
+
+    return rows
+
+def print_results(results):
+    print("{0:<28} {1:>8} {2:>9} {3:>9} {4:>9} {5:>9} {6:>10}".format('stage',
+                                                                    'count',
+                                                                    'p50 (ms)',
+                                                                    'p95 (ms)',
+                                                                    'p99 (ms)',
+                                                                    'mean (ms)',
+                                                                    'peak (MB)'))
+    sections = [('images', results['images'])]
+    if 'clip' in results:
+        sections.append(('clip', results['clip']['stages']))
+    for section, stages in sections:
+        for name, stats in stages.items():
+            print("{0:<28} {1:>8} {2:>9.2f} {3:>9.2f} {4:>9.2f} {5:>9.2f} {6:>10}".format(section + '/' + name,
+                                                                                         stats['count'],
+                                                                                         stats['p50_ms'],
+                                                                                         stats['p95_ms'],
+                                                                                         stats['p99_ms'],
+                                                                                         stats['mean_ms'],
+                                                                                         '{0:.2f}'.format(stats['peak_traced_mb']) if 'peak_traced_mb' in stats else '-'))
+    if 'clip' in results:
+        print("clip: {0} frames at {1:.1f} fps".format(results['clip']['frames'],
+                                                       results['clip']['fps']))
+    if results['peak_rss_mb'] is not None:
+        print("peak RSS: {0:.1f} MB".format(results['peak_rss_mb']))
+
+def print_comparison(rows):
+    print("{0:<28} {1:>10} {2:>10} {3:>8}".format('compared to baseline',
+                                                  'baseline',
+                                                  'current',
+                                                  'change'))
+    for name, old, new, change, regressed in rows:
+        print("{0:<28} {1:>10.2f} {2:>10.2f} {3:>+7.1f}% {4}".format(name,
+                                                                    old,
+                                                                    new,
+                                                                    100*change,
+                                                                    'REGRESSION' if regressed else ''))
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark the lane detection stages.')
+    parser.add_argument('-t', '--test-dir',
+                        default=TEST_DIR,
+                        help='directory of test images')
+    parser.add_argument('-v', '--video',
+                        help='video clip to benchmark end to end (default: none)')
+    parser.add_argument('-p', '--preset',
+                        default=pipeline.PERSPECTIVE_PRESET,
+                        choices=sorted(PERSPECTIVE_PRESETS),
+                        help='perspective preset matching the clip')
+    parser.add_argument('-f', '--frames',
+                        type=int,
+                        default=None,
+                        help='frames of the clip to use (default: all)')
+    parser.add_argument('-r', '--repeats',
+                        type=int,
+                        default=10,
+                        help='timed calls per stage and image, and timed runs of the clip')
+    parser.add_argument('-w', '--warmup',
+                        type=int,
+                        default=2,
+                        help='untimed calls or runs before the timed ones')
+    parser.add_argument('-o', '--output',
+                        help='JSON file to write the results to')
+    parser.add_argument('-b', '--baseline',
+                        help='JSON results of an earlier run to compare against')
+    parser.add_argument('--tolerance',
+                        type=float,
+                        default=TOLERANCE,
+                        help='fraction a median may slow down by before it is flagged')
+
+    return parser.parse_args(args)
+
+def main():
+    """ Benchmark entry point. Exits with status 1 if any stage regressed
+        against the baseline.
+    """
+    args = parse_args()
+    results = run_benchmarks(args.test_dir,
+                             args.video,
+                             args.preset,
+                             args.frames,
+                             args.repeats,
+                             args.warmup)
+    print_results(results)
+
+    if args.output is not None:
+        with open(args.output, 'w') as json_file:
+            json.dump(results,
+                      json_file,
+                      indent=2)
+        LOGGER.info("Benchmark results written to {}".format(args.output))
+
+    if args.baseline is not None:
+        with open(args.baseline) as json_file:
+            baseline = json.load(json_file)
+        rows = compare_results(results,
+                               baseline,
+                               args.tolerance)
+        print_comparison(rows)
+        regressions = [row[0] for row in rows if row[4]]
+        if regressions:
+            LOGGER.warning("{0} regressions: {1}".format(len(regressions),
+                                                         ', '.join(regressions)))
+            sys.exit(1)
+
+if __name__ == '__main__':
+    set_up_logger()
+    main()
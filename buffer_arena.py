@@ -0,0 +1,147 @@
+import sys
+import tracemalloc
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+import numpy as np
+
+class BufferArena():
+    """ Named arrays that are allocated once and reused for every frame.
+
+        `get` hands back an array for a name backed by the same memory as
+        long as it fits, so once the first frames have been through, a
+        steady-state run allocates nothing from here. Each name keeps a flat
+        block that only grows; smaller requests, such as the varying width
+        of a lane corridor, are contiguous views onto its start. The arrays
+        are overwritten by the next frame; anything that has to outlive the
+        frame must be copied.
+    """
+    def __init__(self):
+        # Flat backing block per name
+        self.buffers = {}
+        # Blocks allocated, and their total size, since the arena was made
+        self.allocations = 0
+        self.allocated_bytes = 0
+
+    def get(self,
+            name,
+            shape,
+            dtype=np.uint8):
+        shape = tuple(int(size) for size in shape)
+        dtype = np.dtype(dtype)
+        size = int(np.prod(shape))
+        block = self.buffers.get(name)
+        if block is None or block.dtype != dtype or block.size < size:
+            capacity = size
+            if block is not None and block.dtype == dtype:
+                # Grow by half again, so a slowly widening request only
+                # reallocates a few times
+                capacity = max(size, block.size + block.size // 2)
+            block = np.empty(capacity, dtype=dtype)
+            self.buffers[name] = block
+            self.allocations += 1
+            self.allocated_bytes += block.nbytes
+
+        return block[:size].reshape(shape)
+
+    def zeros(self,
+              name,
+              shape,
+              dtype=np.uint8):
+        buffer = self.get(name,
+                          shape,
+                          dtype)
+        buffer.fill(0)
+
+        return buffer
+
+    def nbytes(self):
+        """ Bytes currently held by the arena. """
+        return sum(buffer.nbytes for buffer in self.buffers.values())
+
+def get_buffer(arena,
+               name,
+               shape,
+               dtype=np.uint8):
+    """ An array from arena, or a new one when there is no arena. """
+    if arena is None:
+        return np.empty(shape, dtype=dtype)
+
+    return arena.get(name,
+                     shape,
+                     dtype)
+
+def get_zeros(arena,
+              name,
+              shape,
+              dtype=np.uint8):
+    if arena is None:
+        return np.zeros(shape, dtype=dtype)
+
+    return arena.zeros(name,
+                       shape,
+                       dtype)
+
+def peak_rss_mb():
+    """ Peak resident set size of this process so far, in MB, or None
+        where the platform cannot report it.
+    """
+    if resource is None:
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    if sys.platform == 'darwin':
+        return peak / 1024. / 1024.
+
+    return peak / 1024.
+
+class AllocationMonitor():
+    """ Per-frame Python and numpy allocations through tracemalloc.
+
+        Call `start_frame` before and `end_frame` after each frame. For each
+        frame it records the transient peak, the most memory allocated on
+        top of what was held when the frame started, and the memory still
+        held at the end, which grows when something leaks between frames.
+    """
+    def __init__(self):
+        self.peaks = []
+        self.retained = []
+        self.frame_start = 0
+
+    def start(self):
+        tracemalloc.start()
+
+    def stop(self):
+        tracemalloc.stop()
+
+    def start_frame(self):
+        tracemalloc.reset_peak()
+        self.frame_start = tracemalloc.get_traced_memory()[0]
+
+    def end_frame(self):
+        current, peak = tracemalloc.get_traced_memory()
+        self.peaks.append(peak - self.frame_start)
+        self.retained.append(current - self.frame_start)
+
+    def stats(self,
+              skip=1):
+        """ Mean and largest transient peak and total retained memory, in
+            bytes, leaving out the first skip frames that fill the buffers.
+        """
+        peaks = np.array(self.peaks[skip:], dtype=np.float64)
+        retained = np.array(self.retained[skip:], dtype=np.float64)
+        if len(peaks) == 0:
+            return {'frames': 0,
+                    'mean_peak_bytes': 0.,
+                    'max_peak_bytes': 0.,
+                    'retained_bytes': 0.}
+
+        return {'frames': len(peaks),
+                'mean_peak_bytes': float(peaks.mean()),
+                'max_peak_bytes': float(peaks.max()),
+                'retained_bytes': float(retained.sum())}
@@ -0,0 +1,95 @@
+import hashlib
+import os
+
+import numpy as np
+
+from logger import LOGGER
+
+# Bump this whenever the layout of the cache file changes
+CACHE_VERSION = 1
+
+def calibration_key(images,
+                    chessboard_dim):
+    """ Build the cache key for a set of calibration images.
+
+        The key is a hash of every image's contents (in the order they are
+        processed) together with the chessboard dimensions, so editing,
+        adding or removing an image, or changing the board, invalidates it.
+    """
+    key = hashlib.sha1()
+    key.update('v{0}:{1}x{2}'.format(CACHE_VERSION,
+                                     chessboard_dim[0],
+                                     chessboard_dim[1]).encode('utf-8'))
+    for file_name in images:
+        with open(file_name, 'rb') as image_file:
+            key.update(hashlib.sha1(image_file.read()).digest())
+
+    return key.hexdigest()
+
+def save_calibration(cache_file,
+                     key,
+                     objpoints,
+                     imgpoints,
+                     ret,
+                     mtx,
+                     dist,
+                     rvecs,
+                     tvecs):
+    # Each image may have matched a different board size, so the corner
+    # points are stored flattened alongside the number of points per image
+    point_counts = np.array([len(objp) for objp in objpoints], dtype=np.int32)
+
+    cache_directory = os.path.dirname(cache_file)
+    if cache_directory and not os.path.isdir(cache_directory):
+        os.makedirs(cache_directory)
+
+    # Write to a temporary file first so an interrupted run never leaves a
+    # truncated cache behind
+    temp_file = cache_file + '.tmp.npz'
+    np.savez_compressed(temp_file,
+                        key=np.array(key),
+                        point_counts=point_counts,
+                        objpoints=np.concatenate(objpoints).astype(np.float32),
+                        imgpoints=np.concatenate(imgpoints).astype(np.float32),
+                        ret=np.array(ret),
+                        mtx=mtx,
+                        dist=dist,
+                        rvecs=np.array(rvecs),
+                        tvecs=np.array(tvecs))
+    os.replace(temp_file,
+               cache_file)
+
+    LOGGER.info("Calibration cached to {}".format(cache_file))
+
+def load_calibration(cache_file,
+                     key):
+    """ Load a cached calibration.
+
+        Returns the same tuple as `calibrate_camera`, or None when there is no
+        cache file, it cannot be read, or it was built from different images.
+    """
+    if not os.path.isfile(cache_file):
+        return None
+
+    try:
+        with np.load(cache_file) as cache:
+            if str(cache['key']) != key:
+                LOGGER.info("Calibration cache {} is stale".format(cache_file))
+                return None
+
+            split_points = np.cumsum(cache['point_counts'])[:-1]
+            objpoints = np.split(cache['objpoints'], split_points)
+            imgpoints = np.split(cache['imgpoints'], split_points)
+            ret = float(cache['ret'])
+            mtx = cache['mtx']
+            dist = cache['dist']
+            rvecs = list(cache['rvecs'])
+            tvecs = list(cache['tvecs'])
+    except (IOError, KeyError, ValueError) as error:
+        LOGGER.warning("Could not read calibration cache {0}: {1}".format(cache_file,
+                                                                          error))
+        return None
+
+    LOGGER.info("Loaded calibration from {}".format(cache_file))
+
+    return objpoints, imgpoints, ret, mtx, dist, rvecs, tvecs
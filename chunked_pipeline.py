@@ -0,0 +1,251 @@
+import collections
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+import cv2
+
+from logger import LOGGER
+from frame_pipeline import preprocess_frame
+from frame_results import FrameResultsWriter, frame_result, concatenate_results
+from video_io import get_video_info, make_sink, stream_frames, VideoWriterSink
+from buffer_arena import get_buffer
+
+Chunk = collections.namedtuple('Chunk', ['index', 'warmup_start', 'start', 'end'])
+
+def keyframe_indices(video_file,
+                     fps,
+                     ffprobe='ffprobe'):
+    """ Indices of the keyframes of a video, from the packet flags reported
+        by ffprobe. Returns None when ffprobe is not available or fails.
+    """
+    command = [ffprobe,
+               '-v', 'error',
+               '-select_streams', 'v:0',
+               '-show_entries', 'packet=pts_time,flags',
+               '-of', 'csv=p=0',
+               video_file]
+    try:
+        output = subprocess.check_output(command).decode()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    # Packets come in decode order, so sort the presentation times
+    times = []
+    keyframe_times = []
+    for line in output.splitlines():
+        fields = line.strip().split(',')
+        if len(fields) < 2 or fields[0] in ('', 'N/A'):
+            continue
+        times.append(float(fields[0]))
+        if 'K' in fields[1]:
+            keyframe_times.append(float(fields[0]))
+    if not keyframe_times:
+        return None
+
+    first = min(times)
+    return sorted(set(int(round((pts - first) * fps)) for pts in keyframe_times))
+
+def plan_chunks(frame_count,
+                n_chunks,
+                overlap,
+                keyframes=None):
+    """ Split frame_count frames into at most n_chunks contiguous chunks.
+
+        Chunks start at the keyframe nearest to an even split when keyframes
+        are given, and at the even split otherwise. Each chunk warms up from
+        at least overlap frames before its start; those frames are tracked
+        again but not written. With keyframes the warm-up starts at the
+        keyframe at or before that, so seeking to it is cheap and exact.
+    """
+    starts = [0]
+    for chunk in range(1, n_chunks):
+        target = chunk * frame_count // n_chunks
+        if keyframes:
+            target = min(keyframes, key=lambda keyframe: abs(keyframe - target))
+        if starts[-1] < target < frame_count:
+            starts.append(target)
+
+    ends = starts[1:] + [frame_count]
+
+    chunks = []
+    for index, (start, end) in enumerate(zip(starts, ends)):
+        warmup_start = max(0, start - overlap)
+        if keyframes:
+            warmup_start = max([keyframe for keyframe in keyframes if keyframe <= warmup_start] + [0])
+        chunks.append(Chunk(index, warmup_start, start, end))
+
+    return chunks
+
+def process_chunk(job):
+    """ Process the frames of one chunk with its own LaneTracker.
+
+        The tracker starts from fresh lines at the chunk's warm-up start and
+        tracks the overlap frames without drawing them, filling the lines'
+        smoothing state, before the chunk's own frames are annotated and
+        written.
+    """
+    video_file, chunk, birds_eye, make_tracker, sink_kind, output, results_file = job
+    info = get_video_info(video_file)
+    tracker = make_tracker()
+    # Frame numbers as in a serial run, since the curvature is only
+    # updated every few frames
+    tracker.frame_number = chunk.warmup_start
+
+    capture = cv2.VideoCapture(video_file)
+    if chunk.warmup_start > 0:
+        capture.set(cv2.CAP_PROP_POS_FRAMES,
+                    chunk.warmup_start)
+    start = time.time()
+    frame_count = 0
+    try:
+        with make_sink(sink_kind, output, info.fps, info.frame_size) as sink, \
+             FrameResultsWriter(results_file) as results:
+            if sink_kind == 'images':
+                # Number the images as in the whole video
+                sink.frame_number = chunk.start
+            for frame_number in range(chunk.warmup_start, chunk.end):
+                ret, frame = capture.read()
+                if not ret:
+                    break
+                plot_image, _, binary_warped, M, Minv = preprocess_frame(frame,
+                                                                         birds_eye,
+                                                                         column_ranges=tracker.column_ranges(frame.shape,
+                                                                                                             birds_eye),
+                                                                         detection_scale=tracker.detection_scale,
+                                                                         arena=tracker.arena)
+                if frame_number < chunk.start:
+                    tracker.track(binary_warped,
+                                  (frame.shape[1], frame.shape[0]))
+                    continue
+                detected_lanes = tracker.process(plot_image,
+                                                 binary_warped,
+                                                 M,
+                                                 Minv)
+                sink.write(cv2.cvtColor(detected_lanes,
+                                        cv2.COLOR_RGB2BGR,
+                                        get_buffer(tracker.arena, 'run_pipeline.output', detected_lanes.shape)))
+                results.write(frame_result(tracker,
+                                           tracker.position(M, (frame.shape[1], frame.shape[0]))))
+                frame_count += 1
+    finally:
+        capture.release()
+
+    return chunk.index, frame_count, time.time() - start
+
+def concatenate_videos(video_files,
+                       output_file,
+                       fps,
+                       frame_size,
+                       ffmpeg='ffmpeg'):
+    """ Join videos end to end, without re-encoding when ffmpeg is available
+        and by decoding and writing every frame again otherwise.
+    """
+    list_file = output_file + '.concat.txt'
+    with open(list_file, 'w') as concat_list:
+        for video_file in video_files:
+            concat_list.write("file '{}'\n".format(os.path.abspath(video_file)))
+    command = [ffmpeg,
+               '-y',
+               '-loglevel', 'error',
+               '-f', 'concat',
+               '-safe', '0',
+               '-i', list_file,
+               '-c', 'copy',
+               output_file]
+    try:
+        subprocess.check_call(command)
+        return
+    except (OSError, subprocess.CalledProcessError):
+        LOGGER.info("ffmpeg is not available, re-encoding the chunks into {}".format(output_file))
+    finally:
+        os.remove(list_file)
+
+    with VideoWriterSink(output_file, fps, frame_size) as sink:
+        for video_file in video_files:
+            for frame in stream_frames(video_file):
+                sink.write(frame)
+
+def run_chunked_pipeline(video_file,
+                         output,
+                         results_file,
+                         birds_eye,
+                         make_tracker,
+                         sink_kind='video',
+                         chunks=None,
+                         overlap=50,
+                         workers=None):
+    """ Process one long video as independent chunks in parallel.
+
+        The video is split at keyframes (or evenly, without ffprobe) into
+        chunks that are processed in a process pool, each with a fresh
+        LaneTracker from make_tracker warmed up on the overlap frames before
+        it. The chunk outputs are stitched into output, and the per-frame
+        results into results_file. The tracking near the start of a chunk
+        can differ from a serial run; the longer the overlap, the more
+        likely the lines have settled into the same state. Returns the
+        number of frames written.
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if chunks is None:
+        chunks = workers
+
+    info = get_video_info(video_file)
+    plan = plan_chunks(info.frame_count,
+                       chunks,
+                       overlap,
+                       keyframe_indices(video_file, info.fps))
+    LOGGER.info("Processing {0} frames as {1} chunks with {2} workers".format(info.frame_count,
+                                                                             len(plan),
+                                                                             workers))
+
+    chunk_dir = tempfile.mkdtemp(prefix='chunks_',
+                                 dir=os.path.dirname(os.path.abspath(results_file)))
+    jobs = []
+    for chunk in plan:
+        if sink_kind == 'images':
+            chunk_output = output
+        else:
+            chunk_output = os.path.join(chunk_dir, 'chunk_{:04d}.mp4'.format(chunk.index))
+        jobs.append((video_file,
+                     chunk,
+                     birds_eye,
+                     make_tracker,
+                     sink_kind,
+                     chunk_output,
+                     os.path.join(chunk_dir, 'chunk_{:04d}.csv'.format(chunk.index))))
+
+    start = time.time()
+    frame_count = 0
+    pool = multiprocessing.Pool(workers)
+    try:
+        for index, chunk_frames, seconds in pool.imap_unordered(process_chunk,
+                                                                jobs):
+            LOGGER.info("Chunk {0}: {1} frames in {2:.1f} s".format(index,
+                                                                   chunk_frames,
+                                                                   seconds))
+            frame_count += chunk_frames
+        pool.close()
+        pool.join()
+
+        if sink_kind != 'images':
+            concatenate_videos([job[5] for job in jobs],
+                               output,
+                               info.fps,
+                               info.frame_size)
+        concatenate_results([job[6] for job in jobs],
+                            results_file)
+    finally:
+        pool.terminate()
+        shutil.rmtree(chunk_dir)
+
+    elapsed = time.time() - start
+    LOGGER.info("Processed {0} frames in {1:.1f} s ({2:.1f} fps)".format(frame_count,
+                                                                         elapsed,
+                                                                         frame_count / max(elapsed, 1e-9)))
+
+    return frame_count
@@ -2,6 +2,18 @@ import cv2
 
 import numpy as np
 
+from logger import LOGGER
+from profiling import PROFILER
+from line import fit_polynomial
+from buffer_arena import get_buffer, get_zeros
+
+# Pixels a sliding window needs to recenter at full resolution
+MINPIX = 50
+# Fractional bits of the lane polygon's vertices in the frame
+OVERLAY_SHIFT = 4
+# Row coordinates of the warped image per height, for the overlay
+PLOT_ROWS = {}
+
 # from image_processing import
 
 def find_window_centroids(warped, window_width, window_height, margin):
@@ -47,9 +59,202 @@ def find_window_centroids(warped, window_width, window_height, margin):
     return window_centroids
 
 def fit_lines(binary_warped,
-	          left_line,
-	          right_line,
-	          frame_number):
+              left_line,
+              right_line,
+              frame_number,
+              max_missed_frames=5,
+              margin=100,
+              distance_weighting=0.,
+              warped_shape=None):
+    """ Find the lane pixels, fit them and update both lines.
+
+        While the lines have a prior fit and have failed the sanity checks
+        on fewer than max_missed_frames consecutive frames, only the pixels
+        within margin of the previous fits are searched. Otherwise the full
+        histogram and sliding-window search runs. Returns which search ran,
+        'look_ahead' or 'sliding_window'.
+
+        With distance_weighting > 0 a pixel at the bottom of the image, next
+        to the vehicle, counts (1 + distance_weighting) times as much in the
+        fit as one at the top.
+
+        warped_shape is the shape of the full-resolution warped image when
+        binary_warped was thresholded at a reduced resolution. The pixel
+        positions are then mapped back to full resolution, so the fits, the
+        margin and the lines all stay in full-resolution pixels; only the
+        sliding-window search runs on the reduced binary, with its margin
+        and minimum pixel count scaled down to match.
+    """
+    # Identify the x and y positions of all nonzero pixels in the image.
+    # nonzero() already returns new arrays, so they are used without a copy
+    nonzeroy, nonzerox = binary_warped.nonzero()
+
+    if warped_shape is None:
+        warped_shape = binary_warped.shape
+    y_scale = binary_warped.shape[0] / float(warped_shape[0])
+    x_scale = binary_warped.shape[1] / float(warped_shape[1])
+    fully = to_full_resolution(nonzeroy,
+                               y_scale)
+    fullx = to_full_resolution(nonzerox,
+                               x_scale)
+
+    if can_look_ahead(left_line, right_line, max_missed_frames):
+        search_path = 'look_ahead'
+        with PROFILER.stage('fit_lines.look_ahead'):
+            left_lane_inds = search_around_fit(fullx,
+                                               fully,
+                                               left_line.best_fit,
+                                               margin)
+            right_lane_inds = search_around_fit(fullx,
+                                                fully,
+                                                right_line.best_fit,
+                                                margin)
+    else:
+        search_path = 'sliding_window'
+        with PROFILER.stage('fit_lines.sliding_window'):
+            left_lane_inds, right_lane_inds = sliding_window_search(binary_warped,
+                                                                    nonzerox,
+                                                                    nonzeroy,
+                                                                    margin * x_scale,
+                                                                    int(round(MINPIX * x_scale * y_scale)))
+    LOGGER.debug("Frame {0}: {1} search".format(frame_number,
+                                                search_path))
+
+    # Extract left and right line pixel positions
+    leftx = fullx[left_lane_inds]
+    lefty = fully[left_lane_inds] 
+    rightx = fullx[right_lane_inds]
+    righty = fully[right_lane_inds] 
+    
+    # Fit a second order polynomial to each through its normal equations,
+    # optionally weighting the pixels closest to the vehicle more
+    height = warped_shape[0]
+    with PROFILER.stage('fit_lines.fit'):
+        left_fit, left_moments = fit_polynomial(leftx,
+                                                lefty,
+                                                height,
+                                                distance_weights(lefty,
+                                                                 height,
+                                                                 distance_weighting))
+        right_fit, right_moments = fit_polynomial(rightx,
+                                                  righty,
+                                                  height,
+                                                  distance_weights(righty,
+                                                                   height,
+                                                                   distance_weighting))
+
+    with PROFILER.stage('line_update'):
+        left_line.update(left_fit,
+                         right_fit,
+                         leftx,
+                         lefty,
+                         warped_shape,
+                         frame_number,
+                         left_moments)
+        right_line.update(right_fit,
+                          left_fit,
+                          rightx,
+                          righty,
+                          warped_shape,
+                          frame_number,
+                          right_moments)
+
+    return search_path
+
+def to_full_resolution(positions,
+                       scale):
+    """ Pixel positions in an image resized by scale, as positions in the
+        original image. Pixel centres map onto pixel centres.
+    """
+    if scale == 1.:
+        return positions
+
+    return (positions + 0.5) / scale - 0.5
+
+def distance_weights(ally,
+                     image_height,
+                     distance_weighting):
+    if distance_weighting == 0.:
+        return None
+
+    return 1. + distance_weighting * ally / (image_height - 1.)
+
+def can_look_ahead(left_line,
+                   right_line,
+                   max_missed_frames):
+    # Both lines need a smoothed fit from a frame that passed the sanity
+    # checks, and neither may have failed too many frames in a row since
+    for line in (left_line, right_line):
+        if len(line.last_n_fits) == 0 or line.missed_frames >= max_missed_frames:
+            return False
+
+    return True
+
+def search_around_fit(nonzerox,
+                      nonzeroy,
+                      line_fit,
+                      margin):
+    # Keep the pixels within +/- margin of the previous polynomial
+    fitx = line_fit[0]*nonzeroy**2 + line_fit[1]*nonzeroy + line_fit[2]
+
+    return ((nonzerox > fitx - margin) & (nonzerox < fitx + margin)).nonzero()[0]
+
+def lane_corridor(image_shape,
+                  dst,
+                  corridor_width,
+                  line_fits=None,
+                  margin=100):
+    """ The bands of columns of a warped image the lines can be found in,
+        as a sorted list of (start, end) ranges.
+
+        With line_fits, the previous fits of the lines, each band covers
+        its line over every row plus the look-ahead search margin, which
+        is all search_around_fit looks at. Otherwise the bands are
+        corridor_width either side of where the perspective transform puts
+        the lane lines, the x positions of the dst points.
+    """
+    height, width = image_shape[:2]
+    ranges = []
+    if line_fits is not None:
+        for fit in line_fits:
+            # A parabola's extremes are at the ends or at its vertex
+            ploty = [0., height-1.]
+            if fit[0] != 0.:
+                vertex = -fit[1] / (2.*fit[0])
+                if 0. < vertex < height-1.:
+                    ploty.append(vertex)
+            ploty = np.array(ploty)
+            fitx = fit[0]*ploty**2 + fit[1]*ploty + fit[2]
+            ranges.append((fitx.min() - margin, fitx.max() + margin))
+    else:
+        for x in np.unique(np.float32(dst)[:, 0]):
+            ranges.append((x - corridor_width, x + corridor_width))
+
+    # Clip to the image and merge overlapping bands
+    corridor = []
+    for start, end in sorted(ranges):
+        start = int(np.clip(np.floor(start), 0, width))
+        end = int(np.clip(np.ceil(end), 0, width))
+        if end <= start:
+            continue
+        if corridor and start <= corridor[-1][1]:
+            corridor[-1] = (corridor[-1][0], max(corridor[-1][1], end))
+        else:
+            corridor.append((start, end))
+
+    return corridor
+
+def sliding_window_search(binary_warped,
+                          nonzerox,
+                          nonzeroy,
+                          margin,
+                          minpix=MINPIX):
+    """ Histogram and sliding-window search for the lane pixels.
+
+        nonzeroy must be sorted, as returned by `binary_warped.nonzero()`,
+        so each window only has to look at the slice of pixels in its own
+        band of rows instead of every nonzero pixel in the image.
+    """
     # Assuming you have created a warped binary image called "binary_warped"
     # Take a histogram of the bottom half of the image
     histogram = np.sum(binary_warped[np.floor(binary_warped.shape[0]/2).astype(np.int):,:], axis=0)
@@ -64,34 +269,33 @@ def fit_lines(binary_warped,
     nwindows = 9
     # Set height of windows
     window_height = np.int(binary_warped.shape[0]/nwindows)
-    # Identify the x and y positions of all nonzero pixels in the image
-    nonzero = binary_warped.nonzero()
-    nonzeroy = np.array(nonzero[0])
-    nonzerox = np.array(nonzero[1])
     # Current positions to be updated for each window
     leftx_current = leftx_base
     rightx_current = rightx_base
-    # Set the width of the windows +/- margin
-    margin = 100
-    # Set minimum number of pixels found to recenter window
-    minpix = 50
     # Create empty lists to receive left and right lane pixel indices
     left_lane_inds = []
     right_lane_inds = []
 
+    # Offsets of every window's band of rows in the sorted pixel arrays
+    window_edges = binary_warped.shape[0] - np.arange(nwindows+1)*window_height
+    band_offsets = np.searchsorted(nonzeroy,
+                                   window_edges)
+
     # Step through the windows one by one
     for window in range(nwindows):
-        # Identify window boundaries in x and y (and right and left)
-        win_y_low = binary_warped.shape[0] - (window+1)*window_height
-        win_y_high = binary_warped.shape[0] - window*window_height
+        # Pixels in this window's band of rows, win_y_low <= y < win_y_high
+        band_start = band_offsets[window+1]
+        band_end = band_offsets[window]
+        band_x = nonzerox[band_start:band_end]
+        # Identify window boundaries in x (right and left)
         win_xleft_low = leftx_current - margin
         win_xleft_high = leftx_current + margin
         win_xright_low = rightx_current - margin
         win_xright_high = rightx_current + margin
         
-        # Identify the nonzero pixels in x and y within the window
-        good_left_inds = (((nonzeroy >= win_y_low) & (nonzeroy < win_y_high) & (nonzerox >= win_xleft_low) & (nonzerox < win_xleft_high)).nonzero()[0]).astype(np.int)
-        good_right_inds = (((nonzeroy >= win_y_low) & (nonzeroy < win_y_high) & (nonzerox >= win_xright_low) & (nonzerox < win_xright_high)).nonzero()[0]).astype(np.int)
+        # Identify the nonzero pixels in x within the window
+        good_left_inds = ((band_x >= win_xleft_low) & (band_x < win_xleft_high)).nonzero()[0] + band_start
+        good_right_inds = ((band_x >= win_xright_low) & (band_x < win_xright_high)).nonzero()[0] + band_start
         # Append these indices to the lists
         left_lane_inds.append(good_left_inds)
         right_lane_inds.append(good_right_inds)
@@ -105,74 +309,91 @@ def fit_lines(binary_warped,
     left_lane_inds = np.concatenate(left_lane_inds)
     right_lane_inds = np.concatenate(right_lane_inds)
 
-    # Extract left and right line pixel positions
-    leftx = nonzerox[left_lane_inds]
-    lefty = nonzeroy[left_lane_inds] 
-    rightx = nonzerox[right_lane_inds]
-    righty = nonzeroy[right_lane_inds] 
-    
-    # Fit a second order polynomial to each
-    try:
-    	left_fit = np.polyfit(lefty, leftx, 2)
-    except TypeError:
-    	left_fit = [np.array(None)]
-    try:
-    	right_fit = np.polyfit(righty, rightx, 2)   
-    except TypeError:
-    	right_fit = [np.array(None)]
-
-
-    left_line.update(left_fit,
-                     right_fit,
-                     leftx,
-                     lefty,
-                     binary_warped.shape,
-                     frame_number)
-    right_line.update(right_fit,
-                      left_fit,
-                      rightx,
-                      righty,
-                      binary_warped.shape,
-                      frame_number)
-
-    return
+    return left_lane_inds, right_lane_inds
+
+def lane_position(left_fit,
+                  right_fit,
+                  M,
+                  warped_shape,
+                  x_m_per_pix):
+    """ Distance in m of the lane centre from the vehicle at the bottom of
+        the warped image, positive with the vehicle left of the centre.
+    """
+    unwarped_center = 0.5 * warped_shape[1], warped_shape[0]
+    warped_center = (M[0][0]*unwarped_center[0] + M[0][1]*unwarped_center[1] + M[0][2]) / \
+                    (M[2][0]*unwarped_center[0] + M[2][1]*unwarped_center[1] + M[2][2])
+
+    y_eval = warped_shape[0] - 1
+    left_x = left_fit[0]*y_eval**2 + left_fit[1]*y_eval + left_fit[2]
+    right_x = right_fit[0]*y_eval**2 + right_fit[1]*y_eval + right_fit[2]
+
+    return (0.5 * (left_x + right_x) - warped_center) * x_m_per_pix
+
+def plot_rows(height):
+    if height not in PLOT_ROWS:
+        PLOT_ROWS[height] = np.linspace(0, height-1, height)
+
+    return PLOT_ROWS[height]
 
 def visualise_lanes(plot_image,
                     binary_warped, 
                     left_line,
                     right_line,
                     Minv,
-                    mtx):
-    # Create an image to draw the lines on
-    warp_zero = np.zeros_like(binary_warped).astype(np.uint8)
-    color_warp = np.dstack((warp_zero, warp_zero, warp_zero))
+                    mtx,
+                    warped_shape=None,
+                    arena=None):
+    # The fits are in full-resolution pixels, even when binary_warped was
+    # thresholded at a reduced resolution
+    if warped_shape is None:
+        warped_shape = binary_warped.shape
 
     left_fit = left_line.best_fit
     right_fit = right_line.best_fit
 
-    ploty = np.linspace(0, binary_warped.shape[0]-1, binary_warped.shape[0] )
+    ploty = plot_rows(warped_shape[0])
     left_fitx = left_fit[0]*ploty**2 + left_fit[1]*ploty + left_fit[2]
     right_fitx = right_fit[0]*ploty**2 + right_fit[1]*ploty + right_fit[2]
 
-    # Recast the x and y points into usable format for cv2.fillPoly()
-    pts_left = np.array([np.transpose(np.vstack([left_fitx, ploty]))])
-    pts_right = np.array([np.flipud(np.transpose(np.vstack([right_fitx, ploty])))])
-    pts = np.hstack((pts_left, pts_right))
-
-    # Draw the lane onto the warped blank image
-    cv2.fillPoly(color_warp, np.int_([pts]), (0,255, 0))
-
-    # Warp the blank back to original image space using inverse perspective matrix (Minv)
-    newwarp = cv2.warpPerspective(color_warp, Minv, (plot_image.shape[1], plot_image.shape[0])) 
-    # Combine the result with the original image
-    result = cv2.addWeighted(plot_image, 1, newwarp, 0.3, 0)
+    # Lane polygon in the warped image, clipped to its width as the fill
+    # of the warped image was, then projected straight into the frame
+    # through Minv instead of warping a whole image of it
+    pts_left = np.column_stack([np.clip(left_fitx, 0, warped_shape[1]-1), ploty])
+    pts_right = np.column_stack([np.clip(right_fitx, 0, warped_shape[1]-1), ploty])[::-1]
+    pts = cv2.perspectiveTransform(np.concatenate([pts_left, pts_right])[np.newaxis],
+                                   Minv)[0]
+    # Fill with sub-pixel vertices, relative to the polygon's bounding box
+    # clipped to the frame
+    x, y, width, height = cv2.boundingRect(np.int32(np.floor(pts)))
+    left, top = max(x, 0), max(y, 0)
+    right, bottom = min(x + width + 1, plot_image.shape[1]), min(y + height + 1, plot_image.shape[0])
 
-    unwarped_center = 0.5 * binary_warped.shape[1], binary_warped.shape[0]
-    warped_center = (mtx[0][0]*unwarped_center[0] + mtx[0][1]*unwarped_center[1] + mtx[0][2]) / \
-                    (mtx[2][0]*unwarped_center[0] + mtx[2][1]*unwarped_center[1] + mtx[2][2])
+    result = get_buffer(arena,
+                        'visualise_lanes.result',
+                        plot_image.shape)
+    np.copyto(result,
+              plot_image)
+    if right > left and bottom > top:
+        lane = get_zeros(arena,
+                         'visualise_lanes.lane',
+                         (bottom - top, right - left, 3))
+        cv2.fillPoly(lane,
+                     [np.int32(np.round((pts - (left, top)) * (1 << OVERLAY_SHIFT)))],
+                     (0, 255, 0),
+                     cv2.LINE_8,
+                     OVERLAY_SHIFT)
+        # Combine the lane with the original image inside the box only
+        result[top:bottom, left:right] = cv2.addWeighted(result[top:bottom, left:right],
+                                                         1,
+                                                         lane,
+                                                         0.3,
+                                                         0)
 
-    position = 0.5 * (left_fitx[-1] + right_fitx[-1]) - warped_center
-    position = position * left_line.x_m_per_pix
+    position = lane_position(left_fit,
+                             right_fit,
+                             mtx,
+                             warped_shape,
+                             left_line.x_m_per_pix)
 
     if position < 0:
     	relative_position = "right"
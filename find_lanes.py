@@ -22,6 +22,9 @@ X_M_PER_PIX = 3.7/700 # meters per pixel in x dimension
 
 # Data directories
 CALIBRATION_DIR = 'camera_cal'
+CALIBRATION_CACHE = 'calibration_cache.npz'
+# Processes used for chessboard corner detection (None for one per CPU)
+CALIBRATION_PROCESSES = None
 TEST_DIR = 'test_images'
 UNDISTORTED_DIR = 'undistorted_images'
 if not os.path.isdir(UNDISTORTED_DIR):
@@ -31,7 +34,9 @@ def main():
     """ Main data processing pipeline
     """
     objpoints, imgpoints, ret, mtx, dist, rvecs, tvecs = calibrate_camera(CALIBRATION_DIR,
-                                                                          (NX, NY))
+                                                                          (NX, NY),
+                                                                          CALIBRATION_CACHE,
+                                                                          CALIBRATION_PROCESSES)
 
     undistort_image_data(TEST_DIR,
                          UNDISTORTED_DIR,
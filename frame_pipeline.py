@@ -0,0 +1,346 @@
+import cv2
+
+import numpy as np
+
+from image_preprocessing import detect_lines, scaled_sobel_kernel
+from buffer_arena import get_buffer
+from profiling import PROFILER
+from detect_lanes import fit_lines, visualise_lanes, can_look_ahead, lane_corridor, lane_position
+from frame_results import frame_result
+
+def detection_shape(warped_shape,
+                    detection_scale):
+    """ Shape of the binary thresholded from a warped image of warped_shape
+        resized by detection_scale.
+    """
+    return (max(int(round(warped_shape[0] * detection_scale)), 1),
+            max(int(round(warped_shape[1] * detection_scale)), 1))
+
+def output_buffer(out,
+                  name,
+                  shape,
+                  arena):
+    if name in out:
+        return out[name]
+
+    return get_buffer(arena,
+                      'preprocess_frame.' + name,
+                      shape)
+
+def preprocess_frame(frame,
+                     birds_eye,
+                     out=None,
+                     column_ranges=None,
+                     detection_scale=1.,
+                     arena=None,
+                     plot=True):
+    """ The stateless stages of the pipeline for one raw BGR frame.
+
+        Undistorts and warps the frame with a BirdsEyeTransform and
+        thresholds the warped image. Returns the undistorted RGB frame to
+        draw on, the warped RGB image, the warped binary and M and Minv.
+        Frames can go through here in any order and in any process.
+
+        out can be a dict with 'plot', 'warped' and 'binary' arrays of the
+        right shapes for the results to be written into, such as the slots
+        of a FrameRing.
+
+        column_ranges restricts the thresholding to those bands of columns
+        of the warped image, see LaneTracker.column_ranges.
+
+        With detection_scale below 1 the warped image is shrunk by that
+        factor before thresholding and the binary returned has the reduced
+        size of detection_shape; the plot and warped images stay at full
+        resolution. The Sobel kernel shrinks with the image, see
+        scaled_sobel_kernel.
+
+        With a BufferArena every image not given in out comes from the
+        arena, and is overwritten when the next frame goes through.
+
+        With plot False nothing will be drawn, so the frame is not
+        undistorted and the plot image returned is None.
+    """
+    if out is None:
+        out = {}
+    height, width = frame.shape[:2]
+
+    # Undistort and warp the raw frame in a single pass, keeping the
+    # undistorted frame to draw the lanes on. The bird's-eye image has the
+    # frame's width and height swapped
+    warped_image, M, Minv, undistorted_image = birds_eye.warp(frame,
+                                                              plot,
+                                                              get_buffer(arena, 'preprocess_frame.warped_bgr', (width, height, 3)),
+                                                              get_buffer(arena, 'preprocess_frame.undistorted_bgr', frame.shape) if plot else None)
+    with PROFILER.stage('colour_conversion'):
+        plot_image = None
+        if plot:
+            plot_image = cv2.cvtColor(undistorted_image,
+                                      cv2.COLOR_BGR2RGB,
+                                      output_buffer(out, 'plot', frame.shape, arena))
+        warped_image = cv2.cvtColor(warped_image,
+                                    cv2.COLOR_BGR2RGB,
+                                    output_buffer(out, 'warped', warped_image.shape, arena))
+    detection_image = warped_image
+    sobel_kernel = scaled_sobel_kernel(detection_scale)
+    if detection_scale != 1.:
+        detection_height, detection_width = detection_shape(warped_image.shape,
+                                                            detection_scale)
+        x_scale = detection_width / float(warped_image.shape[1])
+        with PROFILER.stage('resize'):
+            detection_image = cv2.resize(warped_image,
+                                         (detection_width, detection_height),
+                                         get_buffer(arena, 'preprocess_frame.detection', (detection_height, detection_width, 3)),
+                                         interpolation=cv2.INTER_AREA)
+        if column_ranges is not None:
+            column_ranges = [(int(np.floor(start * x_scale)), int(np.ceil(end * x_scale))) for start, end in column_ranges]
+    with PROFILER.stage('detect_lines'):
+        binary_warped = detect_lines(detection_image,
+                                     column_ranges,
+                                     sobel_kernel,
+                                     out.get('binary'),
+                                     arena)
+
+    return plot_image, warped_image, binary_warped, M, Minv
+
+class LaneTracker():
+    """ The stateful stages of the pipeline.
+
+        Fits the lines, updates the left and right Line and draws the
+        overlay. Frames must be passed in order, since each frame's search
+        and smoothing depend on the frames before it.
+    """
+    def __init__(self,
+                 left_line,
+                 right_line,
+                 max_missed_frames=5,
+                 distance_weighting=0.,
+                 margin=100,
+                 corridor_width=None,
+                 detection_scale=1.,
+                 arena=None):
+        self.left_line = left_line
+        self.right_line = right_line
+        # Passed through to fit_lines
+        self.max_missed_frames = max_missed_frames
+        self.distance_weighting = distance_weighting
+        self.margin = margin
+        # Half width of the column bands around the lane lines that are
+        # thresholded, None to threshold the whole warped image
+        self.corridor_width = corridor_width
+        # Factor the warped image is shrunk by before thresholding; the
+        # fits and lines stay in full-resolution pixels
+        self.detection_scale = detection_scale
+        # BufferArena the per-frame images are drawn from, None to allocate
+        # new ones for every frame
+        self.arena = arena
+        # Number of the next frame
+        self.frame_number = 0
+        # Which search fit_lines ran on the last frame
+        self.search_path = None
+        # Number of frames where either line failed its sanity checks
+        self.failed_frames = 0
+
+    def track(self,
+              binary_warped,
+              warped_shape=None):
+        """ Fit the lines to one binary, thresholded from a warped image
+            of warped_shape, by default the binary's own shape.
+        """
+        with PROFILER.stage('fit_lines'):
+            self.search_path = fit_lines(binary_warped,
+                                         self.left_line,
+                                         self.right_line,
+                                         self.frame_number,
+                                         self.max_missed_frames,
+                                         self.margin,
+                                         self.distance_weighting,
+                                         warped_shape)
+        if not (self.left_line.detected and self.right_line.detected):
+            self.failed_frames += 1
+        self.frame_number += 1
+
+        return self.search_path
+
+    def column_ranges(self,
+                      frame_shape,
+                      birds_eye,
+                      tracking=True):
+        """ The bands of columns of the warped image to threshold for the
+            next raw frame of frame_shape, or None for all of them.
+
+            While the next frame will be searched around the previous fits
+            the bands follow those fits; otherwise, or with tracking False
+            when the frames are not tracked in order, they are the fixed
+            corridor around the dst points of the perspective transform.
+        """
+        if self.corridor_width is None:
+            return None
+
+        # The bird's-eye image has the frame's width and height swapped
+        warped_shape = (frame_shape[1], frame_shape[0])
+        dst = birds_eye.perspective.get_dst(frame_shape[:2])
+        line_fits = None
+        if tracking and can_look_ahead(self.left_line,
+                                       self.right_line,
+                                       self.max_missed_frames):
+            line_fits = (self.left_line.best_fit,
+                         self.right_line.best_fit)
+
+        return lane_corridor(warped_shape,
+                             dst,
+                             self.corridor_width,
+                             line_fits,
+                             self.margin)
+
+    def next_search_path(self):
+        """ The search fit_lines will run on the next frame. """
+        if can_look_ahead(self.left_line,
+                          self.right_line,
+                          self.max_missed_frames):
+            return 'look_ahead'
+
+        return 'sliding_window'
+
+    def position(self,
+                 M,
+                 warped_shape):
+        """ Distance in m of the lane centre between the best fits from the
+            vehicle, see detect_lanes.lane_position, or None until both
+            lines have a fit.
+        """
+        if len(self.left_line.last_n_fits) == 0 or len(self.right_line.last_n_fits) == 0:
+            return None
+
+        return lane_position(self.left_line.best_fit,
+                             self.right_line.best_fit,
+                             M,
+                             warped_shape,
+                             self.left_line.x_m_per_pix)
+
+    def process(self,
+                plot_image,
+                binary_warped,
+                M,
+                Minv):
+        """ Track one preprocessed frame and return the annotated RGB frame.
+
+            With a BufferArena the frame returned is an arena buffer,
+            overwritten by the next frame.
+        """
+        # The bird's-eye image has the frame's width and height swapped
+        warped_shape = (plot_image.shape[1], plot_image.shape[0])
+        self.track(binary_warped,
+                   warped_shape)
+
+        return self.overlay(plot_image,
+                            M,
+                            Minv,
+                            binary_warped)
+
+    def overlay(self,
+                plot_image,
+                M,
+                Minv,
+                binary_warped=None):
+        """ Draw the current best fits on plot_image without tracking, for
+            a frame whose detection was skipped as well as a tracked one.
+            With a BufferArena the frame returned is an arena buffer.
+        """
+        with PROFILER.stage('visualise_lanes'):
+            return visualise_lanes(plot_image,
+                                   binary_warped,
+                                   self.left_line,
+                                   self.right_line,
+                                   Minv,
+                                   M,
+                                   (plot_image.shape[1], plot_image.shape[0]),
+                                   self.arena)
+
+def annotate_frame(frame,
+                   birds_eye,
+                   tracker):
+    """ process_frame without the copy: with a BufferArena the annotated
+        frame is an arena buffer, overwritten by the next frame, so it must
+        be used before then.
+    """
+    plot_image, _, binary_warped, M, Minv = preprocess_frame(frame,
+                                                             birds_eye,
+                                                             column_ranges=tracker.column_ranges(frame.shape,
+                                                                                                 birds_eye),
+                                                             detection_scale=tracker.detection_scale,
+                                                             arena=tracker.arena)
+
+    return tracker.process(plot_image,
+                           binary_warped,
+                           M,
+                           Minv)
+
+def process_frame(frame,
+                  birds_eye,
+                  tracker):
+    """ Run one raw BGR frame through every stage, returning the annotated
+        RGB frame. The frame is the caller's to keep, even when the tracker
+        reuses buffers.
+    """
+    detected_lanes = annotate_frame(frame,
+                                    birds_eye,
+                                    tracker)
+    if tracker.arena is not None:
+        detected_lanes = detected_lanes.copy()
+
+    return detected_lanes
+
+def run_pipeline(frames,
+                 sink,
+                 birds_eye,
+                 tracker):
+    """ Stream BGR frames, in order, through every stage into sink.
+
+        Returns the number of frames written.
+    """
+    frame_count = 0
+    for frame in frames:
+        with PROFILER.stage('process_frame'):
+            # Written to the sink straight away, so no copy is needed
+            detected_lanes = annotate_frame(frame,
+                                            birds_eye,
+                                            tracker)
+        with PROFILER.stage('encode'):
+            sink.write(cv2.cvtColor(detected_lanes,
+                                    cv2.COLOR_RGB2BGR,
+                                    get_buffer(tracker.arena, 'run_pipeline.output', detected_lanes.shape)))
+        PROFILER.end_frame()
+        frame_count += 1
+
+    return frame_count
+
+def run_headless_pipeline(frames,
+                          results,
+                          birds_eye,
+                          tracker):
+    """ Track BGR frames, in order, writing only each frame's results to
+        results, a writer from frame_results. Nothing is undistorted, drawn
+        or encoded.
+
+        Returns the number of frames tracked.
+    """
+    frame_count = 0
+    for frame in frames:
+        with PROFILER.stage('process_frame'):
+            _, _, binary_warped, M, _ = preprocess_frame(frame,
+                                                         birds_eye,
+                                                         column_ranges=tracker.column_ranges(frame.shape,
+                                                                                             birds_eye),
+                                                         detection_scale=tracker.detection_scale,
+                                                         arena=tracker.arena,
+                                                         plot=False)
+            # The bird's-eye image has the frame's width and height swapped
+            warped_shape = (frame.shape[1], frame.shape[0])
+            tracker.track(binary_warped,
+                          warped_shape)
+        results.write(frame_result(tracker,
+                                   tracker.position(M, warped_shape)))
+        PROFILER.end_frame()
+        frame_count += 1
+
+    return frame_count
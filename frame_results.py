@@ -0,0 +1,177 @@
+import csv
+import glob
+import os
+
+import numpy as np
+
+from line import SANITY_CHECKS
+
+RESULT_FIELDS = ['frame',
+                 'search_path',
+                 'left_detected',
+                 'right_detected',
+                 'left_curvature',
+                 'right_curvature',
+                 'left_fit_0', 'left_fit_1', 'left_fit_2',
+                 'right_fit_0', 'right_fit_1', 'right_fit_2',
+                 'position'] + \
+                ['{0}_{1}_check'.format(side, check) for side in ('left', 'right') for check in SANITY_CHECKS]
+
+# Rows an NpzResultsWriter holds before writing them out as a chunk
+RESULTS_CHUNK = 1000
+
+def frame_result(tracker,
+                 position=None):
+    """ The per-frame results of the frame a LaneTracker last tracked.
+
+        position is the lane position in m from LaneTracker.position, if
+        known. The sanity checks are 1 or 0, or None where they were not
+        made.
+    """
+    left_line = tracker.left_line
+    right_line = tracker.right_line
+    result = {'frame': tracker.frame_number - 1,
+              'search_path': tracker.search_path,
+              'left_detected': int(left_line.detected),
+              'right_detected': int(right_line.detected),
+              'left_curvature': left_line.radius_of_curvature,
+              'right_curvature': right_line.radius_of_curvature,
+              'position': None if position is None else repr(float(position))}
+    for side, line in (('left', left_line), ('right', right_line)):
+        for power, coefficient in enumerate(line.best_fit):
+            result['{0}_fit_{1}'.format(side, power)] = repr(float(coefficient))
+        for check, passed in line.checks.items():
+            result['{0}_{1}_check'.format(side, check)] = None if passed is None else int(passed)
+
+    return result
+
+class FrameResultsWriter():
+    """ Writes one CSV row of results per tracked frame. """
+    def __init__(self,
+                 file_name,
+                 header=True):
+        self.file_name = file_name
+        self.file = open(file_name, 'w')
+        self.writer = csv.DictWriter(self.file,
+                                     RESULT_FIELDS)
+        if header:
+            self.writer.writeheader()
+
+    def write(self,
+              result):
+        self.writer.writerow(result)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def concatenate_results(results_files,
+                        output_file):
+    """ Join per-chunk results files, in order, under a single header. """
+    with open(output_file, 'w') as output:
+        for index, results_file in enumerate(results_files):
+            with open(results_file) as results:
+                header = results.readline()
+                if index == 0:
+                    output.write(header)
+                for row in results:
+                    output.write(row)
+
+class NpzResultsWriter():
+    """ Writes the per-frame results as numbered .npz chunks of columns.
+
+        Rows are held until chunk_size have come in, then written to the
+        next chunk next to file_name, results.npz giving results.00000.npz,
+        results.00001.npz and so on, so a run that stops early keeps every
+        full chunk. Each chunk has an array per field: search_path as
+        strings and everything else as floats, with NaN for missing values.
+        load_npz_results joins them back together.
+
+        Like a CSV file, the results of an earlier run under the same name
+        are replaced: its chunks are deleted when the writer is created.
+    """
+    def __init__(self,
+                 file_name,
+                 chunk_size=RESULTS_CHUNK):
+        self.file_name = file_name
+        self.chunk_size = chunk_size
+        self.rows = []
+        self.chunks = 0
+        for chunk_file in npz_chunk_files(file_name):
+            os.remove(chunk_file)
+
+    def write(self,
+              result):
+        self.rows.append(result)
+        if len(self.rows) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        columns = {}
+        for field in RESULT_FIELDS:
+            values = [row.get(field) for row in self.rows]
+            if field == 'search_path':
+                columns[field] = np.array(['' if value is None else value for value in values])
+            else:
+                columns[field] = np.array([np.nan if value is None else float(value) for value in values])
+        chunk_file = npz_chunk_name(self.file_name,
+                                    self.chunks)
+        # Write to a temporary file first so a crash never leaves a
+        # truncated chunk behind
+        temp_file = chunk_file + '.tmp'
+        with open(temp_file, 'wb') as npz_file:
+            np.savez(npz_file,
+                     **columns)
+        os.replace(temp_file,
+                   chunk_file)
+        self.chunks += 1
+        self.rows = []
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def npz_chunk_name(file_name,
+                   index):
+    stem, _ = os.path.splitext(file_name)
+
+    return '{0}.{1:05d}.npz'.format(stem,
+                                    index)
+
+def npz_chunk_files(file_name):
+    """ The chunks written for file_name, in order. """
+    stem, _ = os.path.splitext(file_name)
+
+    return sorted(glob.glob(glob.escape(stem) + '.[0-9][0-9][0-9][0-9][0-9].npz'))
+
+def load_npz_results(file_name):
+    """ The columns of every chunk an NpzResultsWriter wrote, in order. """
+    chunks = []
+    for chunk_file in npz_chunk_files(file_name):
+        with np.load(chunk_file) as chunk:
+            chunks.append(dict((field, chunk[field]) for field in chunk.files))
+    if not chunks:
+        return {}
+
+    return dict((field, np.concatenate([chunk[field] for chunk in chunks])) for field in chunks[0])
+
+def make_results_writer(file_name,
+                        chunk_size=RESULTS_CHUNK):
+    """ A CSV writer for a .csv file name, otherwise .npz chunks. """
+    if os.path.splitext(file_name)[1].lower() == '.csv':
+        return FrameResultsWriter(file_name)
+
+    return NpzResultsWriter(file_name,
+                            chunk_size)
@@ -0,0 +1,190 @@
+import multiprocessing
+import os
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from multiprocessing import shared_memory
+
+import numpy as np
+
+class FrameRing():
+    """ A fixed ring of preallocated frame slots in shared memory.
+
+        Every slot holds one array per entry of `layouts`, a dict of
+        name -> (shape, dtype), e.g. the raw frame, the warped image and the
+        binary mask of the same frame. Processes hand a frame on by passing
+        its slot index through a queue, so the pixels are never pickled.
+
+        Free slots live in a queue: `acquire` blocks when every slot is in
+        use, which is the back-pressure on the producer, and `release`
+        returns a slot once the last stage is done with it, or `discard`
+        one that never carried a frame. Each stage can `mark` a slot, and
+        the time between marks is accumulated per stage when the slot is
+        released.
+
+        The ring can be passed to other processes; they attach to the same
+        shared memory. A slot's counters are only written by the process
+        holding it and the stage totals by the releasing process, so there
+        must be a single releaser.
+    """
+    def __init__(self,
+                 n_slots,
+                 layouts,
+                 stages=('acquired',)):
+        self.n_slots = n_slots
+        self.layouts = [(name, tuple(shape), np.dtype(dtype)) for name, (shape, dtype) in sorted(layouts.items())]
+        self.stages = list(stages)
+
+        self.offsets, self.slot_bytes, self.counter_offset = self.plan_layout()
+        total_bytes = self.counter_offset + self.counter_bytes()
+        self.shared_memory = shared_memory.SharedMemory(create=True,
+                                                        size=total_bytes)
+        # Only the creating process unlinks the shared memory, even when
+        # forked children inherit this object as it is
+        self.owner_pid = os.getpid()
+        self.free_slots = multiprocessing.Queue()
+        for slot in range(n_slots):
+            self.free_slots.put(slot)
+
+        self.attach_counters()
+        self.timestamps[:] = 0.
+        self.slot_hold_time[:] = 0.
+        self.slot_uses[:] = 0
+        self.stage_time[:] = 0.
+        self.back_pressure[:] = 0.
+
+    def plan_layout(self):
+        offsets = {}
+        slot_bytes = 0
+        for name, shape, dtype in self.layouts:
+            # Keep every array 64 byte aligned
+            slot_bytes = 64 * ((slot_bytes + 63) // 64)
+            offsets[name] = slot_bytes
+            slot_bytes += int(np.prod(shape)) * dtype.itemsize
+        slot_bytes = 64 * ((slot_bytes + 63) // 64)
+
+        return offsets, slot_bytes, self.n_slots * slot_bytes
+
+    def counter_bytes(self):
+        # timestamps, hold time, uses, stage time, back-pressure (count, seconds)
+        return 8 * (self.n_slots * len(self.stages) + 2 * self.n_slots + len(self.stages) + 2)
+
+    def attach_counters(self):
+        counters = np.ndarray((self.counter_bytes() // 8,),
+                              dtype=np.float64,
+                              buffer=self.shared_memory.buf,
+                              offset=self.counter_offset)
+        n_stages = len(self.stages)
+        end = self.n_slots * n_stages
+        # Time each slot reached each stage
+        self.timestamps = counters[:end].reshape(self.n_slots, n_stages)
+        # Total seconds each slot was held, and how many frames it carried
+        self.slot_hold_time = counters[end:end+self.n_slots]
+        end += self.n_slots
+        self.slot_uses = counters[end:end+self.n_slots]
+        end += self.n_slots
+        # Total seconds frames spent reaching each stage from the one before,
+        # the last entry being the time from the last stage to release
+        self.stage_time = counters[end:end+n_stages]
+        end += n_stages
+        # Number of acquires that had to wait for a free slot, and for how long
+        self.back_pressure = counters[end:end+2]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ('shared_memory', 'timestamps', 'slot_hold_time', 'slot_uses', 'stage_time', 'back_pressure'):
+            del state[name]
+        state['shared_memory_name'] = self.shared_memory.name
+
+        return state
+
+    def __setstate__(self, state):
+        shared_memory_name = state.pop('shared_memory_name')
+        self.__dict__.update(state)
+        self.shared_memory = shared_memory.SharedMemory(name=shared_memory_name)
+        self.attach_counters()
+
+    def array(self,
+              slot,
+              name):
+        """ The array called name in slot, a view onto the shared memory. """
+        for layout_name, shape, dtype in self.layouts:
+            if layout_name == name:
+                return np.ndarray(shape,
+                                  dtype=dtype,
+                                  buffer=self.shared_memory.buf,
+                                  offset=slot * self.slot_bytes + self.offsets[name])
+
+        raise KeyError("The frame ring has no array called {}".format(name))
+
+    def acquire(self,
+                timeout=None):
+        """ Take a free slot, blocking while the consumers are behind. """
+        try:
+            slot = self.free_slots.get_nowait()
+        except queue.Empty:
+            start = time.time()
+            slot = self.free_slots.get(timeout=timeout)
+            self.back_pressure[0] += 1
+            self.back_pressure[1] += time.time() - start
+
+        self.timestamps[slot, :] = 0.
+        self.timestamps[slot, 0] = time.time()
+
+        return slot
+
+    def mark(self,
+             slot,
+             stage):
+        self.timestamps[slot, self.stages.index(stage)] = time.time()
+
+    def release(self,
+                slot):
+        now = time.time()
+        marks = self.timestamps[slot]
+        # Time from each stage to the next one marked, then to release
+        previous = marks[0]
+        for index in range(1, len(self.stages)):
+            if marks[index] > 0.:
+                self.stage_time[index-1] += marks[index] - previous
+                previous = marks[index]
+        self.stage_time[-1] += now - previous
+        self.slot_hold_time[slot] += now - marks[0]
+        self.slot_uses[slot] += 1
+
+        self.free_slots.put(slot)
+
+    def discard(self,
+                slot):
+        """ Return a slot that never carried a frame, such as the one
+            acquired for the read that hit the end of the video. Nothing is
+            counted, so any process may discard.
+        """
+        self.free_slots.put(slot)
+
+    def stats(self):
+        frames = max(self.slot_uses.sum(), 1)
+        stage_names = ['{0}->{1}'.format(stage, next_stage) for stage, next_stage in zip(self.stages, self.stages[1:] + ['released'])]
+
+        return {'frames': int(self.slot_uses.sum()),
+                'back_pressure_waits': int(self.back_pressure[0]),
+                'back_pressure_seconds': float(self.back_pressure[1]),
+                'mean_stage_latency': dict(zip(stage_names, (self.stage_time / frames).tolist())),
+                'mean_slot_hold_time': [float(hold_time / max(uses, 1)) for hold_time, uses in zip(self.slot_hold_time, self.slot_uses)]}
+
+    def close(self):
+        # Drop the numpy views before closing the shared memory under them
+        for name in ('timestamps', 'slot_hold_time', 'slot_uses', 'stage_time', 'back_pressure'):
+            setattr(self, name, None)
+        try:
+            self.shared_memory.close()
+        except BufferError:
+            # Views handed out by array() are still alive; the mapping goes
+            # when they do, or when the process exits
+            pass
+        if os.getpid() == self.owner_pid:
+            self.shared_memory.unlink()
@@ -1,11 +1,15 @@
 import glob
+import multiprocessing
 import os
+import time
 
 import cv2
 
 import numpy as np
 
 from logger import LOGGER
+from profiling import PROFILER
+from calibration_cache import calibration_key, load_calibration, save_calibration
 
 def undistort_image_data(test_dir,
                          undistorted_dir,
@@ -94,6 +98,89 @@ def undistort_image(image,
     
     return undistorted, error
 
+class Undistorter():
+    """ Removes lens distortion with precomputed remap tables.
+
+        `cv2.undistort` rebuilds the distortion map on every call. Here the
+        map is built once per frame size as fixed-point CV_16SC2 tables and
+        every frame after that is a single `cv2.remap`.
+    """
+    def __init__(self,
+                 matrix,
+                 dist,
+                 cache_file=None):
+        # Camera matrix and distortion coefficients from calibrate_camera
+        self.matrix = np.asarray(matrix, dtype=np.float64)
+        self.dist = np.asarray(dist, dtype=np.float64)
+        # Optional .npz file the remap tables are saved to and loaded from
+        self.cache_file = cache_file
+        # Remap tables keyed by frame size (width, height)
+        self.maps = {}
+
+        if cache_file is not None and os.path.isfile(cache_file):
+            self.load_maps(cache_file)
+
+    def undistort(self,
+                  image,
+                  out=None):
+        map1, map2 = self.get_maps((image.shape[1], image.shape[0]))
+
+        with PROFILER.stage('undistort'):
+            return cv2.remap(image,
+                             map1,
+                             map2,
+                             cv2.INTER_LINEAR,
+                             out)
+
+    def get_maps(self,
+                 frame_size):
+        frame_size = tuple(int(size) for size in frame_size)
+        if frame_size not in self.maps:
+            self.maps[frame_size] = cv2.initUndistortRectifyMap(self.matrix,
+                                                                self.dist,
+                                                                None,
+                                                                self.matrix,
+                                                                frame_size,
+                                                                cv2.CV_16SC2)
+            if self.cache_file is not None:
+                self.save_maps(self.cache_file)
+
+        return self.maps[frame_size]
+
+    def save_maps(self,
+                  file_name):
+        arrays = {'matrix': self.matrix,
+                  'dist': self.dist}
+        for (width, height), (map1, map2) in self.maps.items():
+            arrays['map1_{0}x{1}'.format(width, height)] = map1
+            arrays['map2_{0}x{1}'.format(width, height)] = map2
+
+        np.savez(file_name,
+                 **arrays)
+        LOGGER.info("Undistortion maps saved to {}".format(file_name))
+
+    def load_maps(self,
+                  file_name):
+        """ Load remap tables saved by `save_maps`.
+
+            Tables built for a different camera matrix or distortion are
+            ignored, so a recalibration never reuses stale maps.
+        """
+        with np.load(file_name) as saved:
+            if not np.array_equal(saved['matrix'], self.matrix) or \
+               not np.array_equal(saved['dist'], self.dist):
+                LOGGER.info("Undistortion maps in {} are stale".format(file_name))
+                return
+
+            for name in saved.files:
+                if name.startswith('map1_'):
+                    size = name[len('map1_'):]
+                    width, height = size.split('x')
+                    self.maps[(int(width), int(height))] = (saved[name],
+                                                            saved['map2_' + size])
+
+        LOGGER.info("Loaded undistortion maps from {}".format(file_name))
+
 def check_error(matrix,
                 dist,
                 rvecs,
@@ -117,21 +204,31 @@ def check_error(matrix,
     return mean_error
 
 def calibrate_camera(calibration_dir,
-                     chessboard_dim):
-    # Arrays to store object points and image points from all the images.
-    objpoints = [] # 3d point in real world space
-    imgpoints = [] # 2d points in image plane.
-
+                     chessboard_dim,
+                     cache_file=None,
+                     processes=1):
     calibration_image_path = os.path.join(calibration_dir,
                                           '*.jpg')
-    images = glob.glob(calibration_image_path)
+    # Sort so the calibration (and its cache key) does not depend on the
+    # order the file system lists the images in
+    images = sorted(glob.glob(calibration_image_path))
 
-    for file_name in images:
-        LOGGER.info("Processing {}...".format(file_name))
-        objp, imgp = find_corners(file_name,
-                                  chessboard_dim[0],
-                                  chessboard_dim[1])
+    # Reuse a previous calibration of exactly the same images and board
+    if cache_file is not None:
+        key = calibration_key(images,
+                              chessboard_dim)
+        calibration = load_calibration(cache_file,
+                                       key)
+        if calibration is not None:
+            return calibration
+
+    # Arrays to store object points and image points from all the images.
+    objpoints = [] # 3d point in real world space
+    imgpoints = [] # 2d points in image plane.
 
+    for objp, imgp, _, _ in detect_all_corners(images,
+                                               chessboard_dim,
+                                               processes):
         objpoints.append(objp)
         imgpoints.append(imgp)
 
@@ -144,9 +241,74 @@ def calibrate_camera(calibration_dir,
                                                        None,
                                                        None)
 
+    if cache_file is not None:
+        save_calibration(cache_file,
+                         key,
+                         objpoints,
+                         imgpoints,
+                         ret,
+                         mtx,
+                         dist,
+                         rvecs,
+                         tvecs)
+
     return objpoints, imgpoints, ret, mtx, dist, rvecs, tvecs
     # return None, None, None, None, None, None, None
 
+def detect_all_corners(images,
+                       chessboard_dim,
+                       processes=1):
+    """ Find and refine the chessboard corners in every calibration image.
+
+        With processes > 1 (or None for one per CPU) the images are spread
+        over a process pool. Results are always returned in the same order
+        as `images` as a list of (objp, imgp, board_size, seconds) tuples,
+        where board_size is the (nx, ny) that finally matched.
+    """
+    jobs = [(file_name, chessboard_dim[0], chessboard_dim[1]) for file_name in images]
+
+    start = time.time()
+    if processes == 1:
+        results = [_timed_find_corners(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(_timed_find_corners,
+                               jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+    for file_name, (_, _, board_size, seconds) in zip(images, results):
+        if board_size is None:
+            LOGGER.warning("{0}: no corners found ({1:.3f} s)".format(file_name,
+                                                                      seconds))
+        else:
+            LOGGER.info("{0}: matched {1}x{2} board ({3:.3f} s)".format(file_name,
+                                                                        board_size[0],
+                                                                        board_size[1],
+                                                                        seconds))
+    LOGGER.info("Corner detection on {0} images took {1:.3f} s".format(len(images),
+                                                                       time.time() - start))
+
+    return results
+
+def _timed_find_corners(job):
+    file_name, nx, ny = job
+
+    start = time.time()
+    objp, imgp = find_corners(file_name,
+                              nx,
+                              ny)
+    seconds = time.time() - start
+
+    board_size = None
+    if imgp is not None:
+        # The object points span the board size that finally matched
+        board_size = (int(objp[:, 0].max()) + 1, int(objp[:, 1].max()) + 1)
+
+    return objp, imgp, board_size, seconds
+
 def find_corners(file_name,
                  nx,
                  ny):
@@ -191,28 +353,191 @@ def find_corners(file_name,
 
     return objp, refined_corners
 
-def warp_perspective(image):
-    # Hard coded destination points. Manually found by inspecting image
-    # Test images
-    # src = np.float32([[496,434], [716,434], [300,567], [924,567]])
-    # dst = np.float32([[100,600], [image.shape[0]-100,600], [100,image.shape[1]], [image.shape[0]-100,image.shape[1]]])
-    # Project video
-    # src = np.float32([[493,541], [857,541], [347,665], [1102,665]])
-    # dst = np.float32([[100,900], [image.shape[0]-100,900], [100,image.shape[1]], [image.shape[0]-100,image.shape[1]]])
-#     # Challenge video
-    src = np.float32([[466,584], [909,584], [351,667], [1046,667]])
-    dst = np.float32([[100,1100], [image.shape[0]-100,1100], [100,image.shape[1]], [image.shape[0]-100,image.shape[1]]])
-#     # Harder challenge video
-    # src = np.float32([[480,515], [763,515], [268,664], [956,664]])
-    # dst = np.float32([[100,600], [image.shape[0]-100,600], [100,image.shape[1]], [image.shape[0]-100,image.shape[1]]])
-    
-    M = cv2.getPerspectiveTransform(src,
-                                    dst)
-    Minv = cv2.getPerspectiveTransform(dst,
-                                       src)
-    warped = cv2.warpPerspective(image,
-                                 M,
-                                 image.shape[:2],
-                                 flags=cv2.INTER_LINEAR)
-    
-    return warped, M, Minv
\ No newline at end of file
+# Hard coded source points. Manually found by inspecting each clip. The
+# destination points are the corners of a (image_shape[0] x image_shape[1])
+# bird's-eye image, inset by dst_margin at the sides and starting at dst_top
+PERSPECTIVE_PRESETS = {
+    'test_images': {'src': [[496,434], [716,434], [300,567], [924,567]],
+                    'dst_top': 600},
+    'project': {'src': [[493,541], [857,541], [347,665], [1102,665]],
+                'dst_top': 900},
+    'challenge': {'src': [[466,584], [909,584], [351,667], [1046,667]],
+                  'dst_top': 1100},
+    'harder_challenge': {'src': [[480,515], [763,515], [268,664], [956,664]],
+                         'dst_top': 600},
+}
+
+class PerspectiveTransform():
+    """ Bird's-eye perspective transform with cached matrices.
+
+        `M` and `Minv` only depend on the image shape, so they are computed
+        once per shape and reused for every frame after that.
+    """
+    def __init__(self,
+                 src,
+                 dst=None,
+                 dst_top=0,
+                 dst_margin=100):
+        # Four source points in the camera image:
+        # top left, top right, bottom left, bottom right
+        self.src = np.float32(src)
+        # Fixed destination points, or None to derive them from the shape
+        self.dst = None if dst is None else np.float32(dst)
+        # Top row and side inset of the derived destination points
+        self.dst_top = dst_top
+        self.dst_margin = dst_margin
+        # (M, Minv) keyed by image shape
+        self.matrices = {}
+
+    @classmethod
+    def from_preset(cls,
+                    name):
+        try:
+            preset = PERSPECTIVE_PRESETS[name]
+        except KeyError:
+            raise ValueError("Unknown perspective preset {0}, expected one of {1}".format(name,
+                                                                                           sorted(PERSPECTIVE_PRESETS)))
+
+        return cls(preset['src'],
+                   dst_top=preset['dst_top'])
+
+    def get_dst(self,
+                image_shape):
+        if self.dst is not None:
+            return self.dst
+
+        # warp_perspective passes image.shape[:2] as the output size, so the
+        # warped image is image_shape[0] wide and image_shape[1] high
+        return np.float32([[self.dst_margin, self.dst_top],
+                           [image_shape[0]-self.dst_margin, self.dst_top],
+                           [self.dst_margin, image_shape[1]],
+                           [image_shape[0]-self.dst_margin, image_shape[1]]])
+
+    def get_matrices(self,
+                     image_shape):
+        shape = tuple(image_shape[:2])
+        if shape not in self.matrices:
+            dst = self.get_dst(shape)
+            M = cv2.getPerspectiveTransform(self.src,
+                                            dst)
+            Minv = cv2.getPerspectiveTransform(dst,
+                                               self.src)
+            self.matrices[shape] = (M, Minv)
+
+        return self.matrices[shape]
+
+    def warp(self,
+             image):
+        M, Minv = self.get_matrices(image.shape)
+        warped = cv2.warpPerspective(image,
+                                     M,
+                                     image.shape[:2],
+                                     flags=cv2.INTER_LINEAR)
+
+        return warped, M, Minv
+
+DEFAULT_PERSPECTIVE = PerspectiveTransform.from_preset('challenge')
+
+def warp_perspective(image,
+                     perspective=None):
+    if perspective is None:
+        perspective = DEFAULT_PERSPECTIVE
+
+    return perspective.warp(image)
+
+class BirdsEyeTransform():
+    """ Maps a raw camera frame straight to the bird's-eye view.
+
+        The lens-distortion map and the perspective homography are composed
+        into a single lookup table, so the warped image comes from the raw
+        frame in one `cv2.remap` instead of an undistort followed by a
+        `cv2.warpPerspective`.
+    """
+    def __init__(self,
+                 undistorter,
+                 perspective=None):
+        self.undistorter = undistorter
+        if perspective is None:
+            perspective = DEFAULT_PERSPECTIVE
+        self.perspective = perspective
+        # Fused remap tables and perspective matrices keyed by frame size
+        self.maps = {}
+
+    def warp(self,
+             image,
+             return_undistorted=False,
+             out=None,
+             undistorted_out=None):
+        """ Returns the warped image, M, Minv and, if requested, the
+            undistorted frame (otherwise None) for drawing the overlay on.
+            They are written into out and undistorted_out when given.
+        """
+        map1, map2, M, Minv = self.get_maps((image.shape[1], image.shape[0]))
+
+        with PROFILER.stage('warp_perspective'):
+            warped = cv2.remap(image,
+                               map1,
+                               map2,
+                               cv2.INTER_LINEAR,
+                               out)
+
+        undistorted = None
+        if return_undistorted:
+            undistorted = self.undistorter.undistort(image,
+                                                     undistorted_out)
+
+        return warped, M, Minv, undistorted
+
+    def get_maps(self,
+                 frame_size):
+        frame_size = tuple(int(size) for size in frame_size)
+        if frame_size not in self.maps:
+            self.maps[frame_size] = self.build_maps(frame_size)
+
+        return self.maps[frame_size]
+
+    def build_maps(self,
+                   frame_size):
+        width, height = frame_size
+        # warp_perspective passes image.shape[:2] as the output size, so the
+        # bird's-eye image has the frame's width and height swapped
+        warped_size = (height, width)
+        M, Minv = self.perspective.get_matrices((height, width))
+
+        # Where each bird's-eye pixel lands in the undistorted frame
+        grid_x, grid_y = np.meshgrid(np.arange(warped_size[0], dtype=np.float32),
+                                     np.arange(warped_size[1], dtype=np.float32))
+        grid = np.dstack((grid_x, grid_y))
+        undistorted_points = cv2.perspectiveTransform(grid,
+                                                      Minv)
+
+        # Where each undistorted pixel comes from in the raw frame
+        undistort_x, undistort_y = cv2.initUndistortRectifyMap(self.undistorter.matrix,
+                                                               self.undistorter.dist,
+                                                               None,
+                                                               self.undistorter.matrix,
+                                                               frame_size,
+                                                               cv2.CV_32FC1)
+
+        # Compose the two by sampling the undistortion map at the warped
+        # points. Points outside the frame are sent far outside the raw
+        # image so they come out black, as with cv2.warpPerspective
+        outside = -float(max(frame_size))
+        fused_x = cv2.remap(undistort_x,
+                            undistorted_points[:, :, 0],
+                            undistorted_points[:, :, 1],
+                            cv2.INTER_LINEAR,
+                            borderMode=cv2.BORDER_CONSTANT,
+                            borderValue=outside)
+        fused_y = cv2.remap(undistort_y,
+                            undistorted_points[:, :, 0],
+                            undistorted_points[:, :, 1],
+                            cv2.INTER_LINEAR,
+                            borderMode=cv2.BORDER_CONSTANT,
+                            borderValue=outside)
+
+        map1, map2 = cv2.convertMaps(fused_x,
+                                     fused_y,
+                                     cv2.CV_16SC2)
+
+        return map1, map2, M, Minv
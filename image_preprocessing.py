@@ -2,21 +2,72 @@ import cv2
 
 import numpy as np
 
+from buffer_arena import BufferArena, get_buffer, get_zeros
+from profiling import PROFILER
+
 def apply_colour_mask(image,
                       threshold_low,
-                      threshold_high):
-    binary_image = np.zeros_like(image[:,:,0])
-    
-    binary_image[(image[:, :, 0] >= threshold_low[0]) & (image[:, :, 0] <= threshold_high[0]) & \
-                 (image[:, :, 1] >= threshold_low[1]) & (image[:, :, 1] <= threshold_high[1]) & \
-                 (image[:, :, 2] >= threshold_low[2]) & (image[:, :, 2] <= threshold_high[2])] = 1
+                      threshold_high,
+                      out=None):
+    # cv2.inRange does the six comparisons and the ANDs in one pass, into
+    # out when given since its 0/255 mask is made 0/1 in place
+    in_range = cv2.inRange(image,
+                           tuple(float(value) for value in threshold_low),
+                           tuple(float(value) for value in threshold_high),
+                           out)
+    binary_image = in_range if out is None else out
+    np.not_equal(in_range, 0, out=binary_image)
     
     return binary_image
 
+class ColourThreshold():
+    """ Colour thresholding of uint8 images through per-channel lookup tables.
+
+        Each (low, high) range gets one bit. A 256-entry table per channel
+        has that bit set for the values inside the range, so after
+        `cv2.LUT` a pixel is inside a range when the bit survives ANDing the
+        three channels. A pixel is kept when it is inside any of the ranges,
+        which gives the union of several colour masks in a single pass.
+    """
+    def __init__(self,
+                 ranges):
+        if len(ranges) > 8:
+            raise ValueError("At most 8 colour ranges fit in a uint8 lookup table")
+
+        lut = np.zeros((256, 3), dtype=np.uint8)
+        for bit, (threshold_low, threshold_high) in enumerate(ranges):
+            for channel in range(3):
+                low = max(int(np.ceil(threshold_low[channel])), 0)
+                high = min(int(np.floor(threshold_high[channel])), 255)
+                lut[low:high+1, channel] |= 1 << bit
+        self.lut = lut.reshape(1, 256, 3)
+        # Lookup and output buffers, reused from frame to frame
+        self.arena = BufferArena()
+        self.lookup = None
+        self.combined = None
+        self.binary = None
+
+    def apply(self,
+              image):
+        shape = image.shape[:2]
+        self.lookup = self.arena.get('lookup', image.shape)
+        self.combined = self.arena.get('combined', shape)
+        self.binary = self.arena.get('binary', shape)
+
+        cv2.LUT(image,
+                self.lut,
+                self.lookup)
+        np.bitwise_and(self.lookup[:,:,0], self.lookup[:,:,1], out=self.combined)
+        np.bitwise_and(self.combined, self.lookup[:,:,2], out=self.combined)
+        np.not_equal(self.combined, 0, out=self.binary)
+
+        return self.binary
+
 def abs_sobel_thresh(img,
                      orient='x',
                      sobel_kernel=3,
-                     thresh=(0, 255)):
+                     thresh=(0, 255),
+                     out=None):
     if orient == 'x':
         abs_sobel = np.absolute(cv2.Sobel(img, cv2.CV_64F, 1, 0, ksize=sobel_kernel))
     if orient == 'y':
@@ -24,7 +75,8 @@ def abs_sobel_thresh(img,
     # Rescale back to 8 bit integer
     scaled_sobel = np.uint8(255*abs_sobel/np.max(abs_sobel))
     # Create a copy and apply the threshold
-    binary_output = np.zeros_like(scaled_sobel)
+    binary_output = zeroed_output(scaled_sobel,
+                                  out)
     # Here I'm using inclusive (>=, <=) thresholds, but exclusive is ok too
     binary_output[(scaled_sobel >= thresh[0]) & (scaled_sobel <= thresh[1])] = 1
     
@@ -32,7 +84,8 @@ def abs_sobel_thresh(img,
 
 def mag_threshold(image,
                   sobel_kernel=3,
-                  mag_thresh=(0, 255)):
+                  mag_thresh=(0, 255),
+                  out=None):
     # Take both Sobel x and y gradients
     sobelx = cv2.Sobel(image, cv2.CV_64F, 1, 0, ksize=sobel_kernel)
     sobely = cv2.Sobel(image, cv2.CV_64F, 0, 1, ksize=sobel_kernel)
@@ -42,7 +95,8 @@ def mag_threshold(image,
     scale_factor = np.max(gradmag)/255 
     gradmag = (gradmag/scale_factor).astype(np.uint8) 
     # Create a binary image of ones where threshold is met, zeros otherwise
-    binary_output = np.zeros_like(gradmag)
+    binary_output = zeroed_output(gradmag,
+                                  out)
     binary_output[(gradmag >= mag_thresh[0]) & (gradmag <= mag_thresh[1])] = 1
 
     # Return the binary image
@@ -50,62 +104,316 @@ def mag_threshold(image,
 
 def dir_threshold(image,
                   sobel_kernel=3,
-                  thresh=(0, np.pi/2)):
+                  thresh=(0, np.pi/2),
+                  out=None):
     # Calculate the x and y gradients
     sobelx = cv2.Sobel(image, cv2.CV_64F, 1, 0, ksize=sobel_kernel)
     sobely = cv2.Sobel(image, cv2.CV_64F, 0, 1, ksize=sobel_kernel)
     # Take the absolute value of the gradient direction, 
     # apply a threshold, and create a binary image result
     absgraddir = np.arctan2(np.absolute(sobely), np.absolute(sobelx))
-    binary_output =  np.zeros_like(absgraddir)
+    binary_output = zeroed_output(absgraddir,
+                                  out)
     binary_output[(absgraddir >= thresh[0]) & (absgraddir <= thresh[1])] = 1
 
     # Return the binary image
     return binary_output
 
-def detect_lines(image):
+def zeroed_output(like,
+                  out=None):
+    """ out cleared to zero, or a new zero array like like. """
+    if out is None:
+        return np.zeros_like(like)
+    out.fill(0)
+
+    return out
+
+class SobelGradients():
+    """ Shared Sobel gradients for the absolute, magnitude and direction
+        thresholds.
+
+        Sobel-x and Sobel-y are computed once per channel in float32 and
+        every threshold is derived from those buffers. The intermediate and
+        output masks come from a BufferArena and are reused, so the masks
+        returned are overwritten by the next call to `compute`.
+    """
+    def __init__(self,
+                 sobel_kernel=3):
+        self.sobel_kernel = sobel_kernel
+        self.arena = BufferArena()
+        # Shape the buffers below were taken from the arena for
+        self.shape = None
+        self.sobelx = None
+        self.sobely = None
+        self.abs_sobelx = None
+        self.abs_sobely = None
+        self.magnitude = None
+        # Largest value of each gradient, used to rescale to 8 bit
+        self.max_abs_sobelx = None
+        self.max_abs_sobely = None
+        self.max_magnitude = None
+        # Scratch masks and one output mask per threshold
+        self.low_mask = None
+        self.high_mask = None
+        self.masks = {}
+
+    def allocate(self,
+                 shape):
+        self.shape = shape
+        self.sobelx = self.arena.get('sobelx', shape, np.float32)
+        self.sobely = self.arena.get('sobely', shape, np.float32)
+        self.abs_sobelx = self.arena.get('abs_sobelx', shape, np.float32)
+        self.abs_sobely = self.arena.get('abs_sobely', shape, np.float32)
+        self.magnitude = self.arena.get('magnitude', shape, np.float32)
+        self.low_mask = self.arena.get('low_mask', shape, np.bool_)
+        self.high_mask = self.arena.get('high_mask', shape, np.bool_)
+        self.masks = {}
+
+    def compute(self,
+                channel):
+        if channel.shape != self.shape:
+            self.allocate(channel.shape)
+
+        cv2.Sobel(channel, cv2.CV_32F, 1, 0, dst=self.sobelx, ksize=self.sobel_kernel)
+        cv2.Sobel(channel, cv2.CV_32F, 0, 1, dst=self.sobely, ksize=self.sobel_kernel)
+        np.absolute(self.sobelx, out=self.abs_sobelx)
+        np.absolute(self.sobely, out=self.abs_sobely)
+        self.max_abs_sobelx = self.abs_sobelx.max()
+        self.max_abs_sobely = self.abs_sobely.max()
+        # The magnitude is only needed by magnitude_threshold
+        self.max_magnitude = None
+
+        return self
+
+    def abs_threshold(self,
+                      orient='x',
+                      thresh=(0, 255)):
+        if orient == 'x':
+            return self.scaled_threshold(self.abs_sobelx,
+                                         self.max_abs_sobelx,
+                                         thresh,
+                                         'abs_x')
+        if orient == 'y':
+            return self.scaled_threshold(self.abs_sobely,
+                                         self.max_abs_sobely,
+                                         thresh,
+                                         'abs_y')
+        raise ValueError("orient must be 'x' or 'y', not {}".format(orient))
+
+    def magnitude_threshold(self,
+                            mag_thresh=(0, 255)):
+        if self.max_magnitude is None:
+            cv2.magnitude(self.sobelx,
+                          self.sobely,
+                          self.magnitude)
+            self.max_magnitude = self.magnitude.max()
+
+        return self.scaled_threshold(self.magnitude,
+                                     self.max_magnitude,
+                                     mag_thresh,
+                                     'magnitude')
+
+    def direction_threshold(self,
+                            thresh=(0, np.pi/2)):
+        # Both gradients are non-negative, so the phase is in [0, pi/2]
+        direction = cv2.phase(self.abs_sobelx,
+                              self.abs_sobely)
+
+        return self.in_range(direction,
+                             thresh[0],
+                             thresh[1],
+                             'direction',
+                             upper_inclusive=True)
+
+    def scaled_threshold(self,
+                         values,
+                         max_value,
+                         thresh,
+                         name):
+        # Equivalent to thresholding np.uint8(255*values/max_value) with
+        # inclusive bounds, without building the rescaled image. The
+        # truncation to uint8 means the upper bound becomes thresh[1]+1
+        scale = max_value / 255.
+
+        return self.in_range(values,
+                             thresh[0] * scale,
+                             (thresh[1] + 1) * scale,
+                             name)
+
+    def in_range(self,
+                 values,
+                 low,
+                 high,
+                 name,
+                 upper_inclusive=False):
+        if name not in self.masks:
+            self.masks[name] = self.arena.get('mask_' + name, self.shape)
+        mask = self.masks[name]
+
+        np.greater_equal(values, low, out=self.low_mask)
+        if upper_inclusive:
+            np.less_equal(values, high, out=self.high_mask)
+        else:
+            np.less(values, high, out=self.high_mask)
+        np.logical_and(self.low_mask, self.high_mask, out=mask)
+
+        return mask
+
+# Colour thresholds used by detect_lines
+# Yellow and white lane paint in HSV
+LANE_COLOURS = ColourThreshold([(( 80, 80, 200), (120, 255, 255)),
+                                ((  0,  0, 150), (150,  80, 255))])
+# Saturation in HLS
+SATURATION = ColourThreshold([((  0,  0,  80), (255, 255, 255))])
+
+# Gradient engine shared by every call to detect_lines
+SOBEL_KERNEL = 9
+GRADIENTS = SobelGradients(sobel_kernel=SOBEL_KERNEL)
+# Engines for the smaller kernels used at reduced resolution, by kernel size
+SCALED_GRADIENTS = {}
+
+def scaled_sobel_kernel(scale,
+                        sobel_kernel=SOBEL_KERNEL):
+    """ The Sobel kernel covering about the same part of the road in an
+        image resized by scale: the largest odd size no bigger than
+        sobel_kernel * scale, and at least 3.
+    """
+    kernel = int(np.floor(sobel_kernel * scale))
+    if kernel % 2 == 0:
+        kernel -= 1
+
+    return max(kernel, 3)
+
+def sobel_gradients(sobel_kernel):
+    if sobel_kernel == GRADIENTS.sobel_kernel:
+        return GRADIENTS
+    if sobel_kernel not in SCALED_GRADIENTS:
+        SCALED_GRADIENTS[sobel_kernel] = SobelGradients(sobel_kernel)
+
+    return SCALED_GRADIENTS[sobel_kernel]
+
+def detect_lines(image,
+                 column_ranges=None,
+                 sobel_kernel=SOBEL_KERNEL,
+                 out=None,
+                 arena=None):
     """ Following approach taken in this tutorial 
         https://medium.com/towards-data-science/robust-lane-finding-using-advanced-computer-vision-techniques-mid-project-update-540387e95ed3
+
+        column_ranges can be a list of (start, end) column bands, such as a
+        lane corridor from detect_lanes.lane_corridor, to threshold only
+        those columns; everything outside them is left at zero. The bands
+        are padded by the Sobel kernel radius so the gradients inside them
+        match the full image, but the gradients are rescaled to 8 bit by
+        their largest value inside the bands rather than in the whole image.
+        With no bands at all, as when every band of a corridor falls
+        outside the image, the binary is all zeros.
+
+        A smaller sobel_kernel suits an image thresholded at reduced
+        resolution, see scaled_sobel_kernel.
+
+        The binary is written into out when given. With a BufferArena every
+        intermediate image, and the binary when there is no out, comes from
+        the arena, so nothing is allocated once the buffers exist; the
+        result is then overwritten by the next call with the same arena.
     """
-    hsv_image = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-    yellow_hsv_low  = np.array([ 80, 80, 200])
-    yellow_hsv_high = np.array([ 120, 255, 255])
-    yellow_binary = apply_colour_mask(hsv_image,
-                                      yellow_hsv_low,
-                                      yellow_hsv_high)
-    
-    white_hsv_low  = np.array([  0,   0,   150])
-    white_hsv_high = np.array([ 150,  80, 255])
-    white_binary = apply_colour_mask(hsv_image,
-                                     white_hsv_low,
-                                     white_hsv_high)
-    
-    hls_image = cv2.cvtColor(image, cv2.COLOR_BGR2HLS).astype(np.float)
-    sat_hls_low  = np.array([   0,    0, 80])
-    sat_hls_high = np.array([ 255,  255, 255])
-    sat_binary = apply_colour_mask(hls_image,
-                                   sat_hls_low,
-                                   sat_hls_high)
-    
-    colour_binary = np.zeros_like(white_binary)
-    colour_binary[((yellow_binary == 1) | (white_binary == 1)) & (sat_binary == 1)] = 1
+    gradients = sobel_gradients(sobel_kernel)
+    if column_ranges is None:
+        return threshold_lines(image,
+                               gradients,
+                               out,
+                               arena)
+    if not column_ranges:
+        if out is None:
+            return get_zeros(arena,
+                             'detect_lines.combined',
+                             image.shape[:2])
+        out.fill(0)
+        return out
+
+    # Cut the padded bands out side by side, threshold them in one go and
+    # copy the unpadded columns back
+    pad = sobel_kernel // 2
+    width = image.shape[1]
+    padded_ranges = [(max(start - pad, 0), min(end + pad, width)) for start, end in column_ranges]
+    bands_width = sum(end - start for start, end in padded_ranges)
+    bands = get_buffer(arena,
+                       'detect_lines.bands',
+                       (image.shape[0], bands_width) + image.shape[2:],
+                       image.dtype)
+    with PROFILER.stage('detect_lines.bands'):
+        np.concatenate([image[:, start:end] for start, end in padded_ranges],
+                       axis=1,
+                       out=bands)
+    band_binary = threshold_lines(bands,
+                                  gradients,
+                                  arena=arena)
+
+    with PROFILER.stage('detect_lines.scatter'):
+        if out is None:
+            combined = get_zeros(arena,
+                                 'detect_lines.combined',
+                                 image.shape[:2],
+                                 band_binary.dtype)
+        else:
+            combined = out
+            combined.fill(0)
+        offset = 0
+        for (start, end), (padded_start, padded_end) in zip(column_ranges, padded_ranges):
+            band_start = offset + start - padded_start
+            combined[:, start:end] = band_binary[:, band_start:band_start+end-start]
+            offset += padded_end - padded_start
+
+    return combined
+
+def threshold_lines(image,
+                    gradients=GRADIENTS,
+                    out=None,
+                    arena=None):
+    """ The colour and gradient thresholds of detect_lines on a whole image. """
+    shape = image.shape[:2]
+    with PROFILER.stage('detect_lines.colour'):
+        # Yellow or white in HSV, and saturated in HLS
+        hsv_image = cv2.cvtColor(image,
+                                 cv2.COLOR_BGR2HSV,
+                                 get_buffer(arena, 'threshold_lines.hsv', image.shape))
+        hsv_binary = LANE_COLOURS.apply(hsv_image)
+        hls_image = cv2.cvtColor(image,
+                                 cv2.COLOR_BGR2HLS,
+                                 get_buffer(arena, 'threshold_lines.hls', image.shape))
+        sat_binary = SATURATION.apply(hls_image)
+
+        colour_binary = np.bitwise_and(hsv_binary,
+                                       sat_binary,
+                                       out=get_buffer(arena, 'threshold_lines.colour', shape))
     
-    # Convert to HLS color space and separate the V channel
-    l_channel = hls_image[:,:,1]
-    s_channel = hls_image[:,:,2]
-    # Choose a Sobel kernel size
-    ksize = 3 # Choose a larger odd number to smooth gradient measurements
-
-    # Apply each of the thresholding functions
-    gradx = abs_sobel_thresh(s_channel, orient='x', sobel_kernel=9, thresh=(10, 150))
-    grady = abs_sobel_thresh(s_channel, orient='y', sobel_kernel=9, thresh=(20, 75))
-    mag_binary = mag_threshold(s_channel, sobel_kernel=9, mag_thresh=(15, 100))
-    dir_binary = dir_threshold(s_channel, sobel_kernel=9, thresh=(0.75, 1.5))
+    with PROFILER.stage('detect_lines.gradients'):
+        # Separate the S channel of the HLS image into a contiguous image
+        s_channel = cv2.extractChannel(hls_image,
+                                       2,
+                                       get_buffer(arena, 'threshold_lines.s_channel', shape))
+
+        # Compute the Sobel gradients once and apply each threshold to them
+        gradients = gradients.compute(s_channel)
+        gradx = gradients.abs_threshold(orient='x', thresh=(10, 150))
+        grady = gradients.abs_threshold(orient='y', thresh=(20, 75))
+        mag_binary = gradients.magnitude_threshold(mag_thresh=(15, 100))
     
-    sobel_binary = np.zeros_like(colour_binary)
-    sobel_binary[((gradx == 1) | (grady == 1)) & ((mag_binary == 1))] = 1
+    with PROFILER.stage('detect_lines.combine'):
+        # Every mask is 0 or 1, so the bitwise operators combine them
+        sobel_binary = np.bitwise_or(gradx,
+                                     grady,
+                                     out=get_buffer(arena, 'threshold_lines.sobel', shape))
+        np.bitwise_and(sobel_binary,
+                       mag_binary,
+                       out=sobel_binary)
 
-    combined = np.zeros_like(sobel_binary)
-    combined[(sobel_binary == 1) | (colour_binary == 1)] = 1
+        if out is None:
+            out = get_buffer(arena,
+                             'threshold_lines.combined',
+                             shape)
+        combined = np.bitwise_or(sobel_binary,
+                                 colour_binary,
+                                 out=out)
     
-    return combined
\ No newline at end of file
+    return combined
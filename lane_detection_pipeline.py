@@ -5,16 +5,21 @@ import glob
 
 import cv2
 
-from moviepy.editor import VideoClip
-
 import numpy as np
 import matplotlib.pyplot as plt
 
 from logger import LOGGER, set_up_logger
-from image_correction import calibrate_camera, undistort_image_data, undistort_image, warp_perspective
-from image_preprocessing import detect_lines
-from detect_lanes import fit_lines, visualise_lanes
+from profiling import PROFILER, set_up_profiler
+from image_correction import calibrate_camera, undistort_image_data, Undistorter, BirdsEyeTransform, PerspectiveTransform
+from frame_pipeline import process_frame, run_pipeline, run_headless_pipeline, LaneTracker
+from frame_results import make_results_writer
+from parallel_pipeline import run_parallel_pipeline
+from chunked_pipeline import run_chunked_pipeline
+from live_pipeline import ReplaySource, run_live_pipeline
+from stage_cache import StageCache, run_cached_pipeline
+from video_io import get_video_info, stream_frames, make_sink
 from line import Line
+from buffer_arena import BufferArena
 
 # GLOBALS
 # Chessboard dimensions
@@ -27,36 +32,131 @@ X_M_PER_PIX = 3.7/605. # meters per pixel in x dimension
 
 # Data directories
 CALIBRATION_DIR = 'camera_cal'
+CALIBRATION_CACHE = 'calibration_cache.npz'
+# Processes used for chessboard corner detection (None for one per CPU)
+CALIBRATION_PROCESSES = None
+UNDISTORT_MAPS = 'undistort_maps.npz'
 TEST_DIR = 'test_images'
 UNDISTORTED_DIR = 'undistorted_images'
-if not os.path.isdir(UNDISTORTED_DIR):
-    os.mkdir(UNDISTORTED_DIR)
-
-# CAP = cv2.VideoCapture('project_video.mp4')
-CAP = cv2.VideoCapture('challenge_video.mp4')
-# CAP = cv2.VideoCapture('harder_challenge_video.mp4')
 
-FRAME_NUMBER = 0
+# Perspective preset matching the clip, see image_correction.PERSPECTIVE_PRESETS
+# PERSPECTIVE_PRESET = 'project'
+PERSPECTIVE_PRESET = 'challenge'
+# PERSPECTIVE_PRESET = 'harder_challenge'
+
+# VIDEO_FILE = 'project_video.mp4'
+VIDEO_FILE = 'challenge_video.mp4'
+# VIDEO_FILE = 'harder_challenge_video.mp4'
+
+# OUTPUT_FILE = 'project_animation.mp4'
+OUTPUT_FILE = 'challenge_animation.mp4'
+# OUTPUT_FILE = 'harder_challenge_animation.mp4'
+# Per-frame fits, curvature, position, detections and sanity checks,
+# written in chunked and headless mode. A name not ending in .csv is
+# written as numbered .npz chunks of columns, see frame_results.py
+RESULTS_FILE = 'challenge_results.csv'
+# Only track the lines and write RESULTS_FILE, without drawing or
+# encoding any output video
+HEADLESS = False
+# In headless mode, keep each frame's warped binary in STAGE_CACHE_DIR,
+# up to STAGE_CACHE_SIZE bytes, so runs sweeping the fitting and line
+# settings skip decoding and thresholding. None to not cache. See
+# stage_cache.py
+STAGE_CACHE_DIR = None
+STAGE_CACHE_SIZE = 2 << 30
+# How the output is written, see video_io.make_sink:
+# 'video' (cv2.VideoWriter), 'ffmpeg' (raw pipe to ffmpeg) or 'images'
+SINK = 'video'
+
+# Processes running the undistort, warp and threshold stages in parallel.
+# With 1 everything runs in this process, frame by frame
+WORKERS = 1
+
+# Independent chunks of the video processed in parallel, one process per
+# CPU, each warming up its lines on the CHUNK_OVERLAP frames before it.
+# With 1 the video is processed as a whole
+CHUNKS = 1
+CHUNK_OVERLAP = 50
+
+# Consecutive failed frames before the lane search falls back from the
+# look-ahead search around the previous fits to the sliding-window search
+MAX_MISSED_FRAMES = 5
 
 ALPHA = 0.1
-LEFT_LINE = Line(X_M_PER_PIX,
-                 Y_M_PER_PIX,
-                 ALPHA,
-                 10)
-RIGHT_LINE = Line(X_M_PER_PIX,
-                  Y_M_PER_PIX,
-                  ALPHA,
-                  10)
+# Per-frame decay of the running least-squares fit, None to average the
+# last n fits instead
+FIT_DECAY = None
+# Extra weight of the pixels closest to the vehicle in each fit
+DISTANCE_WEIGHTING = 0.
+# Half width in pixels of the column bands around the lane lines of the
+# warped image that are thresholded, None to threshold every column. While
+# tracking, the bands follow the previous fits instead
+CORRIDOR_WIDTH = None
+# Factor the warped image is shrunk by before thresholding and the lane
+# search, see benchmark_detection_scale.py. The fits, curvature and overlay
+# stay at full resolution
+DETECTION_SCALE = 1.
+# Draw every per-frame image from a BufferArena, so a steady-state run
+# reuses the same memory instead of allocating it for each frame
+REUSE_BUFFERS = True
+# Replay the video at camera rate as a live source, dropping frames that
+# fall behind and reusing the previous fit for frames that would miss the
+# LATENCY_BUDGET in seconds, counted from capture. See live_pipeline.py
+LIVE = False
+LATENCY_BUDGET = 0.1
+# Time every stage and export the p50/p95/p99 per stage to PROFILE_FILE,
+# .json or .csv, at the end of the run and, unless None, every
+# PROFILE_EVERY frames. See profiling.py
+PROFILE = False
+PROFILE_FILE = 'challenge_profile.json'
+PROFILE_EVERY = None
+
+def make_tracker():
+    """ A LaneTracker with a fresh pair of lines, set up from the globals
+    """
+    left_line = Line(X_M_PER_PIX,
+                     Y_M_PER_PIX,
+                     ALPHA,
+                     10,
+                     FIT_DECAY)
+    right_line = Line(X_M_PER_PIX,
+                      Y_M_PER_PIX,
+                      ALPHA,
+                      10,
+                      FIT_DECAY)
+
+    return LaneTracker(left_line,
+                       right_line,
+                       MAX_MISSED_FRAMES,
+                       DISTANCE_WEIGHTING,
+                       corridor_width=CORRIDOR_WIDTH,
+                       detection_scale=DETECTION_SCALE,
+                       arena=BufferArena() if REUSE_BUFFERS else None)
+
+TRACKER = make_tracker()
+LEFT_LINE = TRACKER.left_line
+RIGHT_LINE = TRACKER.right_line
 
 MTX = None
 DIST = None
+UNDISTORTER = None
+BIRDS_EYE = None
 
 def main():
     """ Main data processing pipeline
     """
-    global MTX, DIST
+    global MTX, DIST, UNDISTORTER, BIRDS_EYE
+    if not os.path.isdir(UNDISTORTED_DIR):
+        os.mkdir(UNDISTORTED_DIR)
     objpoints, imgpoints, ret, MTX, DIST, rvecs, tvecs = calibrate_camera(CALIBRATION_DIR,
-                                                                          (NX, NY))
+                                                                          (NX, NY),
+                                                                          CALIBRATION_CACHE,
+                                                                          CALIBRATION_PROCESSES)
+    UNDISTORTER = Undistorter(MTX,
+                              DIST,
+                              UNDISTORT_MAPS)
+    BIRDS_EYE = BirdsEyeTransform(UNDISTORTER,
+                                  PerspectiveTransform.from_preset(PERSPECTIVE_PRESET))
     # undistort_image_data(TEST_DIR,
     #                      UNDISTORTED_DIR,
     #                      objpoints,
@@ -66,44 +166,82 @@ def main():
     #                      rvecs,
     #                      tvecs)
 
-    # animation = VideoClip(make_frame, duration=50)
-    animation = VideoClip(make_frame, duration=16)
-    # animation = VideoClip(make_frame, duration=47)
-    # export as a video file
-    # animation.write_videofile("project_animation.mp4", fps=25)
-    animation.write_videofile("challenge_animation.mp4", fps=25)
-    # animation.write_videofile("harder_challenge_animation.mp4", fps=25)
-
-    CAP.release()
-
-def make_frame(t):
-    global FRAME_NUMBER, LEFT_LINE, RIGHT_LINE
-    if CAP.isOpened():
-        ret, frame = CAP.read()
-
-        undistorted_image, _ = undistort_image(frame,
-                                               MTX,
-                                               DIST)
-        plot_image = cv2.cvtColor(undistorted_image,
-                                  cv2.COLOR_BGR2RGB)
-        warped_image, M, Minv = warp_perspective(plot_image)
-        binary_warped = detect_lines(warped_image)
-
-        fit_lines(binary_warped,
-                  LEFT_LINE,
-                  RIGHT_LINE,
-                  FRAME_NUMBER)
-        
-        detected_lanes = visualise_lanes(plot_image,
-                                         binary_warped, 
-                                         LEFT_LINE,
-                                         RIGHT_LINE,
-                                         Minv,
-                                         M)
-        FRAME_NUMBER += 1
-        
-        return detected_lanes
+    # Frame rate and length come from the container
+    info = get_video_info(VIDEO_FILE)
+    LOGGER.info("{0}: {1} frames at {2:.2f} fps ({3:.1f} s)".format(VIDEO_FILE,
+                                                                   info.frame_count,
+                                                                   info.fps,
+                                                                   info.duration))
+
+    if HEADLESS:
+        with make_results_writer(RESULTS_FILE) as results:
+            if STAGE_CACHE_DIR is not None:
+                run_cached_pipeline(VIDEO_FILE,
+                                    results,
+                                    BIRDS_EYE,
+                                    TRACKER,
+                                    StageCache(STAGE_CACHE_DIR,
+                                               STAGE_CACHE_SIZE))
+            else:
+                run_headless_pipeline(stream_frames(VIDEO_FILE),
+                                      results,
+                                      BIRDS_EYE,
+                                      TRACKER)
+        return
+
+    if LIVE:
+        with make_sink(SINK,
+                       OUTPUT_FILE,
+                       info.fps,
+                       info.frame_size) as sink, \
+             ReplaySource(VIDEO_FILE,
+                          info.fps) as source:
+            run_live_pipeline(source,
+                              sink,
+                              BIRDS_EYE,
+                              TRACKER,
+                              LATENCY_BUDGET)
+        return
+
+    if CHUNKS > 1:
+        run_chunked_pipeline(VIDEO_FILE,
+                             OUTPUT_FILE,
+                             RESULTS_FILE,
+                             BIRDS_EYE,
+                             make_tracker,
+                             SINK,
+                             CHUNKS,
+                             CHUNK_OVERLAP)
+        return
+
+    with make_sink(SINK,
+                   OUTPUT_FILE,
+                   info.fps,
+                   info.frame_size) as sink:
+        if WORKERS > 1:
+            run_parallel_pipeline(VIDEO_FILE,
+                                  sink,
+                                  BIRDS_EYE,
+                                  TRACKER,
+                                  WORKERS)
+        else:
+            run_pipeline(stream_frames(VIDEO_FILE),
+                         sink,
+                         BIRDS_EYE,
+                         TRACKER)
+
+def make_frame(frame):
+    """ Process one raw BGR frame, returning the annotated RGB frame, a new
+        array every call, see frame_pipeline.process_frame
+    """
+    return process_frame(frame,
+                         BIRDS_EYE,
+                         TRACKER)
 
 if __name__ == '__main__':
     set_up_logger()
+    if PROFILE:
+        set_up_profiler(PROFILE_FILE,
+                        PROFILE_EVERY)
     main()
+    PROFILER.finish()
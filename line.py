@@ -1,13 +1,152 @@
 import numpy as np
 import collections
 
+class PolynomialMoments():
+    """ Running weighted least-squares sums for x = A*y**2 + B*y + C.
+
+        Keeps the 3x3 moment matrix and right hand side of the normal
+        equations instead of the pixels, so a batch of pixels is added in
+        one pass and the fit is a 3x3 solve. Older batches can be decayed
+        when merging, which weights the fit towards recent frames without
+        refitting them. y is divided by y_scale before accumulating to keep
+        the powers of y well conditioned.
+    """
+    def __init__(self,
+                 y_scale=1.):
+        self.y_scale = float(y_scale)
+        # Weighted sums of t**k for k = 0..4, with t = y / y_scale
+        self.t_sums = np.zeros(5)
+        # Weighted sums of x*t**k for k = 0..2
+        self.xt_sums = np.zeros(3)
+        # Weighted sum of x**2, for the residual
+        self.xx_sum = 0.
+        # (Decayed) number of pixels accumulated
+        self.count = 0.
+
+    def add(self,
+            x,
+            y,
+            weights=None):
+        x = np.asarray(x, dtype=np.float64)
+        t = np.asarray(y, dtype=np.float64) / self.y_scale
+        if weights is None:
+            weights = np.ones_like(t)
+
+        wt = weights * t
+        wt2 = wt * t
+        self.t_sums += [np.sum(weights),
+                        np.sum(wt),
+                        np.sum(wt2),
+                        np.dot(wt2, t),
+                        np.dot(wt2, t*t)]
+        self.xt_sums += [np.dot(wt2, x),
+                         np.dot(wt, x),
+                         np.dot(weights, x)]
+        self.xx_sum += np.dot(weights * x, x)
+        self.count += len(t)
+
+        return self
+
+    def merge(self,
+              other,
+              decay=1.):
+        """ Decay the sums so far by decay and add the sums from other. """
+        self.t_sums = decay * self.t_sums + other.t_sums
+        self.xt_sums = decay * self.xt_sums + other.xt_sums
+        self.xx_sum = decay * self.xx_sum + other.xx_sum
+        self.count = decay * self.count + other.count
+
+        return self
+
+    def moment_matrix(self):
+        s = self.t_sums
+        return np.array([[s[4], s[3], s[2]],
+                         [s[3], s[2], s[1]],
+                         [s[2], s[1], s[0]]])
+
+    def solve_scaled(self):
+        # Coefficients in terms of t, or None if the system is degenerate
+        if self.count < 3:
+            return None
+        try:
+            scaled_fit = np.linalg.solve(self.moment_matrix(),
+                                         self.xt_sums)
+        except np.linalg.LinAlgError:
+            return None
+        if not np.all(np.isfinite(scaled_fit)):
+            return None
+
+        return scaled_fit
+
+    def solve(self):
+        """ The weighted least-squares fit [A, B, C] in terms of y, or None. """
+        scaled_fit = self.solve_scaled()
+        if scaled_fit is None:
+            return None
+
+        return scaled_fit * self.coefficient_scale()
+
+    def coefficient_scale(self):
+        return np.array([1. / self.y_scale**2, 1. / self.y_scale, 1.])
+
+    def residual(self):
+        """ Weighted RMS distance in x of the pixels from the fit, or None. """
+        scaled_fit = self.solve_scaled()
+        if scaled_fit is None or self.t_sums[0] <= 0.:
+            return None
+
+        squared_error = self.xx_sum \
+                        - 2. * np.dot(scaled_fit, self.xt_sums) \
+                        + np.dot(scaled_fit, np.dot(self.moment_matrix(), scaled_fit))
+
+        return np.sqrt(max(squared_error, 0.) / self.t_sums[0])
+
+    def covariance(self):
+        """ Covariance of the fit coefficients [A, B, C], or None.
+
+            Estimated from the residual and the moment matrix, treating the
+            weights as relative inverse variances of the pixels.
+        """
+        scaled_fit = self.solve_scaled()
+        if scaled_fit is None or self.count <= 3:
+            return None
+
+        # Weighted residual variance with three fitted parameters
+        variance = self.residual()**2 * self.t_sums[0] / (self.count - 3.)
+        try:
+            scaled_covariance = variance * np.linalg.inv(self.moment_matrix())
+        except np.linalg.LinAlgError:
+            return None
+        scale = self.coefficient_scale()
+
+        return scaled_covariance * np.outer(scale, scale)
+
+def fit_polynomial(x,
+                   y,
+                   y_scale=1.,
+                   weights=None):
+    """ Second order fit of x against y through the normal equations.
+
+        Returns the fit and the moments it came from, the fit being None
+        when there are too few pixels to fit.
+    """
+    moments = PolynomialMoments(y_scale).add(x,
+                                             y,
+                                             weights)
+
+    return moments.solve(), moments
+
+# Sanity checks Line.update makes against the other line
+SANITY_CHECKS = ('curvature', 'parallel', 'separation')
+
 # Define a class to receive the characteristics of each line detection
 class Line():
     def __init__(self,
                  x_m_per_pix=1.,
                  y_m_per_pix=1.,
                  alpha=0.5,
-                 n=5):
+                 n=5,
+                 fit_decay=None):
         # X meters per pixel
         self.x_m_per_pix = x_m_per_pix
         # Y meters per pixel
@@ -24,6 +163,8 @@ class Line():
         self.min_separation = 250.
         # was the line detected in the last iteration?
         self.detected = False  
+        # number of consecutive iterations the line has not been detected
+        self.missed_frames = 0
         # x values of the last n fits of the line
         self.recent_xfitted = [] 
         #average x values of the fitted line over the last n iterations
@@ -33,12 +174,27 @@ class Line():
         #polynomial coefficients for the most recent fit
         self.current_fit = [np.array([None])] 
         self.last_n_fits = collections.deque(maxlen=self.n)
+        # PolynomialMoments of the last n fits, None where not given
+        self.last_n_moments = collections.deque(maxlen=self.n)
+        # Per-frame decay of the running fit moments. When set, best_fit is
+        # the weighted least-squares fit of all sane frames' pixels, older
+        # frames decayed by fit_decay per frame of age, instead of the mean
+        # of the last n fits
+        self.fit_decay = fit_decay
+        self.fit_moments = None
+        #covariance of the best_fit coefficients and RMS pixel residual,
+        #from the pixels of the same frames best_fit comes from
+        self.best_fit_covariance = None
+        self.best_fit_residual = None
         #radius of curvature of the line in some units
         self.radius_of_curvature = None 
         #gradient closest to car
         self.gradient = None
         #distance in meters of vehicle center from the line
         self.line_base_pos = None 
+        # Outcome of each of SANITY_CHECKS on the last frame, None where
+        # it could not be made
+        self.checks = dict.fromkeys(SANITY_CHECKS)
         #difference in fit coefficients between last and new fits
         self.diffs = np.array([0,0,0], dtype='float') 
         #x values for detected line pixels
@@ -52,9 +208,19 @@ class Line():
                allx,
                ally,
                image_shape,
-               frame_number):
+               frame_number,
+               moments=None):
+        """ Update the line with a new fit.
+
+            new_fit and other_line are the fit coefficients of this line and
+            the other line for the current frame, or None if they could not
+            be fitted. moments are the PolynomialMoments new_fit came from;
+            they are needed for fit_decay smoothing and the confidence of
+            best_fit.
+        """
         self.allx = allx
         self.ally = ally
+        self.checks = dict.fromkeys(SANITY_CHECKS)
 
         ploty = np.linspace(0, image_shape[0]-1, image_shape[0])
         y_eval = np.max(ploty) # Evaluate line properties closest to vehicle
@@ -64,47 +230,55 @@ class Line():
             new_radius_of_curvature = self.calculate_curvature(y_eval,
                                                                new_fit)
 
-            other_curvature = self.calculate_curvature(y_eval,
-                                                       other_line)
-
             self.gradient = self.calculate_gradient(y_eval,
                                                     new_fit)
-            other_gradient = self.calculate_gradient(y_eval,
-                                                     other_line)
-
             self.line_base_pos = self.get_line_base_pos(y_eval,
                                                         new_fit)
-            other_line_base_pos = self.get_line_base_pos(y_eval,
-                                                         other_line)
 
             # Sanity Checks
-            line_is_sane = True
-            # Check for similar radius
-            if np.abs(new_radius_of_curvature - other_curvature) / new_radius_of_curvature > self.curvature_tolerance:
-                line_is_sane = False
-                # print("Not curvature {0} || {1}".format(self.radius_of_curvature,
-                #                                            other_curvature))
-            # Check if lines are parallel
-            if np.abs(self.gradient - other_gradient) / self.gradient > self.gradient_tolerance or \
-               np.sign(self.gradient) != np.sign(other_gradient):
-                line_is_sane = False
-                # print("Not parallel {0} || {1}".format(self.gradient,
-                #                                            other_gradient))
-            # Check lines are not too far apart
-            if np.abs(self.line_base_pos - other_line_base_pos) > self.max_separation or \
-               np.abs(self.line_base_pos - other_line_base_pos) < self.min_separation:
-                line_is_sane = False
-                # print("Not close {0} || {1}".format(self.line_base_pos,
-                #                                            other_line_base_pos))
-                # print("Sep {0}".format(np.abs(self.line_base_pos - other_line_base_pos)))
-            
-                        
+            # Without a fit for the other line there is nothing to check against
+            line_is_sane = other_line is not None
+            if line_is_sane:
+                other_curvature = self.calculate_curvature(y_eval,
+                                                           other_line)
+                other_gradient = self.calculate_gradient(y_eval,
+                                                         other_line)
+                other_line_base_pos = self.get_line_base_pos(y_eval,
+                                                             other_line)
+                self.checks = dict.fromkeys(SANITY_CHECKS, True)
+
+                # Check for similar radius
+                if np.abs(new_radius_of_curvature - other_curvature) / new_radius_of_curvature > self.curvature_tolerance:
+                    line_is_sane = False
+                    self.checks['curvature'] = False
+                    # print("Not curvature {0} || {1}".format(self.radius_of_curvature,
+                    #                                            other_curvature))
+                # Check if lines are parallel
+                if np.abs(self.gradient - other_gradient) / self.gradient > self.gradient_tolerance or \
+                   np.sign(self.gradient) != np.sign(other_gradient):
+                    line_is_sane = False
+                    self.checks['parallel'] = False
+                    # print("Not parallel {0} || {1}".format(self.gradient,
+                    #                                            other_gradient))
+                # Check lines are not too far apart
+                if np.abs(self.line_base_pos - other_line_base_pos) > self.max_separation or \
+                   np.abs(self.line_base_pos - other_line_base_pos) < self.min_separation:
+                    line_is_sane = False
+                    self.checks['separation'] = False
+                    # print("Not close {0} || {1}".format(self.line_base_pos,
+                    #                                            other_line_base_pos))
+                    # print("Sep {0}".format(np.abs(self.line_base_pos - other_line_base_pos)))
 
             if line_is_sane:
+                # Frames since the last sane one, rejected frames included
+                age = self.missed_frames + 1
                 self.detected = True
+                self.missed_frames = 0
                 # self.best_fit = self.alpha * new_fit + (1.-self.alpha)*self.best_fit
                 self.last_n_fits.append(new_fit)
-                self.best_fit = np.mean(self.last_n_fits, 0)
+                self.last_n_moments.append(moments)
+                self.update_best_fit(moments,
+                                     age)
                 # Only update radius every so many frames
                 if frame_number % 5 == 0:
                     # Used averaged curves to calculate radius
@@ -112,11 +286,50 @@ class Line():
                         self.radius_of_curvature = self.calculate_curvature(y_eval)
                     else:
                         self.radius_of_curvature = self.alpha * self.calculate_curvature(y_eval) + (1.-self.alpha)*self.radius_of_curvature
+            else:
+                self.detected = False
+                self.missed_frames += 1
         else:
             self.detected = False
+            self.missed_frames += 1
 
         return
 
+    def update_best_fit(self,
+                        moments,
+                        age=1):
+        """ Update best_fit and its confidence with a sane frame's moments,
+            age frames after the last sane frame.
+
+            Without fit_decay best_fit is the mean of the last n fits, and
+            its confidence comes from the pooled pixels of those n frames.
+        """
+        if self.fit_decay is None or moments is None:
+            self.best_fit = np.mean(self.last_n_fits, 0)
+            best_moments = None
+            if all(frame_moments is not None for frame_moments in self.last_n_moments):
+                best_moments = PolynomialMoments(self.last_n_moments[0].y_scale)
+                for frame_moments in self.last_n_moments:
+                    best_moments.merge(frame_moments)
+        else:
+            # Decay the older frames by their age and add this frame's sums,
+            # O(1) per frame
+            if self.fit_moments is None:
+                self.fit_moments = PolynomialMoments(moments.y_scale)
+            self.fit_moments.merge(moments,
+                                   self.fit_decay**age)
+            best_fit = self.fit_moments.solve()
+            if best_fit is not None:
+                self.best_fit = best_fit
+            best_moments = self.fit_moments
+
+        if best_moments is None:
+            self.best_fit_covariance = None
+            self.best_fit_residual = None
+        else:
+            self.best_fit_covariance = best_moments.covariance()
+            self.best_fit_residual = best_moments.residual()
+
     def calculate_gradient(self,
                            y_eval,
                            line_fit=None):
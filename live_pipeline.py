@@ -0,0 +1,211 @@
+import threading
+import time
+
+import cv2
+
+import numpy as np
+
+from logger import LOGGER
+from profiling import PROFILER
+from frame_pipeline import preprocess_frame
+from buffer_arena import get_buffer
+from video_io import get_video_info, stream_frames
+
+# Weight of the newest duration in the running estimate of each stage's cost
+COST_SMOOTHING = 0.2
+
+class ReplaySource():
+    """ Replays a video as if it were a live camera.
+
+        A background thread decodes the frames and publishes each one at its
+        due time for the camera rate, stamped with the time it was
+        published. Like a camera with a single-frame buffer, only the newest
+        frame is kept: a consumer that falls behind gets the latest frame
+        and the ones in between are lost.
+    """
+    def __init__(self,
+                 video_file,
+                 fps=None):
+        self.video_file = video_file
+        self.fps = fps if fps is not None else get_video_info(video_file).fps
+        self.condition = threading.Condition()
+        # (index, capture time, frame) of the newest frame
+        self.latest = None
+        self.finished = False
+        self.stopped = False
+        # Index of the last frame handed out, and frames never handed out
+        self.last_read = -1
+        self.missed_frames = 0
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+        return self
+
+    def run(self):
+        start = time.time()
+        try:
+            for index, frame in enumerate(stream_frames(self.video_file)):
+                if self.stopped:
+                    break
+                delay = start + index / self.fps - time.time()
+                if delay > 0.:
+                    time.sleep(delay)
+                with self.condition:
+                    self.latest = (index, time.time(), frame)
+                    self.condition.notify()
+        finally:
+            with self.condition:
+                self.finished = True
+                self.condition.notify()
+
+    def read(self):
+        """ Block for a frame newer than the last one read and return
+            (index, capture time, frame), or None once the video has ended.
+        """
+        with self.condition:
+            while not self.finished and (self.latest is None or self.latest[0] == self.last_read):
+                self.condition.wait()
+            if self.latest is None or self.latest[0] == self.last_read:
+                return None
+            index, capture_time, frame = self.latest
+
+        self.missed_frames += index - self.last_read - 1
+        self.last_read = index
+
+        return index, capture_time, frame
+
+    def stop(self):
+        self.stopped = True
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+def update_cost(costs,
+                stage,
+                seconds):
+    if costs.get(stage) is None:
+        costs[stage] = seconds
+    else:
+        costs[stage] += COST_SMOOTHING * (seconds - costs[stage])
+
+def latency_percentiles(latencies):
+    """ Mean, p50, p95, p99 and largest latency in milliseconds. """
+    if len(latencies) == 0:
+        return {}
+    latencies = 1000. * np.asarray(latencies)
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+
+    return {'mean_ms': float(latencies.mean()),
+            'p50_ms': float(p50),
+            'p95_ms': float(p95),
+            'p99_ms': float(p99),
+            'max_ms': float(latencies.max())}
+
+def run_live_pipeline(source,
+                      sink,
+                      birds_eye,
+                      tracker,
+                      latency_budget):
+    """ Process frames from a live source within a per-frame latency budget.
+
+        Each frame is worked on as soon as it is read, and the source only
+        ever hands out its newest frame, so frames that arrive while one is
+        being processed are dropped rather than queued. A running estimate
+        of each stage's cost decides how much of a frame fits in what is
+        left of its budget, counted from its capture time:
+
+        * a frame already older than the budget is dropped as stale;
+        * if the whole detection would overrun, for example because the
+          next search is the slower sliding window, the frame is only
+          undistorted and the lines' last best_fit is drawn on it;
+        * if the preprocessing ran long, tracking is skipped in the same way.
+
+        Until the lines have a fit every frame is detected in full. The
+        annotated BGR frames are written to sink. Returns a dict of frame
+        counts and end-to-end latency percentiles, capture to written.
+    """
+    # Running cost estimates, in seconds, of preprocessing, each search
+    # path and drawing the overlay
+    costs = {}
+    latencies = []
+    counts = {'frames': 0,
+              'detected': 0,
+              'reused_fit': 0,
+              'stale': 0}
+    while True:
+        item = source.read()
+        if item is None:
+            break
+        index, capture_time, frame = item
+        counts['frames'] += 1
+
+        start = time.time()
+        if start - capture_time > latency_budget:
+            counts['stale'] += 1
+            continue
+
+        search_path = tracker.next_search_path()
+        has_fit = len(tracker.left_line.last_n_fits) > 0 and len(tracker.right_line.last_n_fits) > 0
+        detect = not has_fit or \
+                 start - capture_time + sum(costs.get(stage) or 0. for stage in ('preprocess', search_path, 'overlay')) <= latency_budget
+        if detect:
+            plot_image, _, binary_warped, M, Minv = preprocess_frame(frame,
+                                                                     birds_eye,
+                                                                     column_ranges=tracker.column_ranges(frame.shape,
+                                                                                                         birds_eye),
+                                                                     detection_scale=tracker.detection_scale,
+                                                                     arena=tracker.arena)
+            preprocessed = time.time()
+            update_cost(costs, 'preprocess', preprocessed - start)
+            detect = not has_fit or \
+                     preprocessed - capture_time + sum(costs.get(stage) or 0. for stage in (search_path, 'overlay')) <= latency_budget
+            if detect:
+                tracker.track(binary_warped,
+                              (frame.shape[1], frame.shape[0]))
+                update_cost(costs, search_path, time.time() - preprocessed)
+        else:
+            # Only what the overlay needs: the undistorted frame and the
+            # perspective matrices
+            undistorted = birds_eye.undistorter.undistort(frame,
+                                                          get_buffer(tracker.arena, 'preprocess_frame.undistorted_bgr', frame.shape))
+            plot_image = cv2.cvtColor(undistorted,
+                                      cv2.COLOR_BGR2RGB,
+                                      get_buffer(tracker.arena, 'preprocess_frame.plot', frame.shape))
+            M, Minv = birds_eye.perspective.get_matrices(frame.shape)
+
+        drawing = time.time()
+        detected_lanes = tracker.overlay(plot_image,
+                                         M,
+                                         Minv)
+        update_cost(costs, 'overlay', time.time() - drawing)
+        counts['detected' if detect else 'reused_fit'] += 1
+
+        with PROFILER.stage('encode'):
+            sink.write(cv2.cvtColor(detected_lanes,
+                                    cv2.COLOR_RGB2BGR,
+                                    get_buffer(tracker.arena, 'run_pipeline.output', detected_lanes.shape)))
+        PROFILER.end_frame()
+        latencies.append(time.time() - capture_time)
+
+    counts['missed'] = source.missed_frames
+    stats = dict(counts)
+    stats.update(latency_percentiles(latencies))
+    LOGGER.info("Live: {0} frames read, {1} missed by the source, {2} detected, {3} with the previous fit, {4} stale".format(counts['frames'],
+                                                                                                                          counts['missed'],
+                                                                                                                          counts['detected'],
+                                                                                                                          counts['reused_fit'],
+                                                                                                                          counts['stale']))
+    if latencies:
+        LOGGER.info("Live latency: p50 {0:.1f} ms, p95 {1:.1f} ms, p99 {2:.1f} ms, max {3:.1f} ms".format(stats['p50_ms'],
+                                                                                                          stats['p95_ms'],
+                                                                                                          stats['p99_ms'],
+                                                                                                          stats['max_ms']))
+
+    return stats
@@ -0,0 +1,201 @@
+import multiprocessing
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import cv2
+
+import numpy as np
+
+from logger import LOGGER
+from profiling import PROFILER
+from frame_pipeline import preprocess_frame, detection_shape
+from buffer_arena import BufferArena, get_buffer
+from frame_ring import FrameRing
+from video_io import get_video_info
+
+# Seconds the in-order stage waits for a result before checking on the
+# reader and worker processes
+POLL_INTERVAL = 1.
+# Stages each frame passes through, as marked on its FrameRing slot
+RING_STAGES = ('read', 'preprocessing', 'preprocessed', 'tracking')
+
+def read_frames(video_file,
+                ring,
+                frame_queue,
+                workers):
+    """ Reader process: decode frames straight into free ring slots. """
+    capture = cv2.VideoCapture(video_file)
+    index = 0
+    while capture.isOpened():
+        # Blocks until the in-order stage has released a slot
+        slot = ring.acquire()
+        frame = ring.array(slot, 'frame')
+        ret, decoded = capture.read(frame)
+        if ret and decoded is not frame:
+            # OpenCV only decodes in place when the sizes match
+            frame[:] = decoded
+        if not ret:
+            ring.discard(slot)
+            break
+        frame_queue.put((index, slot))
+        index += 1
+    capture.release()
+
+    # One end marker per worker
+    for _ in range(workers):
+        frame_queue.put(None)
+
+def preprocess_frames(birds_eye,
+                      ring,
+                      frame_queue,
+                      result_queue,
+                      column_ranges=None,
+                      detection_scale=1.,
+                      reuse_buffers=False):
+    """ Worker process: run the stateless stages on frames in any order. """
+    arena = BufferArena() if reuse_buffers else None
+    while True:
+        item = frame_queue.get()
+        if item is None:
+            result_queue.put(None)
+            return
+
+        index, slot = item
+        ring.mark(slot, 'preprocessing')
+        _, _, _, M, Minv = preprocess_frame(ring.array(slot, 'frame'),
+                                            birds_eye,
+                                            out={'plot': ring.array(slot, 'plot'),
+                                                 'warped': ring.array(slot, 'warped'),
+                                                 'binary': ring.array(slot, 'binary')},
+                                            column_ranges=column_ranges,
+                                            detection_scale=detection_scale,
+                                            arena=arena)
+        ring.mark(slot, 'preprocessed')
+        result_queue.put((index, slot, M, Minv))
+
+def frame_layouts(frame_size,
+                  detection_scale=1.):
+    """ FrameRing layouts for frames of frame_size (width, height). """
+    width, height = frame_size
+
+    # The bird's-eye image has the frame's width and height swapped
+    return {'frame': ((height, width, 3), np.uint8),
+            'plot': ((height, width, 3), np.uint8),
+            'warped': ((width, height, 3), np.uint8),
+            'binary': (detection_shape((width, height), detection_scale), np.uint8)}
+
+def run_parallel_pipeline(video_file,
+                          sink,
+                          birds_eye,
+                          tracker,
+                          workers=None,
+                          max_in_flight=None):
+    """ Process a video with a reader process, a pool of preprocessing
+        workers and the stateful LaneTracker stage in this process.
+
+        Frames travel between the processes in the slots of a shared-memory
+        FrameRing; only slot indices go through the queues. The workers
+        undistort, warp and threshold frames in parallel and the results
+        are put back in frame order before tracking and drawing. The ring
+        has max_in_flight slots, which bounds every queue and the
+        reordering buffer. The annotated BGR frames are written to sink.
+        The workers run ahead of the tracking, so with a corridor_width set
+        on the tracker they threshold the fixed corridor around the dst
+        points rather than following the fits. Returns the number of frames
+        written.
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if max_in_flight is None:
+        max_in_flight = 4 * workers
+
+    frame_size = get_video_info(video_file).frame_size
+    ring = FrameRing(max_in_flight,
+                     frame_layouts(frame_size,
+                                   tracker.detection_scale),
+                     RING_STAGES)
+    column_ranges = tracker.column_ranges((frame_size[1], frame_size[0]),
+                                          birds_eye,
+                                          tracking=False)
+    frame_queue = multiprocessing.Queue(max_in_flight + workers)
+    result_queue = multiprocessing.Queue(max_in_flight + workers)
+
+    processes = [multiprocessing.Process(target=read_frames,
+                                         args=(video_file,
+                                               ring,
+                                               frame_queue,
+                                               workers))]
+    for _ in range(workers):
+        processes.append(multiprocessing.Process(target=preprocess_frames,
+                                                 args=(birds_eye,
+                                                       ring,
+                                                       frame_queue,
+                                                       result_queue,
+                                                       column_ranges,
+                                                       tracker.detection_scale,
+                                                       tracker.arena is not None)))
+    for process in processes:
+        process.daemon = True
+        process.start()
+
+    start = time.time()
+    # Slots, M and Minv of results that arrived ahead of the next frame
+    pending = {}
+    next_index = 0
+    finished_workers = 0
+    try:
+        while finished_workers < workers:
+            try:
+                item = result_queue.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                check_processes(processes)
+                continue
+
+            if item is None:
+                finished_workers += 1
+                continue
+
+            pending[item[0]] = item[1:]
+            while next_index in pending:
+                slot, M, Minv = pending.pop(next_index)
+                ring.mark(slot, 'tracking')
+                detected_lanes = tracker.process(ring.array(slot, 'plot'),
+                                                 ring.array(slot, 'binary'),
+                                                 M,
+                                                 Minv)
+                with PROFILER.stage('encode'):
+                    sink.write(cv2.cvtColor(detected_lanes,
+                                            cv2.COLOR_RGB2BGR,
+                                            get_buffer(tracker.arena, 'run_pipeline.output', detected_lanes.shape)))
+                PROFILER.end_frame()
+                ring.release(slot)
+                next_index += 1
+    finally:
+        for process in processes:
+            process.join(POLL_INTERVAL)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        stats = ring.stats()
+        ring.close()
+
+    elapsed = time.time() - start
+    LOGGER.info("Processed {0} frames with {1} workers in {2:.1f} s ({3:.1f} fps)".format(next_index,
+                                                                                         workers,
+                                                                                         elapsed,
+                                                                                         next_index / max(elapsed, 1e-9)))
+    LOGGER.info("Frame ring: {0} waits for a free slot ({1:.3f} s), mean stage latency {2}".format(stats['back_pressure_waits'],
+                                                                                                  stats['back_pressure_seconds'],
+                                                                                                  stats['mean_stage_latency']))
+
+    return next_index
+
+def check_processes(processes):
+    for process in processes:
+        if process.exitcode is not None and process.exitcode != 0:
+            raise RuntimeError("Pipeline process {0} exited with code {1}".format(process.name,
+                                                                                  process.exitcode))
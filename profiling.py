@@ -0,0 +1,218 @@
+import csv
+import json
+import math
+import os
+import time
+
+import numpy as np
+
+from logger import LOGGER
+
+STATS_FIELDS = ['stage', 'count', 'total_ms', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms']
+
+# Durations are counted in log-spaced buckets from HISTOGRAM_MIN to
+# HISTOGRAM_MAX seconds, BUCKETS_PER_DECADE to a factor of ten, so the
+# percentiles are within about 2.5% whatever the length of the run
+HISTOGRAM_MIN = 1e-6
+HISTOGRAM_MAX = 1e3
+BUCKETS_PER_DECADE = 48
+
+class StageHistogram():
+    """ Durations of one stage as counts in fixed log-spaced buckets.
+
+        The first and last buckets also catch everything below and above
+        the range. The count, total and largest duration are exact.
+    """
+    n_buckets = int(round(BUCKETS_PER_DECADE * np.log10(HISTOGRAM_MAX / HISTOGRAM_MIN)))
+    # Upper edge of every bucket in seconds
+    edges = HISTOGRAM_MIN * 10.**(np.arange(1, n_buckets + 1) / float(BUCKETS_PER_DECADE))
+
+    def __init__(self):
+        self.counts = [0] * self.n_buckets
+        self.count = 0
+        self.total = 0.
+        self.min = float('inf')
+        self.max = 0.
+
+    def add(self,
+            seconds):
+        bucket = int(math.log10(max(seconds, HISTOGRAM_MIN) / HISTOGRAM_MIN) * BUCKETS_PER_DECADE)
+        self.counts[min(bucket, self.n_buckets - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        self.min = min(self.min, seconds)
+        self.max = max(self.max, seconds)
+
+    def percentiles(self,
+                    percents):
+        """ Durations in seconds at percents, each the geometric centre of
+            the bucket the percentile falls in, clipped to the smallest and
+            largest duration.
+        """
+        cumulative = np.cumsum(self.counts)
+        ranks = np.maximum(np.ceil(np.asarray(percents) / 100. * self.count), 1)
+        buckets = np.searchsorted(cumulative, ranks)
+        centres = self.edges[buckets] * 10.**(-0.5 / BUCKETS_PER_DECADE)
+
+        return np.clip(centres, self.min, self.max)
+
+class NullStage():
+    """ Stands in for a StageTimer while profiling is off. """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+NULL_STAGE = NullStage()
+
+class StageTimer():
+    def __init__(self,
+                 profiler,
+                 name):
+        self.profiler = profiler
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.profiler.record(self.name,
+                             time.perf_counter() - self.start)
+        return False
+
+class Profiler():
+    """ Wall-clock time of each stage of the pipeline, frame after frame.
+
+        Stages are timed with `with PROFILER.stage('name'):` around the
+        code, and a stage inside another is recorded separately as well as
+        counted in the outer one. The percentiles come from a histogram per
+        stage, so memory and the cost of an export stay the same however
+        long the run. While disabled, `stage` hands back a shared no-op
+        context and nothing is recorded.
+
+        Only the process the profiler was set up in is timed; the workers
+        of the parallel and chunked pipelines have their own, disabled,
+        profiler.
+    """
+    def __init__(self):
+        self.enabled = False
+        # StageHistogram per stage, in the order the stages first ran
+        self.histograms = {}
+        self.stage_order = []
+        self.frames = 0
+        # Where to export the statistics, .json or .csv, and how many
+        # frames apart, None to only export at the end of the run
+        self.output_file = None
+        self.export_every = None
+
+    def stage(self,
+              name):
+        if not self.enabled:
+            return NULL_STAGE
+
+        return StageTimer(self,
+                          name)
+
+    def record(self,
+               name,
+               seconds):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = StageHistogram()
+            self.histograms[name] = histogram
+            self.stage_order.append(name)
+        histogram.add(seconds)
+
+    def end_frame(self):
+        """ Mark the end of a frame, exporting the statistics so far every
+            export_every frames.
+        """
+        if not self.enabled:
+            return
+        self.frames += 1
+        if self.export_every is not None and self.output_file is not None and \
+           self.frames % self.export_every == 0:
+            self.export()
+
+    def reset(self):
+        self.histograms = {}
+        self.stage_order = []
+        self.frames = 0
+
+    def stats(self):
+        """ Per stage, in the order the stages first ran: the number of
+            times it ran and its total, mean, p50, p95, p99 and largest
+            duration in milliseconds, the percentiles from the histograms.
+        """
+        stats = []
+        for name in self.stage_order:
+            histogram = self.histograms[name]
+            p50, p95, p99 = 1000. * histogram.percentiles([50, 95, 99])
+            stats.append({'stage': name,
+                          'count': histogram.count,
+                          'total_ms': 1000. * histogram.total,
+                          'mean_ms': 1000. * histogram.total / histogram.count,
+                          'p50_ms': float(p50),
+                          'p95_ms': float(p95),
+                          'p99_ms': float(p99),
+                          'max_ms': 1000. * histogram.max})
+
+        return stats
+
+    def export(self,
+               file_name=None):
+        """ Write the statistics to file_name, by default output_file, as
+            JSON or, for a .csv name, one row per stage. The file is
+            replaced atomically, so it can be read while a run is going.
+        """
+        if file_name is None:
+            file_name = self.output_file
+        stats = self.stats()
+
+        temp_name = file_name + '.tmp'
+        if os.path.splitext(file_name)[1].lower() == '.csv':
+            with open(temp_name, 'w') as csv_file:
+                writer = csv.DictWriter(csv_file,
+                                        STATS_FIELDS)
+                writer.writeheader()
+                writer.writerows(stats)
+        else:
+            with open(temp_name, 'w') as json_file:
+                json.dump({'frames': self.frames,
+                           'stages': stats},
+                          json_file,
+                          indent=2)
+        os.replace(temp_name,
+                   file_name)
+
+    def log_stats(self):
+        for stats in self.stats():
+            LOGGER.info("{0:<24} {1:>7} x  p50 {2:7.2f} ms  p95 {3:7.2f} ms  p99 {4:7.2f} ms".format(stats['stage'],
+                                                                                                  stats['count'],
+                                                                                                  stats['p50_ms'],
+                                                                                                  stats['p95_ms'],
+                                                                                                  stats['p99_ms']))
+
+    def finish(self):
+        """ Log and export the statistics of the run, if profiling. """
+        if not self.enabled or self.frames == 0:
+            return
+        self.log_stats()
+        if self.output_file is not None:
+            self.export()
+            LOGGER.info("Stage timings written to {}".format(self.output_file))
+
+PROFILER = Profiler()
+
+def set_up_profiler(output_file=None,
+                    export_every=None):
+    """ Turn on the stage timings of PROFILER, exported to output_file at
+        the end of the run and, if given, every export_every frames.
+    """
+    PROFILER.reset()
+    PROFILER.output_file = output_file
+    PROFILER.export_every = export_every
+    PROFILER.enabled = True
@@ -0,0 +1,314 @@
+import collections
+import hashlib
+import itertools
+import json
+import os
+
+import cv2
+
+import numpy as np
+
+from logger import LOGGER
+from image_preprocessing import LANE_COLOURS, SATURATION, scaled_sobel_kernel
+from frame_pipeline import preprocess_frame
+from frame_results import frame_result
+from profiling import PROFILER
+from video_io import get_video_info
+
+# Bump this whenever detect_lines or the warp change what they produce for
+# the same parameters, which the keys cannot see
+CACHE_VERSION = 1
+# Where a StageCache remembers the source_key of each video it has seen
+SOURCE_KEYS_FILE = 'source_keys.json'
+
+def source_key(video_file,
+               block_size=1 << 20):
+    """ Hash of a video's contents, so a cache entry follows the footage
+        rather than its file name. This reads the whole video; see
+        StageCache.source_key to only do so once per version of the file.
+    """
+    key = hashlib.sha1()
+    with open(video_file, 'rb') as video:
+        for block in iter(lambda: video.read(block_size), b''):
+            key.update(block)
+
+    return key.hexdigest()
+
+def preprocess_key(birds_eye,
+                   frame_size,
+                   detection_scale=1.):
+    """ Hash of everything preprocess_frame's binary depends on besides
+        the frame itself and the column ranges: the calibration, the
+        perspective, the detection scale and the colour thresholds.
+    """
+    perspective = birds_eye.perspective
+    key = hashlib.sha1()
+    key.update('v{0}:{1}x{2}:{3!r}:{4}:{5!r}:{6!r}'.format(CACHE_VERSION,
+                                                           frame_size[0],
+                                                           frame_size[1],
+                                                           float(detection_scale),
+                                                           scaled_sobel_kernel(detection_scale),
+                                                           float(perspective.dst_top),
+                                                           float(perspective.dst_margin)).encode('utf-8'))
+    for array in (birds_eye.undistorter.matrix,
+                  birds_eye.undistorter.dist,
+                  perspective.src,
+                  perspective.dst if perspective.dst is not None else np.zeros(0),
+                  LANE_COLOURS.lut,
+                  SATURATION.lut):
+        key.update(np.ascontiguousarray(array).tobytes())
+
+    return key.hexdigest()
+
+def frame_key(source,
+              parameters,
+              frame_index,
+              column_ranges=None):
+    """ Key of one frame's binary. The column ranges are part of it, since
+        the corridor width changes the binary.
+    """
+    ranges = None if column_ranges is None else [(int(start), int(end)) for start, end in column_ranges]
+
+    return hashlib.sha1('{0}:{1}:{2}:{3!r}'.format(source,
+                                                   parameters,
+                                                   frame_index,
+                                                   ranges).encode('utf-8')).hexdigest()
+
+class StageCache():
+    """ Thresholded warped binaries on disk, bit-packed and compressed.
+
+        Entries live under directory in one .npz file per key. Reading an
+        entry marks it as most recently used, and once the files add up to
+        more than max_bytes the least recently used are deleted. The order
+        is kept in the files' modification times, so it carries over from
+        run to run.
+    """
+    def __init__(self,
+                 directory,
+                 max_bytes=2 << 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # Entry size in bytes by key, least recently used first
+        self.entries = collections.OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        existing = []
+        for entry in os.scandir(directory):
+            # Skipping any temporary file an interrupted put left behind
+            if entry.name.endswith('.npz') and not entry.name.endswith('.tmp.npz') and entry.is_file():
+                stat = entry.stat()
+                existing.append((stat.st_mtime, entry.name[:-len('.npz')], stat.st_size))
+        for _, key, size in sorted(existing):
+            self.entries[key] = size
+            self.total_bytes += size
+        self.evict()
+
+    def source_key(self,
+                   video_file):
+        """ source_key of video_file, hashed again only when its path, size
+            or modification time differ from the last time.
+        """
+        keys_file = os.path.join(self.directory,
+                                 SOURCE_KEYS_FILE)
+        known_keys = {}
+        if os.path.isfile(keys_file):
+            try:
+                with open(keys_file) as json_file:
+                    known_keys = json.load(json_file)
+            except (IOError, ValueError) as error:
+                LOGGER.warning("Could not read {0}: {1}".format(keys_file,
+                                                                error))
+
+        path = os.path.abspath(video_file)
+        stat = os.stat(path)
+        known = known_keys.get(path)
+        if known is not None and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+            return known['key']
+
+        key = source_key(video_file)
+        known_keys[path] = {'size': stat.st_size,
+                            'mtime_ns': stat.st_mtime_ns,
+                            'key': key}
+        temp_file = keys_file + '.tmp'
+        with open(temp_file, 'w') as json_file:
+            json.dump(known_keys,
+                      json_file,
+                      indent=2)
+        os.replace(temp_file,
+                   keys_file)
+
+        return key
+
+    def path(self,
+             key):
+        return os.path.join(self.directory,
+                            key + '.npz')
+
+    def get(self,
+            key):
+        """ The binary stored under key, or None. """
+        if key not in self.entries:
+            self.misses += 1
+            return None
+
+        path = self.path(key)
+        try:
+            with np.load(path) as entry:
+                shape = tuple(entry['shape'])
+                bits = entry['bits']
+        except (IOError, KeyError, ValueError) as error:
+            LOGGER.warning("Could not read stage cache entry {0}: {1}".format(path,
+                                                                              error))
+            self.remove(key)
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        os.utime(path, None)
+        self.hits += 1
+
+        return np.unpackbits(bits, count=int(np.prod(shape))).reshape(shape)
+
+    def put(self,
+            key,
+            binary):
+        path = self.path(key)
+        # Write to a temporary file first so an interrupted run never leaves
+        # a truncated entry behind
+        temp_file = path + '.tmp.npz'
+        np.savez_compressed(temp_file,
+                            shape=np.array(binary.shape),
+                            bits=np.packbits(binary != 0))
+        os.replace(temp_file,
+                   path)
+
+        if key in self.entries:
+            self.total_bytes -= self.entries.pop(key)
+        size = os.path.getsize(path)
+        self.entries[key] = size
+        self.total_bytes += size
+        self.evict()
+
+    def remove(self,
+               key):
+        self.total_bytes -= self.entries.pop(key)
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def evict(self):
+        """ Delete the least recently used entries until under max_bytes. """
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            self.remove(next(iter(self.entries)))
+
+class FrameReader():
+    """ Decodes the frames of a video by index, seeking only when the
+        requested frame is not the next one, and opening the video only
+        once a frame is actually needed.
+    """
+    def __init__(self,
+                 video_file):
+        self.video_file = video_file
+        self.capture = None
+        self.position = None
+
+    def read(self,
+             index):
+        if self.capture is None:
+            self.capture = cv2.VideoCapture(self.video_file)
+            if not self.capture.isOpened():
+                raise IOError("Could not open {}".format(self.video_file))
+            self.position = 0
+        if index != self.position:
+            self.capture.set(cv2.CAP_PROP_POS_FRAMES, index)
+        ret, frame = self.capture.read()
+        self.position = index + 1
+
+        return frame if ret else None
+
+    def close(self):
+        if self.capture is not None:
+            self.capture.release()
+            self.capture = None
+
+def run_cached_pipeline(video_file,
+                        results,
+                        birds_eye,
+                        tracker,
+                        cache):
+    """ run_headless_pipeline over a video, with each frame's binary taken
+        from a StageCache when it is there.
+
+        Frames are only decoded, undistorted, warped and thresholded on a
+        cache miss, and the binary is then added to the cache, so a second
+        run that changes only the fitting or the lines' settings replays
+        from the cache. Like run_headless_pipeline, it runs to the end of
+        the video rather than to the frame count in its container, which
+        is only an estimate. Returns the number of frames tracked.
+
+        With a corridor_width the tracker's bands would follow its own fits,
+        so any change to the fitting would change every frame's binary and
+        miss the cache. The binaries are instead thresholded in the fixed
+        corridor around the dst points, as with tracking off, which can
+        give slightly different fits from an uncached run.
+    """
+    info = get_video_info(video_file)
+    width, height = info.frame_size
+    frame_shape = (height, width, 3)
+    # The bird's-eye image has the frame's width and height swapped
+    warped_shape = (width, height)
+    M, _ = birds_eye.perspective.get_matrices(frame_shape)
+    source = cache.source_key(video_file)
+    parameters = preprocess_key(birds_eye,
+                                info.frame_size,
+                                tracker.detection_scale)
+    # The same for every frame, see above
+    column_ranges = tracker.column_ranges(frame_shape,
+                                          birds_eye,
+                                          tracking=False)
+
+    reader = FrameReader(video_file)
+    frame_count = 0
+    try:
+        # Frames past the end are never cached, so the first miss there
+        # reads the end of the video
+        for index in itertools.count():
+            with PROFILER.stage('process_frame'):
+                key = frame_key(source,
+                                parameters,
+                                index,
+                                column_ranges)
+                with PROFILER.stage('stage_cache'):
+                    binary_warped = cache.get(key)
+                if binary_warped is None:
+                    frame = reader.read(index)
+                    if frame is None:
+                        break
+                    _, _, binary_warped, _, _ = preprocess_frame(frame,
+                                                                 birds_eye,
+                                                                 column_ranges=column_ranges,
+                                                                 detection_scale=tracker.detection_scale,
+                                                                 arena=tracker.arena,
+                                                                 plot=False)
+                    cache.put(key,
+                              binary_warped)
+                tracker.track(binary_warped,
+                              warped_shape)
+            results.write(frame_result(tracker,
+                                       tracker.position(M, warped_shape)))
+            PROFILER.end_frame()
+            frame_count += 1
+    finally:
+        reader.close()
+
+    LOGGER.info("Stage cache: {0} hits, {1} misses, {2:.1f} MB in {3} entries".format(cache.hits,
+                                                                                      cache.misses,
+                                                                                      cache.total_bytes / 1024. / 1024.,
+                                                                                      len(cache.entries)))
+
+    return frame_count
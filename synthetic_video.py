@@ -0,0 +1,525 @@
+from __future__ import print_function
+
+import argparse
+import csv
+
+import cv2
+
+import numpy as np
+
+from logger import LOGGER, set_up_logger
+from image_correction import Undistorter, BirdsEyeTransform, PerspectiveTransform, PERSPECTIVE_PRESETS
+from frame_pipeline import process_frame
+from line import Line
+from video_io import make_sink
+import lane_detection_pipeline as pipeline
+
+# Frame size the perspective presets and the pipeline's meters per pixel
+# were set up for
+REFERENCE_SIZE = (1280, 720)
+
+# Road geometry in meters
+LANE_WIDTH = 3.7
+LINE_WIDTH = 0.15
+DASH_LENGTH = 3.
+DASH_GAP = 9.
+SHOULDER = 1.5
+# Length of road each set of distractors is drawn for
+TILE_LENGTH = 20.
+
+# BGR colours
+ASPHALT = (110, 100, 88)
+GRASS = (60, 105, 70)
+SKY = (225, 195, 160)
+WHITE_PAINT = (235, 235, 235)
+YELLOW_PAINT = (0, 200, 235)
+
+# curvature is the radius in m, inf on frames where the road is straight
+GROUND_TRUTH_FIELDS = ['frame',
+                       'curvature',
+                       'offset',
+                       'left_fit_0', 'left_fit_1', 'left_fit_2',
+                       'right_fit_0', 'right_fit_1', 'right_fit_2']
+
+def scaled_perspective(preset,
+                       frame_size):
+    """ A perspective preset, set up for REFERENCE_SIZE frames, scaled to
+        frames of frame_size.
+    """
+    x_scale = frame_size[0] / float(REFERENCE_SIZE[0])
+    y_scale = frame_size[1] / float(REFERENCE_SIZE[1])
+    preset = PERSPECTIVE_PRESETS[preset]
+
+    # The bird's-eye image has the frame's width and height swapped
+    return PerspectiveTransform(np.float32(preset['src']) * np.float32([x_scale, y_scale]),
+                                dst_top=preset['dst_top'] * x_scale,
+                                dst_margin=100 * y_scale)
+
+def ideal_camera(frame_size):
+    """ Camera matrix and distortion coefficients of a camera without lens
+        distortion, so an Undistorter leaves the frames as they are.
+    """
+    width, height = frame_size
+    mtx = np.array([[width, 0., 0.5 * (width - 1)],
+                    [0., width, 0.5 * (height - 1)],
+                    [0., 0., 1.]])
+
+    return mtx, np.zeros(5)
+
+def strip_polygon(line_x,
+                  y_values,
+                  half_width):
+    """ The outline of a band half_width either side of the x values along
+        y_values, as a polygon for cv2.fillPoly.
+    """
+    return np.int32(np.round(np.concatenate([np.column_stack([line_x - half_width, y_values]),
+                                             np.column_stack([line_x + half_width, y_values])[::-1]])))
+
+class SyntheticRoad():
+    """ Renders a deterministic video of a road with known lane lines.
+
+        The road is drawn in the bird's-eye view of a scaled perspective
+        preset and projected into the camera, so in the pipeline's warped
+        image the lines are exactly the polynomials of ground_truth. The
+        vehicle drives at speed along a road whose curvature and lateral
+        offset vary sinusoidally; the left line is solid yellow, the right
+        dashed white. Distractors (shadows, cracks and stray paint) are
+        fixed to the road and scroll past with it. Frames are BGR, as from
+        a video file, and are the same for the same settings and seed, in
+        any order.
+
+        The frames have no lens distortion: process them with the
+        BirdsEyeTransform from birds_eye, and Lines using x_m_per_pix and
+        y_m_per_pix, as make_tracker sets up.
+    """
+    def __init__(self,
+                 frame_size=REFERENCE_SIZE,
+                 frame_count=250,
+                 fps=25.,
+                 seed=0,
+                 noise=2.,
+                 distractors=True,
+                 preset='test_images',
+                 speed=25.,
+                 max_curvature=1./600,
+                 curve_period=12.,
+                 max_offset=0.3,
+                 offset_period=7.):
+        self.frame_size = tuple(int(size) for size in frame_size)
+        self.frame_count = frame_count
+        self.fps = float(fps)
+        self.seed = seed
+        # Standard deviation of the per-pixel sensor noise
+        self.noise = noise
+        self.distractors = distractors
+        # Speed in m/s, largest curvature in 1/m and largest offset of the
+        # vehicle from the lane centre in m, and their periods in seconds
+        self.speed = speed
+        self.max_curvature = max_curvature
+        self.curve_period = curve_period
+        self.max_offset = max_offset
+        self.offset_period = offset_period
+
+        width, height = self.frame_size
+        self.perspective = scaled_perspective(preset,
+                                              self.frame_size)
+        self.M, self.Minv = self.perspective.get_matrices((height, width))
+        # The preset's source points sit on the lane lines, so a lane spans
+        # the destination points in the warped image; along the road the
+        # pipeline's meters per pixel are scaled to this resolution
+        dst = self.perspective.get_dst((height, width))
+        self.x_m_per_pix = LANE_WIDTH / float(dst[1, 0] - dst[0, 0])
+        self.y_m_per_pix = pipeline.Y_M_PER_PIX * REFERENCE_SIZE[0] / float(width)
+        # The warped image is height wide and width high; the lines are
+        # measured at its bottom row
+        self.warped_shape = (width, height)
+        self.y_eval = width - 1.
+        # Warped x of the camera, below the middle of the frame
+        self.camera_x = self.to_warped([[0.5 * width, height]])[0, 0]
+
+        # The canvas the road is drawn on covers the warped image down to
+        # the bottom of the frame, and the road and its shoulders with room
+        # for the curves; beyond it is grass
+        bottom = self.to_warped([[0., height], [width, height]])[:, 1].max()
+        road_half_width = (0.5 * LANE_WIDTH + SHOULDER + max_offset + 1.) / self.x_m_per_pix
+        self.canvas_origin = (int(np.floor(self.camera_x - road_half_width)), 0)
+        self.canvas_shape = (int(np.ceil(bottom)) + 1,
+                             int(np.ceil(2 * road_half_width)) + 1,
+                             3)
+        translation = np.array([[1., 0., self.canvas_origin[0]],
+                                [0., 1., self.canvas_origin[1]],
+                                [0., 0., 1.]])
+        self.canvas_to_frame = self.Minv.dot(translation)
+        # Frame rows above the far end of the warped image show sky
+        self.horizon = int(np.clip(np.ceil(cv2.perspectiveTransform(np.float32([[[0.5 * width, 0.]]]),
+                                                                    self.Minv)[0, 0, 1]),
+                                   0,
+                                   height))
+        # Rows of the canvas the lines are sampled at
+        self.sample_y = np.linspace(0., self.canvas_shape[0] - 1., max(self.canvas_shape[0] // 8, 2))
+        self.canvas = np.empty(self.canvas_shape, dtype=np.uint8)
+        self.noise_image = np.empty((height, width, 3), dtype=np.int16)
+
+    def to_warped(self,
+                  points):
+        return cv2.perspectiveTransform(np.float32([points]),
+                                        self.M)[0]
+
+    def birds_eye(self):
+        mtx, dist = ideal_camera(self.frame_size)
+
+        return BirdsEyeTransform(Undistorter(mtx, dist),
+                                 self.perspective)
+
+    def state(self,
+              index):
+        """ Distance travelled, curvature, heading and lateral offset of
+            the lane centre from the vehicle at a frame.
+        """
+        time = index / self.fps
+        curvature = self.max_curvature * np.sin(2. * np.pi * time / self.curve_period)
+        offset = self.max_offset * np.sin(2. * np.pi * time / self.offset_period)
+        # Heading of the road relative to the vehicle, in m/m, as the
+        # vehicle drifts across the lane
+        heading = 0.01 * np.cos(2. * np.pi * time / self.offset_period)
+
+        return self.speed * time, curvature, heading, offset
+
+    def line_fit(self,
+                 index,
+                 lateral):
+        """ Fit x = A*y**2 + B*y + C in warped pixels of the line lateral
+            meters right of the lane centre at a frame.
+        """
+        _, curvature, heading, offset = self.state(index)
+        # x in meters at distance d ahead is offset + lateral + heading*d
+        # + curvature/2*d**2, with d = (y_eval - y) * y_m_per_pix
+        a = 0.5 * curvature * self.y_m_per_pix**2 / self.x_m_per_pix
+        slope = heading * self.y_m_per_pix / self.x_m_per_pix
+        b = -slope - 2. * a * self.y_eval
+        c = self.camera_x + (offset + lateral) / self.x_m_per_pix + slope * self.y_eval + a * self.y_eval**2
+
+        return np.array([a, b, c])
+
+    def ground_truth(self,
+                     index):
+        """ The lane lines' fits in warped pixels, the radius of curvature
+            in m as Line measures it, and the offset in m of the lane centre
+            from the vehicle, positive with the vehicle left of the centre.
+            The radius is inf where the road is straight, as at frame 0.
+        """
+        left_fit = self.line_fit(index,
+                                 -0.5 * LANE_WIDTH)
+        right_fit = self.line_fit(index,
+                                  0.5 * LANE_WIDTH)
+        if left_fit[0] == 0.:
+            # Line.calculate_curvature would divide by zero
+            radius = np.inf
+        else:
+            radius = Line(self.x_m_per_pix,
+                          self.y_m_per_pix).calculate_curvature(self.y_eval,
+                                                                left_fit)
+
+        return {'frame': index,
+                'curvature': radius,
+                'offset': self.state(index)[3],
+                'left_fit': left_fit,
+                'right_fit': right_fit}
+
+    def canvas_x(self,
+                 fit,
+                 canvas_y):
+        y = canvas_y + self.canvas_origin[1]
+
+        return fit[0]*y**2 + fit[1]*y + fit[2] - self.canvas_origin[0]
+
+    def canvas_y(self,
+                 distance,
+                 travelled):
+        """ Canvas row of the road a distance along it, seen from where the
+            vehicle has travelled to.
+        """
+        return self.y_eval - (distance - travelled) / self.y_m_per_pix - self.canvas_origin[1]
+
+    def draw_strip(self,
+                   fit,
+                   half_width,
+                   colour,
+                   y_range=None):
+        y_values = self.sample_y
+        if y_range is not None:
+            top, bottom = max(y_range[0], 0.), min(y_range[1], self.canvas_shape[0] - 1.)
+            if bottom <= top:
+                return
+            y_values = np.linspace(top, bottom, max(int(bottom - top) // 8, 2))
+        cv2.fillPoly(self.canvas,
+                     [strip_polygon(self.canvas_x(fit, y_values),
+                                    y_values,
+                                    half_width)],
+                     colour)
+
+    def draw_distractors(self,
+                         index,
+                         centre_fit):
+        """ Shadows, cracks and stray paint on the stretch of road in view,
+            each tile of road always getting the same ones.
+        """
+        travelled = self.state(index)[0]
+        view = self.canvas_shape[0] * self.y_m_per_pix
+        first_tile = int(np.floor((travelled - (self.canvas_shape[0] - self.y_eval) * self.y_m_per_pix) / TILE_LENGTH))
+        last_tile = int(np.ceil((travelled + view) / TILE_LENGTH))
+        shadows = []
+        for tile in range(first_tile, last_tile + 1):
+            random_state = np.random.RandomState([self.seed, tile % 2**31])
+            for _ in range(random_state.randint(1, 4)):
+                kind = random_state.choice(['shadow', 'crack', 'paint'])
+                distance = (tile + random_state.random_sample()) * TILE_LENGTH
+                lateral = random_state.uniform(-LANE_WIDTH, LANE_WIDTH)
+                if kind == 'shadow':
+                    # A shadow across the road, from a tree or a bridge
+                    length = random_state.uniform(2., 10.)
+                    shadows.append((distance, length, lateral, random_state.uniform(0.4, 0.7)))
+                elif kind == 'crack':
+                    steps = random_state.normal(0., 0.15, (12, 2)).cumsum(0)
+                    distances = distance + np.linspace(0., 4., 12) + steps[:, 0]
+                    y_values = self.canvas_y(distances, travelled)
+                    x_values = self.canvas_x(centre_fit, y_values) + (lateral + steps[:, 1]) / self.x_m_per_pix
+                    cv2.polylines(self.canvas,
+                                  [np.int32(np.round(np.column_stack([x_values, y_values])))],
+                                  False,
+                                  (45, 45, 45),
+                                  max(int(round(0.03 / self.x_m_per_pix)), 1))
+                else:
+                    # An old or stray marking in white or yellow
+                    length = random_state.uniform(0.5, 2.)
+                    colour = WHITE_PAINT if random_state.random_sample() < 0.5 else YELLOW_PAINT
+                    self.draw_strip(centre_fit + np.array([0., 0., lateral / self.x_m_per_pix]),
+                                    0.5 * random_state.uniform(0.1, 0.5) / self.x_m_per_pix,
+                                    colour,
+                                    (self.canvas_y(distance + length, travelled),
+                                     self.canvas_y(distance, travelled)))
+
+        for distance, length, lateral, shade in shadows:
+            top = int(max(np.floor(self.canvas_y(distance + length, travelled)), 0))
+            bottom = int(min(np.ceil(self.canvas_y(distance, travelled)), self.canvas_shape[0]))
+            if bottom <= top:
+                continue
+            centre = int(round(self.canvas_x(centre_fit, 0.5 * (top + bottom)) + lateral / self.x_m_per_pix))
+            half_width = int(round(1.5 * LANE_WIDTH / self.x_m_per_pix))
+            left, right = max(centre - half_width, 0), min(centre + half_width, self.canvas_shape[1])
+            if right <= left:
+                continue
+            region = self.canvas[top:bottom, left:right]
+            region[...] = (region * shade).astype(np.uint8)
+
+    def render(self,
+               index):
+        """ The BGR frame at index. """
+        travelled = self.state(index)[0]
+        centre_fit = self.line_fit(index, 0.)
+        left_fit = self.line_fit(index, -0.5 * LANE_WIDTH)
+        right_fit = self.line_fit(index, 0.5 * LANE_WIDTH)
+
+        self.canvas[...] = GRASS
+        self.draw_strip(centre_fit,
+                        (0.5 * LANE_WIDTH + SHOULDER) / self.x_m_per_pix,
+                        ASPHALT)
+
+        line_half_width = 0.5 * LINE_WIDTH / self.x_m_per_pix
+        self.draw_strip(left_fit,
+                        line_half_width,
+                        YELLOW_PAINT)
+        # Dashes at fixed places along the road
+        period = DASH_LENGTH + DASH_GAP
+        far = travelled + (self.y_eval - self.canvas_origin[1]) * self.y_m_per_pix
+        near = travelled - (self.canvas_shape[0] - self.y_eval) * self.y_m_per_pix
+        for dash in range(int(np.floor(near / period)), int(np.ceil(far / period)) + 1):
+            self.draw_strip(right_fit,
+                            line_half_width,
+                            WHITE_PAINT,
+                            (self.canvas_y(dash * period + DASH_LENGTH, travelled),
+                             self.canvas_y(dash * period, travelled)))
+
+        if self.distractors:
+            self.draw_distractors(index,
+                                  centre_fit)
+
+        width, height = self.frame_size
+        frame = cv2.warpPerspective(self.canvas,
+                                    self.canvas_to_frame,
+                                    (width, height),
+                                    flags=cv2.INTER_LINEAR,
+                                    borderMode=cv2.BORDER_CONSTANT,
+                                    borderValue=GRASS)
+        frame[:self.horizon] = SKY
+
+        if self.noise > 0:
+            # OpenCV's generator is much faster than numpy's at 4K; seeding
+            # it per frame keeps the frames independent of their order
+            cv2.setRNGSeed(self.seed * 1000003 + index)
+            cv2.randn(self.noise_image,
+                      (0., 0., 0.),
+                      (self.noise, self.noise, self.noise))
+            np.clip(self.noise_image + frame,
+                    0,
+                    255,
+                    out=self.noise_image)
+            frame = self.noise_image.astype(np.uint8)
+
+        return frame
+
+    def frames(self):
+        """ Yield the BGR frames in order, for run_pipeline or a sink. """
+        for index in range(self.frame_count):
+            yield self.render(index)
+
+def write_ground_truth(road,
+                       file_name):
+    """ Write every frame's ground_truth as a row of GROUND_TRUTH_FIELDS,
+        a straight road's curvature as inf.
+    """
+    with open(file_name, 'w') as csv_file:
+        writer = csv.DictWriter(csv_file,
+                                GROUND_TRUTH_FIELDS)
+        writer.writeheader()
+        for index in range(road.frame_count):
+            truth = road.ground_truth(index)
+            row = {'frame': index,
+                   'curvature': repr(float(truth['curvature'])),
+                   'offset': repr(float(truth['offset']))}
+            for side in ('left', 'right'):
+                for power, coefficient in enumerate(truth[side + '_fit']):
+                    row['{0}_fit_{1}'.format(side, power)] = repr(float(coefficient))
+            writer.writerow(row)
+
+def make_tracker(road):
+    """ The pipeline's LaneTracker, with its lines measuring in the road's
+        meters per pixel and their separation checks scaled to its
+        resolution.
+    """
+    tracker = pipeline.make_tracker()
+    x_scale = pipeline.X_M_PER_PIX / road.x_m_per_pix
+    for line in (tracker.left_line, tracker.right_line):
+        line.x_m_per_pix = road.x_m_per_pix
+        line.y_m_per_pix = road.y_m_per_pix
+        line.min_separation *= x_scale
+        line.max_separation *= x_scale
+
+    return tracker
+
+def evaluate(road,
+             tracker=None):
+    """ Run the road's frames through the pipeline and compare the lines'
+        best fits with the ground truth. Returns the fraction of frames
+        where both lines passed their checks, the mean and largest x error
+        in pixels over the warped image, and the median relative error of
+        the radius of curvature on frames curving with a radius under 2 km.
+    """
+    if tracker is None:
+        tracker = make_tracker(road)
+    birds_eye = road.birds_eye()
+    ploty = np.arange(road.warped_shape[0], dtype=np.float64)
+
+    detected = 0
+    x_errors = []
+    curvature_errors = []
+    for index, frame in enumerate(road.frames()):
+        process_frame(frame,
+                      birds_eye,
+                      tracker)
+        truth = road.ground_truth(index)
+        if tracker.left_line.detected and tracker.right_line.detected:
+            detected += 1
+        if len(tracker.left_line.last_n_fits) == 0 or len(tracker.right_line.last_n_fits) == 0:
+            continue
+        for side, line in (('left', tracker.left_line), ('right', tracker.right_line)):
+            x_errors.append(np.abs(np.polyval(line.best_fit, ploty) - np.polyval(truth[side + '_fit'], ploty)).max())
+        if truth['curvature'] < 2000.:
+            curvature = 0.5 * (tracker.left_line.calculate_curvature(road.y_eval) +
+                               tracker.right_line.calculate_curvature(road.y_eval))
+            curvature_errors.append(abs(curvature - truth['curvature']) / truth['curvature'])
+
+    return {'frames': road.frame_count,
+            'detected': detected / float(max(road.frame_count, 1)),
+            'mean_dx': float(np.mean(x_errors)) if x_errors else np.nan,
+            'max_dx': float(np.max(x_errors)) if x_errors else np.nan,
+            'median_curvature_error': float(np.median(curvature_errors)) if curvature_errors else np.nan}
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Render a synthetic road video with known lane lines.')
+    parser.add_argument('output',
+                        nargs='?',
+                        help='video file, or directory for the images sink')
+    parser.add_argument('--width',
+                        type=int,
+                        default=REFERENCE_SIZE[0])
+    parser.add_argument('--height',
+                        type=int,
+                        default=REFERENCE_SIZE[1])
+    parser.add_argument('-n', '--frames',
+                        type=int,
+                        default=250)
+    parser.add_argument('--fps',
+                        type=float,
+                        default=25.)
+    parser.add_argument('--seed',
+                        type=int,
+                        default=0)
+    parser.add_argument('--noise',
+                        type=float,
+                        default=2.,
+                        help='standard deviation of the sensor noise')
+    parser.add_argument('--no-distractors',
+                        action='store_true',
+                        help='leave out the shadows, cracks and stray paint')
+    parser.add_argument('-p', '--preset',
+                        default='test_images',
+                        choices=sorted(PERSPECTIVE_PRESETS),
+                        help='perspective preset the road is drawn for')
+    parser.add_argument('-s', '--sink',
+                        default='video',
+                        choices=['video', 'ffmpeg', 'images'],
+                        help='how the frames are written')
+    parser.add_argument('-g', '--ground-truth',
+                        help='CSV file for the per-frame lane fits, curvature and offset')
+    parser.add_argument('-e', '--evaluate',
+                        action='store_true',
+                        help='stream the frames through the pipeline and compare with the ground truth')
+
+    return parser.parse_args(args)
+
+def main():
+    """ Synthetic video entry point
+    """
+    args = parse_args()
+    road = SyntheticRoad((args.width, args.height),
+                         args.frames,
+                         args.fps,
+                         args.seed,
+                         args.noise,
+                         not args.no_distractors,
+                         args.preset)
+
+    if args.output is not None:
+        with make_sink(args.sink,
+                       args.output,
+                       road.fps,
+                       road.frame_size) as sink:
+            for frame in road.frames():
+                sink.write(frame)
+    if args.ground_truth is not None:
+        write_ground_truth(road,
+                           args.ground_truth)
+        LOGGER.info("Ground truth written to {}".format(args.ground_truth))
+
+    if args.evaluate:
+        stats = evaluate(road)
+        print("{0} frames: both lines detected in {1:.1f}%, mean dx {2:.2f} px, max dx {3:.2f} px, median curvature error {4:.1f}%".format(stats['frames'],
+                                                                                                                                           100*stats['detected'],
+                                                                                                                                           stats['mean_dx'],
+                                                                                                                                           stats['max_dx'],
+                                                                                                                                           100*stats['median_curvature_error']))
+
+if __name__ == '__main__':
+    set_up_logger()
+    main()
@@ -0,0 +1,173 @@
+import collections
+import os
+import subprocess
+
+import cv2
+
+from logger import LOGGER
+from profiling import PROFILER
+
+VideoInfo = collections.namedtuple('VideoInfo',
+                                   ['fps', 'frame_count', 'frame_size', 'duration'])
+
+def get_video_info(video_file):
+    """ Frame rate, frame count, (width, height) and duration in seconds of
+        a video, as stored in its container.
+    """
+    capture = cv2.VideoCapture(video_file)
+    if not capture.isOpened():
+        raise IOError("Could not open {}".format(video_file))
+    fps = capture.get(cv2.CAP_PROP_FPS)
+    frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    frame_size = (int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                  int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    capture.release()
+
+    duration = frame_count / fps if fps > 0 else 0.
+
+    return VideoInfo(fps, frame_count, frame_size, duration)
+
+def stream_frames(video_file):
+    """ Yield every decoded BGR frame of a video exactly once, in order. """
+    capture = cv2.VideoCapture(video_file)
+    if not capture.isOpened():
+        raise IOError("Could not open {}".format(video_file))
+    try:
+        while True:
+            with PROFILER.stage('read'):
+                ret, frame = capture.read()
+            if not ret:
+                break
+            yield frame
+    finally:
+        capture.release()
+
+class VideoWriterSink():
+    """ Writes BGR frames to a video file with cv2.VideoWriter. """
+    def __init__(self,
+                 file_name,
+                 fps,
+                 frame_size,
+                 fourcc='mp4v'):
+        self.file_name = file_name
+        self.writer = cv2.VideoWriter(file_name,
+                                      cv2.VideoWriter_fourcc(*fourcc),
+                                      fps,
+                                      frame_size)
+        if not self.writer.isOpened():
+            raise IOError("Could not open {} for writing".format(file_name))
+
+    def write(self,
+              frame):
+        self.writer.write(frame)
+
+    def close(self):
+        self.writer.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class FFmpegSink():
+    """ Pipes raw BGR frames into an ffmpeg process that encodes them. """
+    def __init__(self,
+                 file_name,
+                 fps,
+                 frame_size,
+                 codec='libx264',
+                 ffmpeg='ffmpeg'):
+        self.file_name = file_name
+        command = [ffmpeg,
+                   '-y',
+                   '-loglevel', 'error',
+                   '-f', 'rawvideo',
+                   '-pix_fmt', 'bgr24',
+                   '-s', '{0}x{1}'.format(frame_size[0], frame_size[1]),
+                   '-r', str(fps),
+                   '-i', '-',
+                   '-c:v', codec,
+                   '-pix_fmt', 'yuv420p',
+                   file_name]
+        self.process = subprocess.Popen(command,
+                                        stdin=subprocess.PIPE)
+
+    def write(self,
+              frame):
+        self.process.stdin.write(frame.tobytes())
+
+    def close(self):
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise IOError("ffmpeg failed to write {}".format(self.file_name))
+
+    def abort(self):
+        """ Close after an error, without raising over it: ffmpeg may
+            already have died, which is often what the error was.
+        """
+        try:
+            self.process.stdin.close()
+        except (IOError, OSError):
+            # BrokenPipeError when ffmpeg has exited
+            pass
+        if self.process.wait() != 0:
+            LOGGER.warning("ffmpeg failed to write {}".format(self.file_name))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+class ImageSequenceSink():
+    """ Writes every BGR frame to its own numbered image file. """
+    def __init__(self,
+                 directory,
+                 file_pattern='frame_{:06d}.jpg'):
+        self.directory = directory
+        self.file_pattern = file_pattern
+        self.frame_number = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def write(self,
+              frame):
+        cv2.imwrite(os.path.join(self.directory,
+                                 self.file_pattern.format(self.frame_number)),
+                    frame)
+        self.frame_number += 1
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+SINKS = {'video': VideoWriterSink,
+         'ffmpeg': FFmpegSink}
+
+def make_sink(kind,
+              output,
+              fps,
+              frame_size):
+    """ Build a sink by name: 'video' (cv2.VideoWriter), 'ffmpeg' (raw pipe to
+        ffmpeg) or 'images' (an image sequence in the directory output).
+    """
+    LOGGER.info("Writing {0} output to {1}".format(kind,
+                                                   output))
+    if kind == 'images':
+        return ImageSequenceSink(output)
+    if kind not in SINKS:
+        raise ValueError("Unknown sink {0}, expected one of {1}".format(kind,
+                                                                        sorted(SINKS) + ['images']))
+
+    return SINKS[kind](output,
+                       fps,
+                       frame_size)